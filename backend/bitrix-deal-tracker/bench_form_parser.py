@@ -0,0 +1,85 @@
+"""
+Business: Микробенчмарк разбора тела вебхука Битрикс24: прежний parse_qs + replace против bitrix_form.parse_form_body
+Args: CLI - python bench_form_parser.py [--iterations N] [--product-rows N] [--base64]
+Returns: время на событие (мкс) для обоих вариантов и ускорение
+"""
+import argparse
+import base64
+import json
+import timeit
+import urllib.parse
+from typing import Dict, Any
+
+from bitrix_form import parse_form_body
+
+def legacy_parse(body_str: str, is_base64: bool) -> Dict[str, Any]:
+    '''Разбор, который был в bitrix-deal-tracker / bitrix-test-handler до bitrix_form'''
+    if is_base64:
+        body_str = base64.b64decode(body_str).decode('utf-8')
+
+    parsed = urllib.parse.parse_qs(body_str)
+    body_data = {k: v[0] if len(v) == 1 else v for k, v in parsed.items()}
+
+    if 'auth[domain]' in body_data:
+        auth = {}
+        data_fields = {}
+        for key, value in list(body_data.items()):
+            if key.startswith('auth['):
+                auth_key = key.replace('auth[', '').replace(']', '')
+                auth[auth_key] = value
+                del body_data[key]
+            elif key.startswith('data[FIELDS]['):
+                field_key = key.replace('data[FIELDS][', '').replace(']', '')
+                data_fields[field_key] = value
+                del body_data[key]
+
+        if auth:
+            body_data['auth'] = auth
+        if data_fields:
+            body_data['data'] = {'FIELDS': data_fields}
+
+    return body_data
+
+def build_sample_body(product_rows: int) -> str:
+    '''Типичное событие ONCRMDEALUPDATE в том виде, в каком его шлёт Битрикс24 (скобки percent-encoded)'''
+    pairs = [
+        ('event', 'ONCRMDEALUPDATE'),
+        ('event_handler_id', '17'),
+        ('data[FIELDS][ID]', '48213'),
+        ('ts', '1729234567'),
+        ('auth[domain]', 'example.bitrix24.ru'),
+        ('auth[client_endpoint]', 'https://example.bitrix24.ru/rest/'),
+        ('auth[server_endpoint]', 'https://oauth.bitrix.info/rest/'),
+        ('auth[member_id]', 'a1b2c3d4e5f60718293a4b5c6d7e8f90'),
+        ('auth[application_token]', 'q9w8e7r6t5y4u3i2o1p0'),
+    ]
+    for row in range(product_rows):
+        pairs.append((f'data[FIELDS][PRODUCT_ROWS][{row}][ID]', str(1000 + row)))
+        pairs.append((f'data[FIELDS][PRODUCT_ROWS][{row}][PRODUCT_NAME]', f'Товар №{row}'))
+    return urllib.parse.urlencode(pairs)
+
+def main():
+    parser = argparse.ArgumentParser(description='Сравнение разбора urlencoded-событий Битрикс24')
+    parser.add_argument('--iterations', type=int, default=20000, help='число разборов на вариант')
+    parser.add_argument('--product-rows', type=int, default=0, help='строк товаров в data[FIELDS][PRODUCT_ROWS]')
+    parser.add_argument('--base64', action='store_true', help='тело в base64, как при isBase64Encoded=true')
+    args = parser.parse_args()
+
+    body = build_sample_body(args.product_rows)
+    if args.base64:
+        body = base64.b64encode(body.encode('utf-8')).decode('ascii')
+
+    legacy_seconds = min(timeit.repeat(lambda: legacy_parse(body, args.base64), number=args.iterations, repeat=3))
+    shared_seconds = min(timeit.repeat(lambda: parse_form_body(body, args.base64), number=args.iterations, repeat=3))
+
+    stats = {
+        'body_bytes': len(body),
+        'iterations': args.iterations,
+        'legacy_us_per_event': round(legacy_seconds / args.iterations * 1e6, 2),
+        'bitrix_form_us_per_event': round(shared_seconds / args.iterations * 1e6, 2),
+        'speedup': round(legacy_seconds / shared_seconds, 2) if shared_seconds else None
+    }
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
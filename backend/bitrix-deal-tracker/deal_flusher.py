@@ -0,0 +1,171 @@
+"""
+Business: Забирает из Битрикс24 сделки, помеченные событиями как изменённые (dirty_deals), по одному разу на окно дебаунса
+Args: CLI - python deal_flusher.py [--max-seconds N]
+      HTTP - GET/POST ?action=flush в bitrix-deal-tracker
+Returns: статистику прогона (сделок, записей изменений, пропущено без изменений)
+"""
+import argparse
+import json
+import os
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, Any, List
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from index import record_deal_change, DEAL_DEBOUNCE_SECONDS
+
+FLUSH_CHUNK_SIZE = 50
+# Сделка, которую постоянно меняют, всё равно сбрасывается не реже раза в DEAL_DEBOUNCE_MAX_WAIT секунд
+DEAL_DEBOUNCE_MAX_WAIT = float(os.environ.get('DEAL_DEBOUNCE_MAX_WAIT', str(max(DEAL_DEBOUNCE_SECONDS * 5, 60))))
+# Захват пачки сбросом, упавшим до завершения, перестаёт действовать через DEAL_CLAIM_TTL_SECONDS
+DEAL_CLAIM_TTL_SECONDS = 300
+
+def flush_dirty_deals(conn, max_seconds: float = 25) -> Dict[str, Any]:
+    '''
+    Сделки, по которым DEAL_DEBOUNCE_SECONDS не было событий, забираются пачками по 50 одним crm.deal.list
+    с filter[ID]. Пачка сначала помечается claimed_at короткой транзакцией - блокировки строк dirty_deals
+    не держатся во время запросов к Битрикс24, и вебхуки по этим сделкам не ждут сброса.
+    Строка удаляется вместе с записью изменений, только если после захвата по сделке не было новых событий;
+    иначе захват снимается и сделка будет сброшена ещё раз
+    '''
+    webhook_url = os.environ.get('BITRIX24_WEBHOOK_URL', '')
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    started = time.monotonic()
+    stats = {'success': True, 'deals': 0, 'events': 0, 'recorded': 0, 'unchanged': 0, 'requeued': 0, 'chunks': 0}
+    dirty: List[Dict[str, Any]] = []
+    
+    try:
+        while time.monotonic() - started < max_seconds:
+            dirty = claim_dirty_deals(cur, conn)
+            if not dirty:
+                break
+            
+            deals = fetch_deals(webhook_url, [row['deal_id'] for row in dirty])
+            
+            for row in dirty:
+                deal_full_data = deals.get(row['deal_id']) or {'error': 'Сделка не найдена в Битрикс24', 'deal_id': row['deal_id']}
+                log_id = record_deal_change(cur, webhook_url, row['deal_id'], deal_full_data, {
+                    'event_type': row['event_type'],
+                    'event_handler_id': row['event_handler_id'],
+                    'domain': row['bitrix_domain'],
+                    'member_id': row['member_id'],
+                    'ts': row['timestamp_bitrix']
+                })
+                stats['recorded' if log_id else 'unchanged'] += 1
+                stats['events'] += row['events_count']
+            
+            stats['requeued'] += finish_claimed_deals(cur, dirty)
+            conn.commit()
+            stats['deals'] += len(dirty)
+            stats['chunks'] += 1
+            dirty = []
+    
+    except Exception as e:
+        conn.rollback()
+        stats['success'] = False
+        stats['error'] = str(e)
+        print(f"[ERROR] Ошибка сброса грязных сделок: {e}")
+        # Снимаем захват, чтобы пачку не пришлось ждать DEAL_CLAIM_TTL_SECONDS
+        if dirty:
+            release_claimed_deals(cur, conn, dirty)
+    finally:
+        cur.close()
+    
+    stats['elapsed_seconds'] = round(time.monotonic() - started, 2)
+    return stats
+
+def claim_dirty_deals(cur, conn) -> List[Dict[str, Any]]:
+    '''Помечает claimed_at до FLUSH_CHUNK_SIZE готовых сделок и сразу фиксирует - блокировки строк живут миллисекунды'''
+    cur.execute("""
+        UPDATE dirty_deals SET claimed_at = clock_timestamp()
+        WHERE deal_id IN (
+            SELECT deal_id FROM dirty_deals
+            WHERE (claimed_at IS NULL OR claimed_at <= now() - make_interval(secs => %s))
+              AND (last_seen_at <= now() - make_interval(secs => %s)
+                   OR first_seen_at <= now() - make_interval(secs => %s))
+            ORDER BY first_seen_at
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING *
+    """, (DEAL_CLAIM_TTL_SECONDS, DEAL_DEBOUNCE_SECONDS, DEAL_DEBOUNCE_MAX_WAIT, FLUSH_CHUNK_SIZE))
+    dirty = cur.fetchall()
+    conn.commit()
+    return dirty
+
+def finish_claimed_deals(cur, dirty: List[Dict[str, Any]]) -> int:
+    '''
+    Удаляет сброшенные сделки, по которым после захвата не было событий. Сделки с новыми событиями
+    возвращаются в очередь без захвата и без уже учтённых событий. Возвращает число возвращённых сделок
+    '''
+    deal_ids = [row['deal_id'] for row in dirty]
+    claimed_at = [row['claimed_at'] for row in dirty]
+    events = [row['events_count'] for row in dirty]
+    
+    cur.execute("""
+        DELETE FROM dirty_deals d
+        USING unnest(%s::varchar[], %s::timestamptz[]) AS c(deal_id, claimed_at)
+        WHERE d.deal_id = c.deal_id AND d.claimed_at = c.claimed_at AND d.last_seen_at <= c.claimed_at
+    """, (deal_ids, claimed_at))
+    
+    cur.execute("""
+        UPDATE dirty_deals d
+        SET claimed_at = NULL,
+            events_count = GREATEST(d.events_count - c.events_count, 1),
+            first_seen_at = c.claimed_at
+        FROM unnest(%s::varchar[], %s::timestamptz[], %s::int[]) AS c(deal_id, claimed_at, events_count)
+        WHERE d.deal_id = c.deal_id AND d.claimed_at = c.claimed_at
+    """, (deal_ids, claimed_at, events))
+    requeued = cur.rowcount
+    
+    print(f"[INFO] Сброшено {len(dirty)} сделок ({sum(events)} событий), вернулись в очередь: {requeued}")
+    return requeued
+
+def release_claimed_deals(cur, conn, dirty: List[Dict[str, Any]]):
+    try:
+        cur.execute("""
+            UPDATE dirty_deals d SET claimed_at = NULL
+            FROM unnest(%s::varchar[], %s::timestamptz[]) AS c(deal_id, claimed_at)
+            WHERE d.deal_id = c.deal_id AND d.claimed_at = c.claimed_at
+        """, ([row['deal_id'] for row in dirty], [row['claimed_at'] for row in dirty]))
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        print(f"[WARN] Не удалось снять захват пачки dirty_deals: {e}")
+
+def fetch_deals(webhook_url: str, deal_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+    '''Все поля (включая пользовательские) до 50 сделок одним crm.deal.list; отсутствующих в ответе сделок нет в словаре'''
+    if not webhook_url:
+        raise RuntimeError('BITRIX24_WEBHOOK_URL не настроен')
+    
+    params = urllib.parse.urlencode({
+        'filter[ID][]': deal_ids,
+        'select[]': ['*', 'UF_*']
+    }, doseq=True)
+    req = urllib.request.Request(f"{webhook_url}crm.deal.list.json", data=params.encode('utf-8'))
+    
+    with urllib.request.urlopen(req, timeout=15) as response:
+        rest_data = json.loads(response.read().decode('utf-8'))
+    
+    if 'error' in rest_data:
+        raise RuntimeError(rest_data.get('error_description', rest_data.get('error')))
+    
+    return {str(deal['ID']): deal for deal in rest_data.get('result') or []}
+
+def main():
+    parser = argparse.ArgumentParser(description='Сброс накопленных изменений сделок из dirty_deals')
+    parser.add_argument('--max-seconds', type=float, default=25, help='ограничение времени прогона')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        stats = flush_dirty_deals(conn, max_seconds=args.max_seconds)
+    finally:
+        conn.close()
+    
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
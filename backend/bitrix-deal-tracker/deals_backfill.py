@@ -0,0 +1,216 @@
+"""
+Business: Заполняет deal_changes и deal_current_state базовыми снимками всех существующих сделок Битрикс24
+Args: CLI - python deals_backfill.py [--reset] [--max-seconds N]
+      HTTP - GET/POST ?action=backfill[&reset=1&max_seconds=25] в bitrix-deal-tracker
+Returns: статистику прогона (строк, строк/сек, водяной знак, завершён ли проход)
+"""
+import argparse
+import json
+import os
+import time
+import urllib.parse
+import urllib.request
+from typing import Dict, Any, List
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+SYNC_NAME = 'deal_baseline'
+PAGE_SIZE = 50
+BITRIX_RATE_LIMIT = float(os.environ.get('BITRIX24_RATE_LIMIT', '2'))
+
+def backfill_deals(conn, max_seconds: float = 25, reset: bool = False) -> Dict[str, Any]:
+    '''
+    Обходит все сделки быстрой постраничной выборкой по ID: order[ID]=ASC, filter[>ID]=водяной знак, start=-1.
+    Снимок пишется только для сделок, которых ещё нет в deal_current_state, - живые данные трекера не затираются.
+    Каждая страница - одна короткая транзакция с многострочным INSERT, водяной знак фиксируется вместе с ней
+    '''
+    webhook_url = os.environ.get('BITRIX24_WEBHOOK_URL', '')
+    if not webhook_url:
+        return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL не настроен'}
+    
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    
+    if reset:
+        cur.execute(
+            "UPDATE sync_state SET watermark = 0, rows_synced = 0, completed = FALSE, updated_at = CURRENT_TIMESTAMP WHERE sync_name = %s",
+            (SYNC_NAME,)
+        )
+        conn.commit()
+    
+    watermark = load_watermark(cur)
+    conn.commit()
+    start_watermark = watermark
+    started = time.monotonic()
+    last_call = 0.0
+    pages = 0
+    rows = 0
+    inserted = 0
+    completed = False
+    error = None
+    
+    print(f"[INFO] Deal backfill started from watermark {watermark}")
+    
+    try:
+        while time.monotonic() - started < max_seconds:
+            # Собственный лимит запросов, чтобы не съедать квоту портала у живых вебхуков
+            wait = 1 / BITRIX_RATE_LIMIT - (time.monotonic() - last_call)
+            if wait > 0:
+                time.sleep(wait)
+            last_call = time.monotonic()
+            
+            result = call_bitrix_list(webhook_url, 'crm.deal.list', {
+                'order[ID]': 'ASC',
+                'filter[>ID]': watermark,
+                'select[]': ['*', 'UF_*'],
+                'start': -1
+            })
+            
+            deals = result.get('result') or []
+            if deals:
+                inserted += insert_baseline_page(cur, deals)
+                watermark = max(int(deal['ID']) for deal in deals)
+                rows += len(deals)
+                pages += 1
+            
+            completed = len(deals) < PAGE_SIZE
+            save_watermark(cur, watermark, len(deals), completed)
+            conn.commit()
+            
+            elapsed = time.monotonic() - started
+            print(f"[INFO] Page {pages}: watermark {watermark}, {rows} deals, {rows / elapsed if elapsed else 0:.1f} deals/s")
+            
+            if completed:
+                break
+    
+    except Exception as e:
+        conn.rollback()
+        error = str(e)
+        print(f"[ERROR] Deal backfill failed at watermark {watermark}: {e}")
+    
+    elapsed = time.monotonic() - started
+    stats = {
+        'success': error is None,
+        'sync_name': SYNC_NAME,
+        'start_watermark': start_watermark,
+        'watermark': watermark,
+        'pages': pages,
+        'rows': rows,
+        'baselines_inserted': inserted,
+        'completed': completed,
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else 0
+    }
+    if error:
+        stats['error'] = error
+    
+    cur.execute(
+        "UPDATE sync_state SET last_run_stats = %s WHERE sync_name = %s",
+        (json.dumps(stats), SYNC_NAME)
+    )
+    conn.commit()
+    cur.close()
+    
+    return stats
+
+def insert_baseline_page(cur, deals: List[Dict[str, Any]]) -> int:
+    '''
+    Снимки новых сделок в два запроса одной транзакции. Сначала строки deal_current_state вставляются
+    с ON CONFLICT DO NOTHING: вставка занимает сделку (параллельный прогон или живое событие трекера ждут
+    на уникальном ключе), RETURNING отдаёт только реально занятые. Затем снимки в deal_changes
+    (event_type BACKFILL) пишутся лишь для них, а last_change_id и event_ts переносятся в deal_current_state
+    '''
+    values = [
+        (str(deal['ID']), json.dumps(deal, ensure_ascii=False), deal.get('STAGE_ID', ''), str(deal.get('MODIFY_BY_ID') or ''), int(deal['ID']))
+        for deal in deals
+    ]
+    
+    claimed = execute_values(
+        cur,
+        """WITH incoming (deal_id, deal_data, current_stage, modifier_user_id, sort_id) AS (VALUES %s)
+           INSERT INTO deal_current_state (
+               deal_id, deal_data, current_stage, event_type, modifier_user_id, modifier_user_name, event_ts, updated_at
+           )
+           SELECT i.deal_id, i.deal_data::jsonb, i.current_stage, 'BACKFILL', i.modifier_user_id, u.full_name,
+                  extract(epoch FROM now())::bigint, now()
+           FROM incoming i
+           LEFT JOIN bitrix_users u ON u.user_id = i.modifier_user_id
+           ORDER BY i.sort_id
+           ON CONFLICT (deal_id) DO NOTHING
+           RETURNING deal_id""",
+        values,
+        page_size=PAGE_SIZE,
+        fetch=True
+    )
+    
+    claimed_ids = {row['deal_id'] for row in claimed}
+    if not claimed_ids:
+        return 0
+    
+    execute_values(
+        cur,
+        """WITH incoming (deal_id, deal_data, current_stage, modifier_user_id, sort_id) AS (VALUES %s),
+           inserted AS (
+               INSERT INTO deal_changes (
+                   deal_id, event_type, deal_data, modifier_user_id, modifier_user_name, current_stage, is_snapshot
+               )
+               SELECT i.deal_id, 'BACKFILL', i.deal_data::jsonb, i.modifier_user_id, u.full_name, i.current_stage, TRUE
+               FROM incoming i
+               LEFT JOIN bitrix_users u ON u.user_id = i.modifier_user_id
+               ORDER BY i.sort_id
+               RETURNING id, deal_id, event_ts
+           )
+           UPDATE deal_current_state s
+           SET last_change_id = inserted.id, event_ts = inserted.event_ts
+           FROM inserted
+           WHERE s.deal_id = inserted.deal_id""",
+        [row for row in values if row[0] in claimed_ids],
+        page_size=PAGE_SIZE
+    )
+    
+    return len(claimed_ids)
+
+def call_bitrix_list(webhook_url: str, method: str, params: Dict[str, Any]) -> Dict[str, Any]:
+    data = urllib.parse.urlencode(params, doseq=True).encode('utf-8')
+    req = urllib.request.Request(f"{webhook_url}{method}.json", data=data)
+    
+    with urllib.request.urlopen(req, timeout=30) as response:
+        result = json.loads(response.read().decode('utf-8'))
+    
+    if 'error' in result:
+        raise RuntimeError(result.get('error_description', result.get('error')))
+    
+    return result
+
+def load_watermark(cur) -> int:
+    cur.execute(
+        "INSERT INTO sync_state (sync_name) VALUES (%s) ON CONFLICT (sync_name) DO NOTHING",
+        (SYNC_NAME,)
+    )
+    cur.execute("SELECT watermark FROM sync_state WHERE sync_name = %s", (SYNC_NAME,))
+    row = cur.fetchone()
+    return int(row['watermark']) if row else 0
+
+def save_watermark(cur, watermark: int, page_rows: int, completed: bool):
+    cur.execute(
+        """UPDATE sync_state
+           SET watermark = %s, rows_synced = rows_synced + %s, completed = %s, updated_at = CURRENT_TIMESTAMP
+           WHERE sync_name = %s""",
+        (watermark, page_rows, completed, SYNC_NAME)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Базовые снимки всех сделок Битрикс24 в deal_changes / deal_current_state')
+    parser.add_argument('--reset', action='store_true', help='начать полный проход с ID=0')
+    parser.add_argument('--max-seconds', type=float, default=24 * 3600, help='ограничение времени прогона')
+    args = parser.parse_args()
+    
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        stats = backfill_deals(conn, max_seconds=args.max_seconds, reset=args.reset)
+    finally:
+        conn.close()
+    
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
@@ -2,11 +2,28 @@ import json
 import os
 import urllib.parse
 import urllib.request
-import base64
-from typing import Dict, Any
+import time
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+# Имена пользователей: LRU в памяти экземпляра функции -> таблица bitrix_users -> user.get только при промахе
+USER_CACHE_SIZE = 1000
+USER_TTL_SECONDS = int(os.environ.get('BITRIX_USERS_TTL_SECONDS', '86400'))
+# Неудачный user.get повторяется не чаще раза в USER_NEGATIVE_TTL_SECONDS
+USER_NEGATIVE_TTL_SECONDS = int(os.environ.get('BITRIX_USERS_NEGATIVE_TTL_SECONDS', '600'))
+_user_name_cache: 'OrderedDict[str, Tuple[str, float]]' = OrderedDict()
+
+# Окно дебаунса событий по сделке (0 - обрабатывать каждое событие сразу)
+DEAL_DEBOUNCE_SECONDS = float(os.environ.get('DEAL_DEBOUNCE_SECONDS', '0'))
+
+# Полный снимок сделки пишется при первом событии, смене стадии и раз в DEAL_SNAPSHOT_EVERY событий,
+# остальные записи хранят только diff полей и ключевые поля для списка
+DEAL_SNAPSHOT_EVERY = int(os.environ.get('DEAL_SNAPSHOT_EVERY', '20'))
+DEAL_KEY_FIELDS = ('ID', 'TITLE', 'STAGE_ID', 'CATEGORY_ID', 'OPPORTUNITY', 'CURRENCY_ID', 'COMPANY_ID',
+                   'CONTACT_ID', 'ASSIGNED_BY_ID', 'MODIFY_BY_ID', 'DATE_MODIFY')
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Отслеживает изменения сделок в Битрикс24 и сохраняет полные данные в БД
@@ -29,6 +46,45 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
+    # Сброс накопленных «грязных» сделок (вызывается по расписанию в режиме дебаунса)
+    if (event.get('queryStringParameters') or {}).get('action') == 'flush':
+        from deal_flusher import flush_dirty_deals
+        
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            flush_stats = flush_dirty_deals(conn)
+        finally:
+            conn.close()
+        
+        return {
+            'statusCode': 200 if flush_stats.get('success') else 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(flush_stats, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
+    # Базовые снимки существующих сделок (возобновляемый проход по водяному знаку в sync_state)
+    if (event.get('queryStringParameters') or {}).get('action') == 'backfill':
+        from deals_backfill import backfill_deals
+        
+        backfill_params = event.get('queryStringParameters') or {}
+        conn = psycopg2.connect(os.environ['DATABASE_URL'])
+        try:
+            backfill_stats = backfill_deals(
+                conn,
+                max_seconds=float(backfill_params.get('max_seconds', 25)),
+                reset=backfill_params.get('reset', '') in ('1', 'true')
+            )
+        finally:
+            conn.close()
+        
+        return {
+            'statusCode': 200 if backfill_stats.get('success') else 500,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps(backfill_stats, ensure_ascii=False),
+            'isBase64Encoded': False
+        }
+    
     headers = event.get('headers', {})
     body_str = event.get('body', '')
     
@@ -44,35 +100,8 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         content_type = headers.get('Content-Type', headers.get('content-type', ''))
         
         if 'application/x-www-form-urlencoded' in content_type:
-            # Декодируем base64 если нужно
-            if event.get('isBase64Encoded', False):
-                try:
-                    body_str = base64.b64decode(body_str).decode('utf-8')
-                    print(f"[DEBUG] Decoded from base64: {body_str[:200]}")
-                except Exception as e:
-                    print(f"[ERROR] Failed to decode base64: {e}")
-            
-            parsed = urllib.parse.parse_qs(body_str)
-            body_data = {k: v[0] if len(v) == 1 else v for k, v in parsed.items()}
-            
-            # Парсим вложенные структуры auth и data
-            if 'auth[domain]' in body_data:
-                auth = {}
-                data_fields = {}
-                for key, value in list(body_data.items()):
-                    if key.startswith('auth['):
-                        auth_key = key.replace('auth[', '').replace(']', '')
-                        auth[auth_key] = value
-                        del body_data[key]
-                    elif key.startswith('data[FIELDS]['):
-                        field_key = key.replace('data[FIELDS][', '').replace(']', '')
-                        data_fields[field_key] = value
-                        del body_data[key]
-                
-                if auth:
-                    body_data['auth'] = auth
-                if data_fields:
-                    body_data['data'] = {'FIELDS': data_fields}
+            from bitrix_form import parse_form_body
+            body_data = parse_form_body(body_str, event.get('isBase64Encoded', False))
         else:
             try:
                 body_data = json.loads(body_str)
@@ -103,121 +132,48 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'isBase64Encoded': False
         }
     
-    # Используем входящий вебхук из секретов для REST API
     webhook_url = os.environ.get('BITRIX24_WEBHOOK_URL', '')
-    if not webhook_url:
-        print(f"[ERROR] Секрет BITRIX24_WEBHOOK_URL не настроен!")
-        deal_full_data = {'error': 'BITRIX24_WEBHOOK_URL не настроен', 'deal_id': deal_id}
-    else:
-        # Получаем полные данные сделки через REST API
-        rest_url = f"{webhook_url}crm.deal.get.json"
-        params = urllib.parse.urlencode({'ID': deal_id})
-        
-        try:
-            print(f"[INFO] Запрос к REST API: {rest_url}?{params[:100]}...")
-            
-            req = urllib.request.Request(f"{rest_url}?{params}")
-            with urllib.request.urlopen(req, timeout=10) as response:
-                rest_data = json.loads(response.read().decode('utf-8'))
-            
-            if not rest_data.get('result'):
-                print(f"[WARN] REST API не вернул данные сделки: {rest_data}")
-                deal_full_data = {'error': 'Нет данных от REST API', 'raw': rest_data}
-            else:
-                deal_full_data = rest_data['result']
-                print(f"[INFO] Получены данные сделки: {json.dumps(deal_full_data, ensure_ascii=False)[:200]}...")
-            
-        except Exception as e:
-            print(f"[ERROR] Ошибка при запросе к REST API: {e}")
-            deal_full_data = {'error': str(e), 'deal_id': deal_id}
-    
-    # Получаем данные пользователя из deal_data или через REST API
-    modifier_id = deal_full_data.get('MODIFY_BY_ID', '')
-    modifier_name = deal_full_data.get('MODIFY_BY_NAME', '')  # Иногда Битрикс возвращает имя
-    
-    # Если нет имени, пробуем загрузить через REST (может не работать для входящих вебхуков)
-    if modifier_id and not modifier_name and webhook_url:
-        try:
-            user_url = f"{webhook_url}user.get.json"
-            user_params = urllib.parse.urlencode({'ID': modifier_id})
-            user_req = urllib.request.Request(f"{user_url}?{user_params}")
-            
-            with urllib.request.urlopen(user_req, timeout=5) as user_response:
-                user_data = json.loads(user_response.read().decode('utf-8'))
-                
-            if user_data.get('result') and len(user_data['result']) > 0:
-                user = user_data['result'][0]
-                modifier_name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip()
-                print(f"[INFO] Пользователь получен: {modifier_name}")
-        except Exception as e:
-            print(f"[WARN] Не удалось получить имя через API (ограничение прав вебхука): {e}")
-            # Формируем fallback из ID
-            if modifier_id:
-                modifier_name = f"Пользователь #{modifier_id}"
-    
-    # Находим предыдущее состояние для отслеживания изменений
     conn = psycopg2.connect(os.environ['DATABASE_URL'])
     cur = conn.cursor(cursor_factory=RealDictCursor)
     
-    previous_stage = None
-    try:
-        cur.execute("""
-            SELECT deal_data->>'STAGE_ID' as stage_id 
-            FROM deal_changes 
-            WHERE deal_id = %s 
-            ORDER BY timestamp_received DESC 
-            LIMIT 1
-        """, (deal_id,))
-        
-        prev_row = cur.fetchone()
-        if prev_row:
-            previous_stage = prev_row['stage_id']
-    except Exception as e:
-        print(f"[WARN] Не удалось получить предыдущее состояние: {e}")
-    
-    current_stage = deal_full_data.get('STAGE_ID', '')
-    
-    # Формируем summary изменений
-    changes_summary = {}
-    if previous_stage and previous_stage != current_stage:
-        changes_summary['stage'] = {'from': previous_stage, 'to': current_stage}
-    
     try:
-        cur.execute("""
-            INSERT INTO deal_changes (
-                deal_id, event_type, deal_data, event_handler_id,
-                bitrix_domain, member_id, timestamp_bitrix,
-                modifier_user_id, modifier_user_name, 
-                previous_stage, current_stage, changes_summary
-            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
-            RETURNING id
-        """, (
-            deal_id,
-            event_type,
-            json.dumps(deal_full_data, ensure_ascii=False),
-            event_handler_id,
-            domain,
-            member_id,
-            int(ts) if ts else None,
-            modifier_id,
-            modifier_name,
-            previous_stage,
-            current_stage,
-            json.dumps(changes_summary, ensure_ascii=False) if changes_summary else None
-        ))
+        # Режим дебаунса: событие только помечает сделку «грязной», данные забирает deal_flusher
+        # одним crm.deal.list на пачку сделок после DEAL_DEBOUNCE_SECONDS тишины
+        if DEAL_DEBOUNCE_SECONDS > 0:
+            mark_deal_dirty(cur, deal_id, event_type, event_handler_id, domain, member_id, ts)
+            conn.commit()
+            return {
+                'statusCode': 200,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({
+                    'success': True,
+                    'message': 'Событие поставлено в очередь',
+                    'queued': True,
+                    'deal_id': deal_id,
+                    'event_type': event_type
+                }, ensure_ascii=False),
+                'isBase64Encoded': False
+            }
         
-        result = cur.fetchone()
-        log_id = result['id']
+        deal_full_data = fetch_deal(webhook_url, deal_id)
+        log_id = record_deal_change(cur, webhook_url, deal_id, deal_full_data, {
+            'event_type': event_type,
+            'event_handler_id': event_handler_id,
+            'domain': domain,
+            'member_id': member_id,
+            'ts': ts
+        })
         conn.commit()
         
-        print(f"[SUCCESS] Сохранено в БД с ID: {log_id}")
+        if log_id:
+            print(f"[SUCCESS] Сохранено в БД с ID: {log_id}")
         
         return {
             'statusCode': 200,
             'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
             'body': json.dumps({
                 'success': True,
-                'message': 'Данные сделки сохранены',
+                'message': 'Данные сделки сохранены' if log_id else 'Сделка не изменилась',
                 'log_id': log_id,
                 'deal_id': deal_id,
                 'event_type': event_type
@@ -237,4 +193,278 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        conn.close()
+
+def fetch_deal(webhook_url: str, deal_id: str) -> Dict[str, Any]:
+    '''Полные данные сделки через crm.deal.get; при ошибке - словарь с ключом error'''
+    # Используем входящий вебхук из секретов для REST API
+    if not webhook_url:
+        print(f"[ERROR] Секрет BITRIX24_WEBHOOK_URL не настроен!")
+        return {'error': 'BITRIX24_WEBHOOK_URL не настроен', 'deal_id': deal_id}
+    
+    rest_url = f"{webhook_url}crm.deal.get.json"
+    params = urllib.parse.urlencode({'ID': deal_id})
+    
+    try:
+        print(f"[INFO] Запрос к REST API: {rest_url}?{params[:100]}...")
+        
+        req = urllib.request.Request(f"{rest_url}?{params}")
+        with urllib.request.urlopen(req, timeout=10) as response:
+            rest_data = json.loads(response.read().decode('utf-8'))
+        
+        if not rest_data.get('result'):
+            print(f"[WARN] REST API не вернул данные сделки: {rest_data}")
+            return {'error': 'Нет данных от REST API', 'raw': rest_data}
+        
+        print(f"[INFO] Получены данные сделки: {json.dumps(rest_data['result'], ensure_ascii=False)[:200]}...")
+        return rest_data['result']
+        
+    except Exception as e:
+        print(f"[ERROR] Ошибка при запросе к REST API: {e}")
+        return {'error': str(e), 'deal_id': deal_id}
+
+def mark_deal_dirty(cur, deal_id: str, event_type: str, event_handler_id: str, domain: str, member_id: str, ts: str):
+    '''Пачка событий по сделке схлопывается в одну строку dirty_deals; ONCRMDEALADD не перетирается последующими UPDATE'''
+    cur.execute("""
+        INSERT INTO dirty_deals (deal_id, event_type, event_handler_id, bitrix_domain, member_id, timestamp_bitrix)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT (deal_id) DO UPDATE SET
+            event_type = CASE WHEN dirty_deals.event_type = 'ONCRMDEALADD' THEN dirty_deals.event_type ELSE EXCLUDED.event_type END,
+            event_handler_id = EXCLUDED.event_handler_id,
+            timestamp_bitrix = GREATEST(dirty_deals.timestamp_bitrix, EXCLUDED.timestamp_bitrix),
+            last_seen_at = now(),
+            events_count = dirty_deals.events_count + 1
+    """, (deal_id, event_type, event_handler_id, domain, member_id, int(ts) if ts else None))
+
+def record_deal_change(cur, webhook_url: str, deal_id: str, deal_full_data: Dict[str, Any], event_meta: Dict[str, Any]) -> Optional[int]:
+    '''
+    Пишет запись deal_changes (diff или снимок) и обновляет deal_current_state в текущей транзакции.
+    Возвращает id записи или None, если сделка не изменилась с прошлого состояния
+    '''
+    event_type = event_meta.get('event_type', '')
+    ts = event_meta.get('ts')
+    # Порядок истории - (event_ts, id): время события в Битрикс24, а не время доставки вебхука
+    event_ts = int(ts) if ts else int(time.time())
+    
+    # Получаем данные пользователя из deal_data или из локального справочника bitrix_users
+    modifier_id = str(deal_full_data.get('MODIFY_BY_ID', '') or '')
+    modifier_name = deal_full_data.get('MODIFY_BY_NAME', '')  # Иногда Битрикс возвращает имя
+    
+    if modifier_id and not modifier_name:
+        modifier_name = resolve_user_name(cur, webhook_url, modifier_id)
+    
+    # Последнее состояние - одна строка deal_current_state по первичному ключу вместо сортировки истории.
+    # FOR UPDATE выстраивает параллельные события по одной сделке в очередь до commit
+    previous_stage = None
+    previous_data = None
+    events_since_snapshot = 0
+    cur.execute("""
+        SELECT current_stage, deal_data, events_since_snapshot, event_ts
+        FROM deal_current_state
+        WHERE deal_id = %s
+        FOR UPDATE
+    """, (deal_id,))
+    
+    prev_row = cur.fetchone()
+    
+    # Событие старше уже записанного (повтор доставки, параллельная отправка): событие несёт только ID, а данные
+    # получены сейчас - это новейшее состояние. Вставка в прошлое исказила бы историю, поэтому запись идёт в голову,
+    # сдвигается только ключ порядка; timestamp_bitrix сохраняет исходное время события.
+    # Если данные совпадают с текущим состоянием, запись пропускается ниже как не несущая изменений
+    if prev_row and prev_row['event_ts'] is not None and event_ts < prev_row['event_ts']:
+        print(f"[INFO] Опоздавшее событие по сделке {deal_id} (ts={event_ts}), записывается после ts={prev_row['event_ts']}")
+        event_ts = prev_row['event_ts']
+    
+    if prev_row:
+        previous_stage = prev_row['current_stage']
+        previous_data = prev_row['deal_data']
+        events_since_snapshot = prev_row['events_since_snapshot']
+    
+    current_stage = deal_full_data.get('STAGE_ID', '')
+    
+    # Переход стадии и diff полей относительно предыдущего состояния;
+    # полный снимок - только когда он нужен для восстановления версий
+    is_snapshot = 'error' not in deal_full_data
+    stored_deal_data = deal_full_data
+    changes_summary = build_changes_summary(
+        previous_data if 'error' not in deal_full_data else None, previous_stage, deal_full_data
+    )
+    if 'error' not in deal_full_data and previous_data:
+        # Повторные события одного сохранения в Битрикс24 дают идентичные данные - запись не нужна
+        if not changes_summary:
+            print(f"[INFO] Сделка {deal_id} не изменилась, запись пропущена")
+            return None
+        
+        is_snapshot = 'stage' in changes_summary or events_since_snapshot + 1 >= DEAL_SNAPSHOT_EVERY
+        if not is_snapshot:
+            stored_deal_data = {key: deal_full_data[key] for key in DEAL_KEY_FIELDS if key in deal_full_data}
+    
+    cur.execute("""
+        INSERT INTO deal_changes (
+            deal_id, event_type, deal_data, event_handler_id,
+            bitrix_domain, member_id, timestamp_bitrix, event_ts,
+            modifier_user_id, modifier_user_name, 
+            previous_stage, current_stage, changes_summary, is_snapshot
+        ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+        RETURNING id
+    """, (
+        deal_id,
+        event_type,
+        json.dumps(stored_deal_data, ensure_ascii=False),
+        event_meta.get('event_handler_id', ''),
+        event_meta.get('domain', ''),
+        event_meta.get('member_id', ''),
+        int(ts) if ts else None,
+        event_ts,
+        modifier_id,
+        modifier_name,
+        previous_stage,
+        current_stage,
+        json.dumps(changes_summary, ensure_ascii=False) if changes_summary else None,
+        is_snapshot
+    ))
+    
+    log_id = cur.fetchone()['id']
+    
+    # Текущее состояние обновляем в той же транзакции; ответы REST с ошибкой его не затирают
+    if 'error' not in deal_full_data:
+        cur.execute("""
+            INSERT INTO deal_current_state (
+                deal_id, last_change_id, deal_data, current_stage, event_type,
+                modifier_user_id, modifier_user_name, timestamp_bitrix, event_ts, events_since_snapshot, updated_at
+            ) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 0, now())
+            ON CONFLICT (deal_id) DO UPDATE SET
+                last_change_id = EXCLUDED.last_change_id,
+                deal_data = EXCLUDED.deal_data,
+                current_stage = EXCLUDED.current_stage,
+                event_type = EXCLUDED.event_type,
+                modifier_user_id = EXCLUDED.modifier_user_id,
+                modifier_user_name = EXCLUDED.modifier_user_name,
+                timestamp_bitrix = EXCLUDED.timestamp_bitrix,
+                event_ts = EXCLUDED.event_ts,
+                events_since_snapshot = CASE WHEN %s THEN 0 ELSE deal_current_state.events_since_snapshot + 1 END,
+                updated_at = EXCLUDED.updated_at
+        """, (
+            deal_id,
+            log_id,
+            json.dumps(deal_full_data, ensure_ascii=False),
+            current_stage,
+            event_type,
+            modifier_id,
+            modifier_name,
+            int(ts) if ts else None,
+            event_ts,
+            is_snapshot
+        ))
+    
+    return log_id
+
+def build_changes_summary(previous_data: Optional[Dict[str, Any]], previous_stage: Optional[str], current_data: Dict[str, Any]) -> Dict[str, Any]:
+    changes_summary = {}
+    current_stage = current_data.get('STAGE_ID', '')
+    if previous_stage and previous_stage != current_stage:
+        changes_summary['stage'] = {'from': previous_stage, 'to': current_stage}
+    if previous_data:
+        field_changes, removed_fields = diff_deal_fields(previous_data, current_data)
+        if field_changes:
+            changes_summary['fields'] = field_changes
+        if removed_fields:
+            changes_summary['removed'] = removed_fields
+    return changes_summary
+
+def diff_deal_fields(previous: Dict[str, Any], current: Dict[str, Any]) -> Tuple[Dict[str, Dict[str, Any]], list]:
+    '''Изменённые поля сделки {поле: {from, to}} и список полей, пропавших из ответа REST'''
+    changes = {}
+    for key, value in current.items():
+        if previous.get(key) != value or key not in previous:
+            changes[key] = {'from': previous.get(key), 'to': value}
+    removed = sorted(key for key in previous if key not in current)
+    return changes, removed
+
+def resolve_user_name(cur, webhook_url: str, user_id: str) -> str:
+    '''
+    Имя пользователя для записи изменения: LRU в памяти, затем bitrix_users (свежее USER_TTL_SECONDS),
+    и только при промахе или устаревшей записи - user.get с сохранением в справочник.
+    Неудачный user.get (у вебхука обычно нет прав) запоминается на USER_NEGATIVE_TTL_SECONDS - в памяти и
+    в bitrix_users.lookup_failed_at, чтобы события по этому пользователю не ходили в REST каждый раз
+    '''
+    cached = _user_name_cache.get(user_id)
+    if cached and cached[1] > time.monotonic():
+        _user_name_cache.move_to_end(user_id)
+        return cached[0]
+    
+    placeholder = f"Пользователь #{user_id}"
+    stale_name = None
+    # Точка сохранения: сбой чтения справочника не должен откатывать остальную транзакцию (например, сброс dirty_deals)
+    cur.execute("SAVEPOINT user_lookup")
+    try:
+        cur.execute(
+            """SELECT full_name,
+                      fetched_at > now() - make_interval(secs => %s) AS fresh,
+                      lookup_failed_at > now() - make_interval(secs => %s) AS recently_failed
+               FROM bitrix_users WHERE user_id = %s""",
+            (USER_TTL_SECONDS, USER_NEGATIVE_TTL_SECONDS, user_id)
+        )
+        row = cur.fetchone()
+        if row:
+            if row['full_name'] and row['fresh']:
+                remember_user_name(user_id, row['full_name'])
+                return row['full_name']
+            stale_name = row['full_name'] or None
+            if row['recently_failed']:
+                remember_user_name(user_id, stale_name or placeholder, USER_NEGATIVE_TTL_SECONDS)
+                return stale_name or placeholder
+    except Exception as e:
+        print(f"[WARN] Не удалось прочитать справочник пользователей: {e}")
+        cur.execute("ROLLBACK TO SAVEPOINT user_lookup")
+    
+    user = fetch_bitrix_user(webhook_url, user_id) if webhook_url else None
+    full_name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip() if user else ''
+    if full_name:
+        cur.execute(
+            """INSERT INTO bitrix_users (user_id, name, last_name, full_name, active, fetched_at)
+               VALUES (%s, %s, %s, %s, %s, now())
+               ON CONFLICT (user_id) DO UPDATE SET
+                   name = EXCLUDED.name, last_name = EXCLUDED.last_name, full_name = EXCLUDED.full_name,
+                   active = EXCLUDED.active, fetched_at = EXCLUDED.fetched_at, lookup_failed_at = NULL""",
+            (user_id, user.get('NAME', ''), user.get('LAST_NAME', ''), full_name, user.get('ACTIVE', True) in (True, 'Y'))
+        )
+        remember_user_name(user_id, full_name)
+        print(f"[INFO] Пользователь получен: {full_name}")
+        return full_name
+    
+    # Неудача: имя (устаревшее, если есть - пользователи почти не переименовываются) кэшируется на короткий срок.
+    # Заглушку отличает пустое full_name и lookup_failed_at, fetched_at у неё обычный
+    try:
+        cur.execute(
+            """INSERT INTO bitrix_users (user_id, full_name, fetched_at, lookup_failed_at)
+               VALUES (%s, '', now(), now())
+               ON CONFLICT (user_id) DO UPDATE SET lookup_failed_at = EXCLUDED.lookup_failed_at""",
+            (user_id,)
+        )
+    except Exception as e:
+        print(f"[WARN] Не удалось отметить неудачный запрос пользователя {user_id}: {e}")
+        cur.execute("ROLLBACK TO SAVEPOINT user_lookup")
+    remember_user_name(user_id, stale_name or placeholder, USER_NEGATIVE_TTL_SECONDS)
+    return stale_name or placeholder
+
+def remember_user_name(user_id: str, full_name: str, ttl_seconds: float = USER_TTL_SECONDS):
+    _user_name_cache[user_id] = (full_name, time.monotonic() + ttl_seconds)
+    _user_name_cache.move_to_end(user_id)
+    while len(_user_name_cache) > USER_CACHE_SIZE:
+        _user_name_cache.popitem(last=False)
+
+def fetch_bitrix_user(webhook_url: str, user_id: str) -> Optional[Dict[str, Any]]:
+    try:
+        user_params = urllib.parse.urlencode({'ID': user_id})
+        user_req = urllib.request.Request(f"{webhook_url}user.get.json?{user_params}")
+        
+        with urllib.request.urlopen(user_req, timeout=5) as user_response:
+            user_data = json.loads(user_response.read().decode('utf-8'))
+        
+        if user_data.get('result') and len(user_data['result']) > 0:
+            return user_data['result'][0]
+    except Exception as e:
+        print(f"[WARN] Не удалось получить имя через API (ограничение прав вебхука): {e}")
+    
+    return None
@@ -0,0 +1,106 @@
+"""
+Business: Разбор тела исходящих вебхуков Битрикс24 (application/x-www-form-urlencoded) во вложенный dict
+Args: body - строка тела запроса, is_base64 - флаг isBase64Encoded из события
+Returns: dict вида {'event': ..., 'auth': {...}, 'data': {'FIELDS': {...}}} с любой глубиной вложенности
+"""
+import base64
+import binascii
+from functools import lru_cache
+from typing import Dict, Any, List, Tuple, Union
+from urllib.parse import unquote_plus
+
+# Общий модуль ингест-функций: копия лежит в каждой функции, которая принимает события Битрикс24
+
+# Набор ключей у событий одного типа почти не меняется - разобранные пути ключей кэшируются на экземпляр функции
+KEY_PATH_CACHE_SIZE = 4096
+
+def decode_event_body(body: Union[str, bytes], is_base64: bool = False) -> str:
+    '''Снимает base64 (если тело пришло закодированным) и возвращает строку; при ошибке декодирования - тело как есть'''
+    if not body:
+        return ''
+    if is_base64:
+        try:
+            body = base64.b64decode(body)
+        except (binascii.Error, ValueError) as e:
+            print(f"[ERROR] Failed to decode base64: {e}")
+    if isinstance(body, bytes):
+        return body.decode('utf-8', errors='replace')
+    return body
+
+def parse_form_body(body: Union[str, bytes], is_base64: bool = False) -> Dict[str, Any]:
+    '''
+    Однопроходный разбор urlencoded-тела: каждая пара key=value раскладывается по пути скобок
+    (data[FIELDS][PRODUCT_ROWS][0][ID] -> data -> FIELDS -> PRODUCT_ROWS -> '0' -> ID).
+    Повторяющийся ключ превращается в список, key[] дописывает значение в список
+    '''
+    body_str = decode_event_body(body, is_base64)
+    result: Dict[str, Any] = {}
+    if not body_str:
+        return result
+
+    for pair in body_str.split('&'):
+        if not pair:
+            continue
+        raw_key, _, value = pair.partition('=')
+        if not raw_key:
+            continue
+        # unquote_plus дорогой - вызываем только если в значении есть что раскодировать
+        if '%' in value or '+' in value:
+            value = unquote_plus(value)
+        assign_path(result, key_path(raw_key), value)
+
+    return result
+
+@lru_cache(maxsize=KEY_PATH_CACHE_SIZE)
+def key_path(raw_key: str) -> Tuple[str, ...]:
+    '''Раскодированный ключ, разбитый по скобкам: auth%5Bdomain%5D -> ('auth', 'domain')'''
+    key = raw_key
+    if '%' in key:
+        # Битрикс24 кодирует в ключах только скобки - полный unquote_plus нужен лишь для прочих символов
+        key = key.replace('%5B', '[').replace('%5D', ']')
+    if '%' in key or '+' in key:
+        key = unquote_plus(key)
+    return tuple(split_key(key))
+
+def split_key(key: str) -> List[str]:
+    '''auth[domain] -> ['auth', 'domain']; ключ без скобок или с незакрытой скобкой остаётся одним сегментом'''
+    bracket = key.find('[')
+    if bracket <= 0 or not key.endswith(']'):
+        return [key]
+    path = [key[:bracket]]
+    path.extend(key[bracket + 1:-1].split(']['))
+    return path
+
+def assign_path(target: Dict[str, Any], path: Tuple[str, ...], value: str):
+    node = target
+    last = len(path) - 1
+    for index, segment in enumerate(path):
+        if isinstance(node, list) and segment != '':
+            # a[]=1&a[x]=2 - индекс поверх списка не поддерживается, пара пропускается
+            return
+        if index == last:
+            if segment == '' and isinstance(node, list):
+                node.append(value)
+            elif segment in node:
+                existing = node[segment]
+                if isinstance(existing, list):
+                    existing.append(value)
+                elif isinstance(existing, str):
+                    node[segment] = [existing, value]
+                # значение поверх уже вложенного dict отбрасываем, как и PHP-парсер Битрикс24
+            else:
+                node[segment] = value
+            return
+
+        next_is_list = path[index + 1] == ''
+        if segment == '' and isinstance(node, list):
+            child: Union[Dict[str, Any], List[Any]] = [] if next_is_list else {}
+            node.append(child)
+            node = child
+            continue
+
+        child = node.get(segment)
+        if not isinstance(child, (dict, list)):
+            child = [] if next_is_list else {}
+            node[segment] = child
+        node = child
@@ -1,6 +1,4 @@
 import json
-import urllib.parse
-import base64
 from typing import Dict, Any
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
@@ -40,33 +38,9 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         content_type = headers.get('Content-Type', headers.get('content-type', ''))
         
         if 'application/x-www-form-urlencoded' in content_type:
-            # Декодируем urlencoded данные
-            # Если данные в base64, декодируем
-            if event.get('isBase64Encoded', False):
-                body_str = base64.b64decode(body_str).decode('utf-8')
-            
-            # Парсим urlencoded строку
-            parsed = urllib.parse.parse_qs(body_str)
-            body_data = {k: v[0] if len(v) == 1 else v for k, v in parsed.items()}
-            
-            # Парсим вложенные структуры auth и data
-            if 'auth[domain]' in body_data:
-                auth = {}
-                data_fields = {}
-                for key, value in list(body_data.items()):
-                    if key.startswith('auth['):
-                        auth_key = key.replace('auth[', '').replace(']', '')
-                        auth[auth_key] = value
-                        del body_data[key]
-                    elif key.startswith('data[FIELDS]['):
-                        field_key = key.replace('data[FIELDS][', '').replace(']', '')
-                        data_fields[field_key] = value
-                        del body_data[key]
-                
-                if auth:
-                    body_data['auth'] = auth
-                if data_fields:
-                    body_data['data'] = {'FIELDS': data_fields}
+            # Декодируем urlencoded данные (base64 снимается внутри) во вложенные auth / data[FIELDS]
+            from bitrix_form import parse_form_body
+            body_data = parse_form_body(body_str, event.get('isBase64Encoded', False))
         else:
             # Пытаемся как JSON
             try:
@@ -0,0 +1,179 @@
+"""
+Business: Разбирает очередь company_check_jobs - асинхронные проверки компаний на дубликаты ИНН
+Args: CLI - python check_worker.py [--concurrency N] [--max-seconds N]
+      HTTP - POST {"action": "process_jobs", "concurrency": 4, "max_seconds": 25} в bitrix-webhook
+Returns: статистику прогона (выполнено, отложено на повтор, переведено в dead)
+"""
+import argparse
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, Optional
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+from index import process_company_check
+
+WORKER_CONCURRENCY = int(os.environ.get('CHECK_WORKER_CONCURRENCY', '4'))
+# Каждый воркер держит своё соединение с БД - число воркеров за вызов ограничено
+WORKER_MAX_CONCURRENCY = 16
+JOB_MAX_ATTEMPTS = int(os.environ.get('CHECK_JOB_MAX_ATTEMPTS', '5'))
+JOB_BACKOFF_SECONDS = int(os.environ.get('CHECK_JOB_BACKOFF_SECONDS', '30'))
+JOB_BACKOFF_MAX_SECONDS = 3600
+PG_UNIQUE_VIOLATION = '23505'
+# Задание в статусе running дольше этого времени считается брошенным (воркер упал) и забирается снова
+JOB_LOCK_TTL_SECONDS = 300
+
+def drain_company_check_jobs(max_seconds: float = 25, concurrency: int = WORKER_CONCURRENCY) -> Dict[str, Any]:
+    '''
+    Запускает concurrency воркеров, каждый со своим соединением; задания разбираются через
+    FOR UPDATE SKIP LOCKED, поэтому воркеры (и параллельные вызовы функции) не мешают друг другу
+    '''
+    started = time.monotonic()
+    workers = min(max(1, concurrency), WORKER_MAX_CONCURRENCY)
+    
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        worker_stats = list(pool.map(lambda _: run_worker(started, max_seconds), range(workers)))
+    
+    stats = {
+        'success': True,
+        'workers': workers,
+        'done': sum(w['done'] for w in worker_stats),
+        'retried': sum(w['retried'] for w in worker_stats),
+        'dead': sum(w['dead'] for w in worker_stats),
+        'elapsed_seconds': round(time.monotonic() - started, 2)
+    }
+    stats['processed'] = stats['done'] + stats['retried'] + stats['dead']
+    print(f"[INFO] Check jobs drained: {stats}")
+    return stats
+
+def run_worker(started: float, max_seconds: float) -> Dict[str, int]:
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+    counts = {'done': 0, 'retried': 0, 'dead': 0}
+    
+    try:
+        while time.monotonic() - started < max_seconds:
+            job = claim_job(cur, conn)
+            if not job:
+                break
+            counts[run_job(cur, conn, job)] += 1
+    finally:
+        cur.close()
+        conn.close()
+    
+    return counts
+
+def claim_job(cur, conn) -> Optional[Dict[str, Any]]:
+    '''Забирает одно готовое к выполнению задание и сразу фиксирует статус running'''
+    cur.execute(
+        """UPDATE company_check_jobs
+           SET status = 'running', attempts = attempts + 1, locked_at = now()
+           WHERE id = (
+               SELECT id FROM company_check_jobs
+               WHERE (status = 'pending' AND run_after <= now())
+                  OR (status = 'running' AND locked_at < now() - make_interval(secs => %s))
+               ORDER BY run_after, id
+               LIMIT 1
+               FOR UPDATE SKIP LOCKED
+           )
+           RETURNING *""",
+        (JOB_LOCK_TTL_SECONDS,)
+    )
+    job = cur.fetchone()
+    conn.commit()
+    return job
+
+def run_job(cur, conn, job: Dict[str, Any]) -> str:
+    '''
+    Выполняет проверку; ошибки Битрикс24 откладываются с экспоненциальной задержкой, после JOB_MAX_ATTEMPTS - dead.
+    Время события - created_at задания: проверка схлопывается, только если компанию забрали уже после постановки в очередь
+    '''
+    status_code = None
+    result: Dict[str, Any] = {}
+    try:
+        status_code, result = process_company_check(
+            cur, conn, job['bitrix_id'], job['request_body'] or {},
+            job['source_info'] or '', job['request_method'] or 'POST',
+            event_at=job['created_at']
+        )
+        # 404 - компания удалена в Битрикс24, повтор ничего не изменит
+        error = None if status_code < 400 or status_code == 404 else result.get('error', f'HTTP {status_code}')
+    except Exception as e:
+        conn.rollback()
+        error = str(e)
+    
+    if result.get('reason') == 'in_flight':
+        # Компанию сейчас проверяет другой вызов - это не ошибка, попытка не засчитывается
+        backoff = min(JOB_BACKOFF_SECONDS * 2 ** (job['attempts'] - 1), JOB_BACKOFF_MAX_SECONDS)
+        print(f"[DEBUG] Check job {job['id']} for company {job['bitrix_id']} is in flight elsewhere, retry in {backoff}s")
+        return requeue_job(cur, conn, job, status_code, error, backoff, count_attempt=False)
+    
+    if error is None:
+        cur.execute(
+            """UPDATE company_check_jobs
+               SET status = 'done', last_status = %s, last_error = NULL, finished_at = now()
+               WHERE id = %s""",
+            (status_code, job['id'])
+        )
+        conn.commit()
+        return 'done'
+    
+    if job['attempts'] >= JOB_MAX_ATTEMPTS:
+        print(f"[ERROR] Check job {job['id']} for company {job['bitrix_id']} is dead after {job['attempts']} attempts: {error}")
+        cur.execute(
+            """UPDATE company_check_jobs
+               SET status = 'dead', last_status = %s, last_error = %s, finished_at = now()
+               WHERE id = %s""",
+            (status_code, error, job['id'])
+        )
+        conn.commit()
+        return 'dead'
+    
+    backoff = min(JOB_BACKOFF_SECONDS * 2 ** (job['attempts'] - 1), JOB_BACKOFF_MAX_SECONDS)
+    print(f"[DEBUG] Check job {job['id']} attempt {job['attempts']} failed, retry in {backoff}s: {error}")
+    return requeue_job(cur, conn, job, status_code, error, backoff)
+
+def requeue_job(cur, conn, job: Dict[str, Any], status_code: Optional[int], error: Optional[str],
+                backoff: float, count_attempt: bool = True) -> str:
+    '''
+    Возвращает задание в pending с задержкой. Если по компании уже стоит более новое pending-задание
+    (уникальный индекс V0029), оно покрывает это событие - текущее задание закрывается как done
+    '''
+    try:
+        cur.execute(
+            """UPDATE company_check_jobs
+               SET status = 'pending', attempts = attempts - %s, last_status = %s, last_error = %s, locked_at = NULL,
+                   run_after = now() + make_interval(secs => %s)
+               WHERE id = %s""",
+            (0 if count_attempt else 1, status_code, error, backoff, job['id'])
+        )
+        conn.commit()
+        return 'retried'
+    except psycopg2.Error as e:
+        if e.pgcode != PG_UNIQUE_VIOLATION:
+            raise
+        conn.rollback()
+    
+    print(f"[DEBUG] Check job {job['id']} superseded by a newer pending job for company {job['bitrix_id']}")
+    cur.execute(
+        """UPDATE company_check_jobs
+           SET status = 'done', last_status = %s, last_error = 'superseded by newer pending job', finished_at = now()
+           WHERE id = %s""",
+        (status_code, job['id'])
+    )
+    conn.commit()
+    return 'done'
+
+def main():
+    parser = argparse.ArgumentParser(description='Разбор очереди асинхронных проверок компаний')
+    parser.add_argument('--concurrency', type=int, default=WORKER_CONCURRENCY, help='число параллельных воркеров')
+    parser.add_argument('--max-seconds', type=float, default=25, help='ограничение времени прогона')
+    args = parser.parse_args()
+    
+    stats = drain_company_check_jobs(max_seconds=args.max_seconds, concurrency=args.concurrency)
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
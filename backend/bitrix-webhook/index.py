@@ -1,11 +1,61 @@
 import json
 import os
-from typing import Dict, Any, List, Optional
+import time
+import base64
+import zlib
+import hashlib
+import threading
+from typing import Dict, Any, List, Optional, Tuple
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
 import psycopg2
 from psycopg2.extras import RealDictCursor
 import urllib.request
 import urllib.parse
+import urllib.error
+
+VERIFY_IDS_CHUNK_SIZE = 500
+BATCH_MAX_COMMANDS = 50
+DELETE_WORKERS = int(os.environ.get('BITRIX24_DELETE_WORKERS', '4'))
+LOGS_PAGE_SIZE = 100
+LOGS_MAX_PAGE_SIZE = 500
+
+# Колонки для списка логов - без тяжёлого request_body (он отдаётся только в детальном запросе)
+LOG_LIST_COLUMNS = 'id, webhook_type, inn, bitrix_company_id, response_status, duplicate_found, action_taken, created_at, source_info, request_method'
+
+# Срок хранения помесячных секций журнала и запас заранее созданных секций
+LOG_RETENTION_MONTHS = int(os.environ.get('LOG_RETENTION_MONTHS', '6'))
+LOG_PARTITIONS_AHEAD_MONTHS = 2
+
+# Схлопывание штормов событий по одной компании: advisory-блокировка на bitrix_id и окно дебаунса
+COMPANY_LOCK_NAMESPACE = 1001
+COMPANY_LOCK_TIMEOUT_MS = int(os.environ.get('COMPANY_LOCK_TIMEOUT_MS', '20000'))
+WEBHOOK_DEBOUNCE_SECONDS = float(os.environ.get('WEBHOOK_DEBOUNCE_SECONDS', '0'))
+PG_LOCK_NOT_AVAILABLE = '55P03'
+
+# Длительные действия (синхронизация реквизитов, очередь проверок) укладываются в таймаут функции
+ACTION_MAX_SECONDS = 25
+
+# Восстановление компании из бэкапа: сессионная advisory-блокировка на исходный ID компании
+RESTORE_LOCK_NAMESPACE = 1002
+
+# Реестр задач «заполнить ИНН»: открытая задача сверяется с Битрикс24 не чаще раза в INN_TASK_RECHECK_SECONDS
+# Статусы задач Битрикс24: 5 - завершена, 7 - отклонена
+INN_TASK_RECHECK_SECONDS = int(os.environ.get('INN_TASK_RECHECK_SECONDS', '3600'))
+TASK_CLOSED_STATUSES = {5, 7}
+
+# Кэш вердикта проверки по хэшу реквизитов; кэшируются только «не дубликат» - дубликат всё равно удаляется
+CHECK_CACHE_TTL_SECONDS = int(os.environ.get('CHECK_CACHE_TTL_SECONDS', '86400'))
+CACHEABLE_CHECK_STATUSES = ('success', 'duplicate_but_old_missing')
+
+# Режим обработки вебхуков проверки: sync - проверка до ответа, async - через очередь company_check_jobs
+WEBHOOK_MODE = os.environ.get('WEBHOOK_MODE', 'sync')
+
+# Лимит REST API портала: "дырявое ведро" на 50 запросов, пополняется BITRIX24_RATE_LIMIT запросами в секунду
+BITRIX_RATE_LIMIT = float(os.environ.get('BITRIX24_RATE_LIMIT', '2'))
+BITRIX_RATE_BURST = 50
+_bitrix_rate_state = {'tokens': float(BITRIX_RATE_BURST), 'updated': time.monotonic()}
+_bitrix_rate_lock = threading.Lock()
 
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
@@ -52,8 +102,24 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         source_info = f"IP: {source_ip} | UA: {user_agent[:100]}"
         
         if method == 'DELETE':
-            cur.execute("DELETE FROM webhook_logs")
-            deleted_count = cur.rowcount
+            query_params = event.get('queryStringParameters', {}) or {}
+            
+            # Плановая очистка: отключаем и удаляем целые месячные секции старше срока хранения
+            if query_params.get('action') == 'apply_retention':
+                keep_months_param = str(query_params.get('keep_months') or LOG_RETENTION_MONTHS)
+                if not keep_months_param.isdigit() or int(keep_months_param) < 1:
+                    return response_json(400, {'success': False, 'error': 'keep_months должен быть целым числом не меньше 1'})
+                retention = apply_log_retention(cur, 'webhook_logs', int(keep_months_param))
+                conn.commit()
+                return response_json(200, {'success': True, **retention})
+            
+            cur.execute("SELECT COUNT(*) AS cnt FROM webhook_logs")
+            deleted_count = cur.fetchone()['cnt']
+            # TRUNCATE по секционированной таблице очищает все секции без построчного удаления
+            cur.execute("TRUNCATE webhook_logs")
+            cur.execute("TRUNCATE webhook_log_stats_daily")
+            # Без записей журнала бэкапы недостижимы (ссылка company_backup_ref ведёт на log_id)
+            cur.execute("TRUNCATE company_backups")
             conn.commit()
             return response_json(200, {
                 'success': True,
@@ -98,40 +164,112 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     })
             
             if action == 'restore':
+                # Бэкап берём из company_backups по id лога; original_data - для старых логов и ручного вызова
                 original_data = body_data.get('original_data', {})
-                print(f"[DEBUG] Restoring company with data: {original_data}")
-                restore_result = restore_deleted_company(original_data)
+                if body_data.get('log_id'):
+                    log_id = str(body_data['log_id']).strip()
+                    if not log_id.isdigit():
+                        return response_json(400, {'success': False, 'error': 'log_id должен быть целым положительным числом'})
+                    original_data = load_company_backup(cur, int(log_id))
+                    if not original_data:
+                        return response_json(404, {'success': False, 'error': 'Данные для восстановления не найдены'})
+                
+                print(f"[DEBUG] Restoring company {original_data.get('ID')} with {len(original_data)} fields")
+                restore_result = restore_deleted_company(original_data, cur, conn)
                 print(f"[DEBUG] Restore result: {restore_result}")
+                restored_inn = (original_data.get('RQ_INN') or original_data.get('inn') or '').strip()
                 
                 if restore_result.get('success'):
-                    log_webhook(cur, 'restore_company', original_data.get('inn', ''), restore_result.get('company_id', ''), body_data, 'success', False, f"Company restored: {restore_result.get('company_id')}", source_info, method)
+                    if restored_inn:
+                        upsert_local_company(cur, restore_result.get('company_id', ''), restored_inn, original_data.get('TITLE', ''))
+                    log_webhook(cur, 'restore_company', restored_inn, restore_result.get('company_id', ''), body_data, 'success', False, f"Company restored: {restore_result.get('company_id')}", source_info, method)
                     conn.commit()
                     return response_json(200, {
                         'success': True,
                         'message': 'Company restored successfully',
                         'company_id': restore_result.get('company_id')
                     })
+                elif restore_result.get('in_progress'):
+                    return response_json(409, {
+                        'success': False,
+                        'in_progress': True,
+                        'error': restore_result.get('error')
+                    })
                 else:
-                    log_webhook(cur, 'restore_company', original_data.get('inn', ''), '', body_data, 'error', False, f"Failed to restore: {restore_result.get('error')}", source_info, method)
+                    log_webhook(cur, 'restore_company', restored_inn, '', body_data, 'error', False, f"Failed to restore: {restore_result.get('error')}", source_info, method)
                     conn.commit()
                     return response_json(400, {
                         'success': False,
                         'error': restore_result.get('error')
                     })
             
+            # Полная/инкрементальная синхронизация реквизитов компаний в локальный индекс companies
+            if action == 'sync_requisites':
+                from requisites_sync import sync_company_requisites
+                
+                max_seconds = parse_max_seconds(body_data.get('max_seconds', ACTION_MAX_SECONDS))
+                if max_seconds is None:
+                    return response_json(400, {'success': False, 'error': f'max_seconds должен быть числом больше 0 (не больше {ACTION_MAX_SECONDS})'})
+                
+                sync_stats = sync_company_requisites(
+                    conn,
+                    max_seconds=max_seconds,
+                    reset=bool(body_data.get('reset', False))
+                )
+                log_webhook(cur, 'sync_requisites', '', '', body_data, 'success' if sync_stats.get('success') else 'error', False,
+                            f"Synced {sync_stats.get('rows', 0)} requisites ({sync_stats.get('rows_per_second', 0)} rows/s), watermark {sync_stats.get('watermark')}", source_info, method)
+                conn.commit()
+                
+                return response_json(200 if sync_stats.get('success') else 500, sync_stats)
+            
+            # Разбор очереди асинхронных проверок компаний
+            if action == 'process_jobs':
+                from check_worker import drain_company_check_jobs, WORKER_CONCURRENCY, WORKER_MAX_CONCURRENCY
+                
+                max_seconds = parse_max_seconds(body_data.get('max_seconds', ACTION_MAX_SECONDS))
+                if max_seconds is None:
+                    return response_json(400, {'success': False, 'error': f'max_seconds должен быть числом больше 0 (не больше {ACTION_MAX_SECONDS})'})
+                
+                concurrency_param = str(body_data.get('concurrency', WORKER_CONCURRENCY)).strip()
+                if not concurrency_param.isdigit() or int(concurrency_param) < 1:
+                    return response_json(400, {'success': False, 'error': 'concurrency должен быть целым числом не меньше 1'})
+                
+                jobs_stats = drain_company_check_jobs(
+                    max_seconds=max_seconds,
+                    concurrency=min(int(concurrency_param), WORKER_MAX_CONCURRENCY)
+                )
+                return response_json(200, jobs_stats)
+            
+            # Сверка открытых задач «заполнить ИНН» с Битрикс24 одним batch-запросом
+            if action == 'refresh_inn_tasks':
+                refresh_result = refresh_pending_inn_tasks(cur)
+                conn.commit()
+                return response_json(200 if refresh_result.get('success') else 500, refresh_result)
+            
             # Проверяем, если это запрос на очистку мусорных реквизитов
             if action == 'clean_orphans':
                 inn_to_clean = body_data.get('inn', '').strip()
                 if not inn_to_clean:
                     return response_json(400, {'success': False, 'error': 'ИНН не указан'})
                 
-                clean_result = clean_orphaned_requisites(inn_to_clean)
-                log_webhook(cur, 'clean_orphans', inn_to_clean, '', body_data, 'success', False, f"Cleaned {clean_result.get('cleaned_count', 0)} orphaned requisites", source_info, method)
+                dry_run = bool(body_data.get('dry_run', False))
+                clean_result = clean_orphaned_requisites(inn_to_clean, dry_run=dry_run)
+                
+                if dry_run:
+                    return response_json(200, {
+                        'success': clean_result.get('success', False),
+                        'dry_run': True,
+                        'orphans': clean_result.get('orphans', []),
+                        'message': f"Найдено {len(clean_result.get('orphans', []))} мусорных реквизитов (без удаления)"
+                    })
+                
+                log_webhook(cur, 'clean_orphans', inn_to_clean, '', body_data, 'success' if clean_result.get('success') else 'error', False, f"Cleaned {clean_result.get('cleaned_count', 0)} orphaned requisites", source_info, method)
                 conn.commit()
                 
                 return response_json(200, {
                     'success': True,
                     'cleaned_count': clean_result.get('cleaned_count', 0),
+                    'failed': clean_result.get('failed', []),
                     'message': f"Удалено {clean_result.get('cleaned_count', 0)} мусорных реквизитов"
                 })
             
@@ -144,6 +282,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     return response_json(400, {'success': False, 'error': 'Не указаны ID компаний для удаления'})
                 
                 delete_result = delete_multiple_companies(company_ids)
+                remove_local_companies(cur, delete_result.get('details', {}).get('deleted', []))
                 log_webhook(cur, 'delete_companies', inn_for_log, ','.join(company_ids), body_data, 'success', False, f"Deleted {delete_result.get('deleted_count', 0)} companies", source_info, method)
                 conn.commit()
                 
@@ -171,28 +310,38 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                     'result': diagnostic_result
                 })
             
+            # Детальная запись лога (с request_body) по id
+            if action == 'log':
+                log_id = query_params.get('id', '').strip()
+                if not log_id.isdigit():
+                    return response_json(400, {'success': False, 'error': 'Не указан id записи'})
+                
+                cur.execute("SELECT * FROM webhook_logs WHERE id = %s", (int(log_id),))
+                log = cur.fetchone()
+                if not log:
+                    return response_json(404, {'success': False, 'error': 'Запись не найдена'})
+                
+                return response_json(200, {'success': True, 'log': serialize_log(log)})
+            
             bitrix_id: str = query_params.get('bitrix_id', query_params.get('id', '')).strip()
             body_data = {'bitrix_id': bitrix_id, 'method': 'GET'}
         else:
             return response_json(405, {'error': 'Method not allowed'})
         
         if not bitrix_id:
-            cur.execute("SELECT * FROM webhook_logs ORDER BY created_at DESC LIMIT 100")
-            logs = cur.fetchall()
+            list_params = query_params if method == 'GET' else {}
+            try:
+                logs, next_cursor = list_webhook_logs(cur, list_params)
+            except ValueError as e:
+                return response_json(400, {'success': False, 'error': str(e)})
             
-            cur.execute("""
-                SELECT 
-                    COALESCE(COUNT(*), 0) as total_requests,
-                    COALESCE(SUM(CASE WHEN duplicate_found = true THEN 1 ELSE 0 END), 0) as duplicates_found,
-                    COALESCE(SUM(CASE WHEN response_status = 'success' THEN 1 ELSE 0 END), 0) as successful
-                FROM webhook_logs
-            """)
-            stats_row = cur.fetchone()
-            stats = dict(stats_row) if stats_row else {'total_requests': 0, 'duplicates_found': 0, 'successful': 0}
+            stats, stats_windows = get_webhook_stats(cur)
             
             return response_json(200, {
                 'logs': [serialize_log(log) for log in logs] if logs else [],
-                'stats': stats
+                'next_cursor': next_cursor,
+                'stats': stats,
+                'stats_windows': stats_windows
             })
             
         # Проверка на тестовые/невалидные ID (999999 и подобные)
@@ -206,214 +355,616 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
                 'message': 'Test or invalid company ID'
             })
         
-        company_data = get_bitrix_company(bitrix_id)
-        
-        if not company_data.get('success'):
-            error_msg = f"Failed to get company data: {company_data.get('error')}"
-            
-            # Если компания не найдена (404/Not found) - это нормально, не логируем как ошибку
-            if 'Not found' in error_msg or 'HTTP 400' in error_msg:
-                print(f"[DEBUG] Company {bitrix_id} not found in Bitrix24 (deleted or test)")
-                return response_json(404, {
-                    'error': 'Company not found',
-                    'message': 'Company may have been deleted or does not exist'
-                })
-            
-            # Только реальные ошибки API логируем
-            log_webhook(cur, 'check_inn', '', bitrix_id, body_data, 'error', False, error_msg, source_info, method)
+        # Асинхронный режим: событие ставится в очередь company_check_jobs, Битрикс24 получает ответ сразу,
+        # а проверку выполняет check_worker (POST action=process_jobs)
+        mode = (event.get('queryStringParameters') or {}).get('mode') or body_data.get('mode') or WEBHOOK_MODE
+        if mode == 'async':
+            job_id = enqueue_company_check(cur, bitrix_id, body_data, source_info, method)
             conn.commit()
-            return response_json(400, {'error': error_msg})
-        
-        company_info = company_data.get('company', {})
-        inn: str = company_info.get('RQ_INN', '').strip()
-        title: str = company_info.get('TITLE', '')
+            return response_json(200, {
+                'queued': True,
+                'bitrix_id': bitrix_id,
+                'job_id': job_id,
+                'already_queued': job_id is None
+            })
         
-        if not inn:
-            action_msg = 'Company has no INN'
-            
-            # Создаём задачу и отправляем уведомление автору
-            task_result = create_task_for_missing_inn(bitrix_id, title, company_info)
-            if task_result.get('success'):
-                action_msg += f" | Task created: {task_result.get('task_id')}"
-            else:
-                action_msg += f" | Failed to create task: {task_result.get('error')}"
-            
-            log_webhook(cur, 'check_inn', '', bitrix_id, body_data, 'no_inn', False, action_msg, source_info, method)
+        status_code, result = process_company_check(cur, conn, bitrix_id, body_data, source_info, method)
+        if result.get('reason') == 'in_flight':
+            # Компания занята другим вызовом - событие не теряем, а переносим в очередь check_worker
+            job_id = enqueue_company_check(cur, bitrix_id, body_data, source_info, method)
             conn.commit()
-            return response_json(200, {
-                'duplicate': False, 
-                'message': 'Company has no INN, task created for responsible user',
-                'task_created': task_result.get('success', False),
-                'task_id': task_result.get('task_id')
+            return response_json(202, {
+                'queued': True,
+                'bitrix_id': bitrix_id,
+                'job_id': job_id,
+                'already_queued': job_id is None,
+                'reason': 'in_flight'
             })
+        return response_json(status_code, result)
+    
+    finally:
+        cur.close()
+        conn.close()
+    
+    return response_json(405, {'error': 'Method not allowed'})
+
+def process_company_check(cur, conn, bitrix_id: str, body_data: Dict[str, Any], source_info: str, method: str,
+                          event_at: Optional[datetime] = None) -> Tuple[int, Dict[str, Any]]:
+    '''
+    Проверка компании на дубликат ИНН: данные из Битрикс24, поиск по локальному индексу, удаление нового дубликата.
+    Вызывается из handler (синхронный режим) и из check_worker (асинхронная очередь).
+    event_at - момент прихода события (для задания из очереди - его created_at), по умолчанию текущий момент.
+    Returns: (HTTP-статус, тело ответа)
+    '''
+    # Параллельные события по одной компании выполняются по очереди; если пока мы ждали,
+    # другой вызов уже забрал свежие данные компании - повторно не проверяем.
+    # Не дождались блокировки - событие не подтверждается (503), его нужно повторить
+    coalesced = begin_company_check(cur, conn, bitrix_id, event_at)
+    if coalesced:
+        return (503 if coalesced['reason'] == 'in_flight' else 200), coalesced
+    
+    company_data = get_bitrix_company(bitrix_id)
+    
+    if not company_data.get('success'):
+        error_msg = f"Failed to get company data: {company_data.get('error')}"
         
-        search_result = find_duplicate_companies_by_inn(inn)
+        # Если компания не найдена (404/Not found) - это нормально, не логируем как ошибку
+        if 'Not found' in error_msg or 'HTTP 400' in error_msg:
+            print(f"[DEBUG] Company {bitrix_id} not found in Bitrix24 (deleted or test)")
+            remove_local_companies(cur, [bitrix_id])
+            conn.commit()
+            return 404, {
+                'error': 'Company not found',
+                'message': 'Company may have been deleted or does not exist'
+            }
         
-        # Подробная информация о поиске для отображения в дашборде
-        search_details = {
-            'search_success': search_result.get('success'),
-            'total_found': len(search_result.get('companies', [])),
-            'found_companies': search_result.get('companies', []),
-            'search_method': 'crm.company.list with filter[RQ_INN]',
-            'inn_searched': inn
+        # Только реальные ошибки API логируем
+        log_webhook(cur, 'check_inn', '', bitrix_id, body_data, 'error', False, error_msg, source_info, method)
+        conn.commit()
+        return 400, {'error': error_msg}
+    
+    company_info = company_data.get('company', {})
+    inn: str = company_info.get('RQ_INN', '').strip()
+    title: str = company_info.get('TITLE', '')
+    
+    if not inn:
+        action_msg = 'Company has no INN'
+        
+        # Создаём задачу и отправляем уведомление автору - только если открытой задачи по компании ещё нет
+        task_result = ensure_missing_inn_task(cur, bitrix_id, title, company_info)
+        if task_result.get('reused'):
+            action_msg += f" | Open task already exists: {task_result.get('task_id')}"
+        elif task_result.get('success'):
+            action_msg += f" | Task created: {task_result.get('task_id')}"
+        else:
+            action_msg += f" | Failed to create task: {task_result.get('error')}"
+        
+        # ИНН могли стереть - компания больше не должна находиться по старому ИНН
+        remove_local_companies(cur, [bitrix_id])
+        log_webhook(cur, 'check_inn', '', bitrix_id, body_data, 'no_inn', False, action_msg, source_info, method)
+        conn.commit()
+        return 200, {
+            'duplicate': False, 
+            'message': 'Company has no INN, task created for responsible user',
+            'task_created': task_result.get('success', False) and not task_result.get('reused', False),
+            'task_reused': task_result.get('reused', False),
+            'task_id': task_result.get('task_id')
         }
+    
+    # ИНН заполнен - задача на его заполнение из реестра больше не актуальна
+    close_missing_inn_task(cur, bitrix_id)
+    
+    # Большинство обновлений компании не трогают ИНН/КПП: если реквизиты не менялись с прошлой
+    # проверки, возвращаем сохранённый вердикт без поиска дубликатов
+    requisites_hash = compute_requisites_hash(company_info)
+    cached_verdict = load_cached_verdict(cur, bitrix_id, requisites_hash)
+    if cached_verdict:
+        print(f"[DEBUG] Requisites of company {bitrix_id} unchanged since {cached_verdict['checked_at']}, returning cached verdict")
+        log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, cached_verdict['status'], False,
+                    f"Requisites unchanged, cached verdict from {cached_verdict['checked_at']}", source_info, method)
+        conn.commit()
+        return 200, {**cached_verdict['result'], 'cached': True}
+    
+    # Сначала ищем кандидатов в локальном индексе companies - без обращений к Битрикс24.
+    # Удалённо проверяем только найденных локальных кандидатов
+    local_candidate_ids = find_local_companies_by_inn(cur, inn, bitrix_id)
+    if local_candidate_ids:
+        search_result = verify_local_candidates(cur, local_candidate_ids)
+        search_method = 'local index companies + crm.company.list filter[ID]'
+    else:
+        search_result = {'success': True, 'companies': []}
+        search_method = 'local index companies (no candidates)'
+    
+    # Подробная информация о поиске для отображения в дашборде
+    search_details = {
+        'search_success': search_result.get('success'),
+        'total_found': len(search_result.get('companies', [])),
+        'found_companies': search_result.get('companies', []),
+        'local_candidates': local_candidate_ids,
+        'search_method': search_method,
+        'inn_searched': inn
+    }
+    
+    if search_result.get('success') and len(search_result.get('companies', [])) > 0:
+        bitrix_companies = search_result['companies']
         
-        if search_result.get('success') and len(search_result.get('companies', [])) > 0:
-            bitrix_companies = search_result['companies']
+        print(f"[DEBUG] Found {len(bitrix_companies)} companies with INN {inn}")
+        print(f"[DEBUG] Company IDs: {[c['ID'] for c in bitrix_companies]}")
+        print(f"[DEBUG] Current company ID: {bitrix_id}")
+        
+        # КРИТИЧНО: Отфильтровываем текущую компанию из списка найденных
+        # Сравниваем как строки, т.к. ID из Битрикс может быть строкой
+        existing_ids = [c['ID'] for c in bitrix_companies if str(c['ID']) != str(bitrix_id)]
+        
+        search_details['other_companies_count'] = len(existing_ids)
+        search_details['other_companies_ids'] = existing_ids
+        search_details['current_company_id'] = bitrix_id
+        search_details['comparison_details'] = {
+            'bitrix_id': bitrix_id,
+            'bitrix_id_type': str(type(bitrix_id).__name__),
+            'found_ids_with_types': [{'id': c['ID'], 'type': str(type(c['ID']).__name__), 'title': c.get('TITLE', 'N/A')} for c in bitrix_companies]
+        }
+        
+        print(f"[DEBUG] Other company IDs (excluding current): {existing_ids}")
+        print(f"[DEBUG] Total companies found: {len(bitrix_companies)}, Others: {len(existing_ids)}")
+        print(f"[DEBUG] Comparison: bitrix_id={bitrix_id} (type: {type(bitrix_id)})")
+        print(f"[DEBUG] All found IDs: {[(c['ID'], type(c['ID'])) for c in bitrix_companies]}")
+        
+        # Дубликат ТОЛЬКО если найдены ДРУГИЕ компании (не текущая)
+        if len(existing_ids) == 0:
+            # Найдена только текущая компания - НЕ дубликат
+            action_msg = f"Only current company {bitrix_id} found with INN {inn}, not a duplicate (total: {len(bitrix_companies)})"
+            action_msg += f" | Search details: {json.dumps(search_details, ensure_ascii=False)}"
+            print(f"[DEBUG] {action_msg}")
             
-            print(f"[DEBUG] Found {len(bitrix_companies)} companies with INN {inn}")
-            print(f"[DEBUG] Company IDs: {[c['ID'] for c in bitrix_companies]}")
-            print(f"[DEBUG] Current company ID: {bitrix_id}")
+            # Добавляем детали поиска в request_body для отображения в дашборде
+            body_data_with_search = body_data.copy()
+            body_data_with_search['search_details'] = search_details
             
-            # КРИТИЧНО: Отфильтровываем текущую компанию из списка найденных
-            # Сравниваем как строки, т.к. ID из Битрикс может быть строкой
-            existing_ids = [c['ID'] for c in bitrix_companies if str(c['ID']) != str(bitrix_id)]
+            log_webhook(cur, 'check_inn', inn, bitrix_id, body_data_with_search, 'success', False, action_msg, source_info, method)
             
-            search_details['other_companies_count'] = len(existing_ids)
-            search_details['other_companies_ids'] = existing_ids
-            search_details['current_company_id'] = bitrix_id
-            search_details['comparison_details'] = {
+            result = {
+                'duplicate': False,
+                'inn': inn,
                 'bitrix_id': bitrix_id,
-                'bitrix_id_type': str(type(bitrix_id).__name__),
-                'found_ids_with_types': [{'id': c['ID'], 'type': str(type(c['ID']).__name__), 'title': c.get('TITLE', 'N/A')} for c in bitrix_companies]
+                'message': 'ИНН уникален, компания сохранена'
             }
+            upsert_local_company(cur, bitrix_id, inn, title)
+            save_check_verdict(cur, bitrix_id, requisites_hash, 'success', result)
+            conn.commit()
             
-            print(f"[DEBUG] Other company IDs (excluding current): {existing_ids}")
-            print(f"[DEBUG] Total companies found: {len(bitrix_companies)}, Others: {len(existing_ids)}")
-            print(f"[DEBUG] Comparison: bitrix_id={bitrix_id} (type: {type(bitrix_id)})")
-            print(f"[DEBUG] All found IDs: {[(c['ID'], type(c['ID'])) for c in bitrix_companies]}")
-            
-            # Дубликат ТОЛЬКО если найдены ДРУГИЕ компании (не текущая)
-            if len(existing_ids) == 0:
-                # Найдена только текущая компания - НЕ дубликат
-                action_msg = f"Only current company {bitrix_id} found with INN {inn}, not a duplicate (total: {len(bitrix_companies)})"
-                action_msg += f" | Search details: {json.dumps(search_details, ensure_ascii=False)}"
-                print(f"[DEBUG] {action_msg}")
-                
-                # Добавляем детали поиска в request_body для отображения в дашборде
-                body_data_with_search = body_data.copy()
-                body_data_with_search['search_details'] = search_details
-                
-                log_webhook(cur, 'check_inn', inn, bitrix_id, body_data_with_search, 'success', False, action_msg, source_info, method)
-                
-                cur.execute(
-                    "INSERT INTO companies (bitrix_id, inn, title) VALUES (%s, %s, %s) ON CONFLICT (bitrix_id) DO UPDATE SET inn = EXCLUDED.inn, title = EXCLUDED.title, updated_at = CURRENT_TIMESTAMP",
-                    (bitrix_id, inn, title)
-                )
-                conn.commit()
-                
-                return response_json(200, {
-                    'duplicate': False,
-                    'inn': inn,
-                    'bitrix_id': bitrix_id,
-                    'message': 'ИНН уникален, компания сохранена'
-                })
-            
-            # Найдены другие компании с таким же ИНН - это дубликат
-            old_company_id = existing_ids[0]
-            other_companies_info = [{'id': c['ID'], 'title': c.get('TITLE', 'N/A'), 'date_create': c.get('DATE_CREATE', 'N/A')} 
-                                   for c in bitrix_companies if str(c['ID']) != str(bitrix_id)]
-            
-            action_taken = f"Duplicate INN found! Existing: {old_company_id} | Other companies: {json.dumps(other_companies_info, ensure_ascii=False)}"
-            deleted = False
-            
-            search_details['duplicate_detected'] = True
-            search_details['existing_company_id'] = old_company_id
-            search_details['other_companies_full'] = other_companies_info
-            
-            print(f"[DEBUG] Duplicate detected! Current: {bitrix_id}, Existing: {old_company_id}")
-            print(f"[DEBUG] Other companies: {other_companies_info}")
-            
-            # КРИТИЧНО: Проверяем что старая компания РЕАЛЬНО существует в Битриксе прямо сейчас
-            old_company_exists = False
-            try:
-                old_company_check = get_bitrix_company(old_company_id)
-                if old_company_check.get('success') and old_company_check.get('company'):
-                    old_company_exists = True
-                    print(f"[DEBUG] Old company {old_company_id} verified - exists in Bitrix")
-                else:
-                    print(f"[DEBUG] Old company {old_company_id} NOT found in Bitrix - will NOT delete new company")
-            except Exception as e:
-                print(f"[DEBUG] Error checking old company {old_company_id}: {e}")
-            
-            # Только если старая компания существует - удаляем новую
-            if not old_company_exists:
-                action_taken = f"Duplicate INN, but old company {old_company_id} doesn't exist - keeping new company {bitrix_id}"
-                print(f"[DEBUG] {action_taken}")
-                
-                log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'duplicate_but_old_missing', False, action_taken, source_info, method)
-                conn.commit()
-                
-                return response_json(200, {
-                    'duplicate': False,
-                    'inn': inn,
-                    'new_company_id': bitrix_id,
-                    'old_company_missing': True,
-                    'old_company_id': old_company_id,
-                    'message': action_taken
-                })
-            
-            # КРИТИЧНО: Сохраняем ПОЛНЫЙ объект компании со ВСЕМИ полями
-            # company_info уже содержит ВСЕ поля + дела (добавлены в get_bitrix_company)
-            company_backup = dict(company_info)
-            company_backup['ID'] = bitrix_id  # Сохраняем оригинальный ID
-            company_backup['bitrix_id'] = bitrix_id  # Дублируем для совместимости
+            return 200, result
+        
+        # Локальный индекс мог отстать от реквизитов - перед удалением подтверждаем ИНН кандидатов в Битрикс24
+        inn_check = confirm_inn_candidates(cur, inn, existing_ids)
+        search_details['inn_confirmed_ids'] = inn_check.get('confirmed_ids', [])
+        
+        if not inn_check.get('success'):
+            action_taken = f"Failed to confirm INN {inn} for candidates {existing_ids}: {inn_check.get('error')} - company {bitrix_id} kept, check must be repeated"
+            print(f"[ERROR] {action_taken}")
+            log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'inn_check_failed', False, action_taken, source_info, method)
+            conn.commit()
+            return 503, {'success': False, 'inn': inn, 'bitrix_id': bitrix_id, 'error': action_taken}
+        
+        existing_ids = inn_check['confirmed_ids']
+        if not existing_ids:
+            action_msg = f"Candidates for INN {inn} no longer have this INN in Bitrix24, not a duplicate"
+            print(f"[DEBUG] {action_msg}")
             
-            print(f"[DEBUG] Company backup created with {len(company_backup)} fields")
-            print(f"[DEBUG] Deals in backup: {len(company_backup.get('DEALS', []))} deals")
+            result = {
+                'duplicate': False,
+                'inn': inn,
+                'bitrix_id': bitrix_id,
+                'message': 'ИНН уникален, компания сохранена'
+            }
+            upsert_local_company(cur, bitrix_id, inn, title)
+            save_check_verdict(cur, bitrix_id, requisites_hash, 'success', result)
+            log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'success', False, action_msg, source_info, method)
+            conn.commit()
             
-            delete_result = delete_bitrix_company(bitrix_id)
-            if delete_result.get('success'):
-                action_taken = f"Auto-deleted NEW duplicate company {bitrix_id} (INN already exists in {old_company_id})"
-                deleted = True
+            return 200, result
+        
+        # Найдены другие компании с таким же ИНН - это дубликат
+        old_company_id = existing_ids[0]
+        other_companies_info = [{'id': c['ID'], 'title': c.get('TITLE', 'N/A'), 'date_create': c.get('DATE_CREATE', 'N/A')} 
+                               for c in bitrix_companies if str(c['ID']) in existing_ids]
+        
+        action_taken = f"Duplicate INN found! Existing: {old_company_id} | Other companies: {json.dumps(other_companies_info, ensure_ascii=False)}"
+        deleted = False
+        
+        search_details['duplicate_detected'] = True
+        search_details['existing_company_id'] = old_company_id
+        search_details['other_companies_full'] = other_companies_info
+        
+        print(f"[DEBUG] Duplicate detected! Current: {bitrix_id}, Existing: {old_company_id}")
+        print(f"[DEBUG] Other companies: {other_companies_info}")
+        
+        # КРИТИЧНО: Проверяем что старая компания РЕАЛЬНО существует в Битриксе прямо сейчас
+        old_company_exists = False
+        try:
+            if verify_companies_exist([old_company_id]):
+                old_company_exists = True
+                print(f"[DEBUG] Old company {old_company_id} verified - exists in Bitrix")
             else:
-                action_taken = f"Failed to delete new company {bitrix_id}: {delete_result.get('error')}"
-            
-            # Сохраняем данные для восстановления в request_body
-            body_data_with_backup = body_data.copy()
-            body_data_with_backup['deleted_company_data'] = company_backup
-            
-            log_webhook(cur, 'check_inn', inn, bitrix_id, body_data_with_backup, 'duplicate_found', True, action_taken, source_info, method)
-            conn.commit()
+                print(f"[DEBUG] Old company {old_company_id} NOT found in Bitrix - will NOT delete new company")
+        except Exception as e:
+            print(f"[DEBUG] Error checking old company {old_company_id}: {e}")
+        
+        # Только если старая компания существует - удаляем новую
+        if not old_company_exists:
+            action_taken = f"Duplicate INN, but old company {old_company_id} doesn't exist - keeping new company {bitrix_id}"
+            print(f"[DEBUG] {action_taken}")
             
-            return response_json(200, {
-                'duplicate': True,
+            result = {
+                'duplicate': False,
                 'inn': inn,
                 'new_company_id': bitrix_id,
-                'existing_company_id': old_company_id,
-                'bitrix_companies': bitrix_companies,
-                'action': 'deleted' if deleted else 'delete_failed',
-                'deleted': deleted,
-                'message': action_taken,
-                'company_backup': company_backup
-            })
+                'old_company_missing': True,
+                'old_company_id': old_company_id,
+                'message': action_taken
+            }
+            remove_local_companies(cur, [old_company_id])
+            upsert_local_company(cur, bitrix_id, inn, title)
+            save_check_verdict(cur, bitrix_id, requisites_hash, 'duplicate_but_old_missing', result)
+            log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'duplicate_but_old_missing', False, action_taken, source_info, method)
+            conn.commit()
+            
+            return 200, result
         
-        cur.execute(
-            "INSERT INTO companies (bitrix_id, inn, title) VALUES (%s, %s, %s) ON CONFLICT (bitrix_id) DO UPDATE SET inn = EXCLUDED.inn, title = EXCLUDED.title, updated_at = CURRENT_TIMESTAMP",
-            (bitrix_id, inn, title)
-        )
+        # КРИТИЧНО: Сохраняем ПОЛНЫЙ объект компании со ВСЕМИ полями
+        # company_info уже содержит ВСЕ поля + дела (добавлены в get_bitrix_company)
+        company_backup = dict(company_info)
+        company_backup['ID'] = bitrix_id  # Сохраняем оригинальный ID
+        company_backup['bitrix_id'] = bitrix_id  # Дублируем для совместимости
+        
+        print(f"[DEBUG] Company backup created with {len(company_backup)} fields")
+        print(f"[DEBUG] Deals in backup: {len(company_backup.get('DEALS', []))} deals")
+        
+        delete_result = delete_bitrix_company(bitrix_id)
+        if delete_result.get('success'):
+            action_taken = f"Auto-deleted NEW duplicate company {bitrix_id} (INN already exists in {old_company_id})"
+            deleted = True
+            remove_local_companies(cur, [bitrix_id])
+        else:
+            action_taken = f"Failed to delete new company {bitrix_id}: {delete_result.get('error')}"
         
-        log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'success', False, 'No duplicate, company saved', source_info, method)
+        # Снимок компании храним сжатым в company_backups, в логе - только ссылка на него
+        body_data_with_backup = body_data.copy()
+        body_data_with_backup['company_backup_ref'] = {'bitrix_id': bitrix_id, 'storage': 'company_backups'}
+        
+        log_id = log_webhook(cur, 'check_inn', inn, bitrix_id, body_data_with_backup, 'duplicate_found', True, action_taken, source_info, method)
+        save_company_backup(cur, log_id, bitrix_id, inn, company_backup)
         conn.commit()
         
-        return response_json(200, {
-            'duplicate': False,
+        return 200, {
+            'duplicate': True,
             'inn': inn,
-            'bitrix_id': bitrix_id,
-            'message': 'ИНН уникален, компания сохранена'
-        })
+            'new_company_id': bitrix_id,
+            'existing_company_id': old_company_id,
+            'bitrix_companies': bitrix_companies,
+            'action': 'deleted' if deleted else 'delete_failed',
+            'deleted': deleted,
+            'message': action_taken,
+            'company_backup': company_backup
+        }
     
-    finally:
-        cur.close()
-        conn.close()
+    result = {
+        'duplicate': False,
+        'inn': inn,
+        'bitrix_id': bitrix_id,
+        'message': 'ИНН уникален, компания сохранена'
+    }
+    upsert_local_company(cur, bitrix_id, inn, title)
+    save_check_verdict(cur, bitrix_id, requisites_hash, 'success', result)
     
-    return response_json(405, {'error': 'Method not allowed'})
+    log_webhook(cur, 'check_inn', inn, bitrix_id, body_data, 'success', False, 'No duplicate, company saved', source_info, method)
+    conn.commit()
+    
+    return 200, result
 
-def log_webhook(cur, webhook_type: str, inn: str, bitrix_id: str, request_body: Dict, status: str, duplicate: bool, action: str, source_info: str = '', method: str = 'POST'):
+def log_webhook(cur, webhook_type: str, inn: str, bitrix_id: str, request_body: Dict, status: str, duplicate: bool, action: str, source_info: str = '', method: str = 'POST') -> int:
     cur.execute(
-        "INSERT INTO webhook_logs (webhook_type, inn, bitrix_company_id, request_body, response_status, duplicate_found, action_taken, source_info, request_method) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)",
+        "INSERT INTO webhook_logs (webhook_type, inn, bitrix_company_id, request_body, response_status, duplicate_found, action_taken, source_info, request_method) VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s) RETURNING id",
         (webhook_type, inn, bitrix_id, json.dumps(request_body), status, duplicate, action, source_info, method)
     )
+    log_id = cur.fetchone()['id']
+    # Счётчики для дашборда ведём в той же транзакции, что и сам лог
+    cur.execute(
+        """INSERT INTO webhook_log_stats_daily (day, response_status, duplicate_found, requests_count)
+           VALUES (CURRENT_DATE, %s, %s, 1)
+           ON CONFLICT (day, response_status, duplicate_found)
+           DO UPDATE SET requests_count = webhook_log_stats_daily.requests_count + 1""",
+        (status or '', bool(duplicate))
+    )
+    return log_id
+
+def save_company_backup(cur, log_id: int, bitrix_id: str, inn: str, company_backup: Dict[str, Any]):
+    '''Сохраняет снимок удаляемой компании (поля, реквизиты, сделки) сжатым zlib JSON'''
+    raw = json.dumps(company_backup, ensure_ascii=False).encode('utf-8')
+    compressed = zlib.compress(raw, 6)
+    cur.execute(
+        "INSERT INTO company_backups (log_id, bitrix_id, inn, snapshot, snapshot_size) VALUES (%s, %s, %s, %s, %s)",
+        (log_id, bitrix_id, inn, psycopg2.Binary(compressed), len(raw))
+    )
+    print(f"[DEBUG] Company backup saved: {len(raw)} bytes -> {len(compressed)} bytes compressed")
+
+def load_company_backup(cur, log_id: int) -> Dict[str, Any]:
+    '''Читает снимок компании по id лога; для логов до company_backups - из request_body'''
+    cur.execute("SELECT snapshot FROM company_backups WHERE log_id = %s ORDER BY id DESC LIMIT 1", (log_id,))
+    row = cur.fetchone()
+    if row:
+        return json.loads(zlib.decompress(bytes(row['snapshot'])).decode('utf-8'))
+    
+    cur.execute("SELECT request_body FROM webhook_logs WHERE id = %s", (log_id,))
+    row = cur.fetchone()
+    if row and row['request_body']:
+        return json.loads(row['request_body']).get('deleted_company_data') or {}
+    
+    return {}
+
+def get_webhook_stats(cur) -> Tuple[Dict[str, int], Dict[str, Dict[str, int]]]:
+    '''
+    Статистика дашборда из дневных счётчиков webhook_log_stats_daily (не сканирует webhook_logs)
+    Возвращает итог за всё время и разбивку today / 7d / 30d
+    '''
+    cur.execute("""
+        SELECT
+            COALESCE(SUM(requests_count), 0) AS total_requests,
+            COALESCE(SUM(requests_count) FILTER (WHERE duplicate_found), 0) AS duplicates_found,
+            COALESCE(SUM(requests_count) FILTER (WHERE response_status = 'success'), 0) AS successful,
+            COALESCE(SUM(requests_count) FILTER (WHERE day = CURRENT_DATE), 0) AS today_total,
+            COALESCE(SUM(requests_count) FILTER (WHERE day = CURRENT_DATE AND duplicate_found), 0) AS today_duplicates,
+            COALESCE(SUM(requests_count) FILTER (WHERE day = CURRENT_DATE AND response_status = 'success'), 0) AS today_successful,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 7), 0) AS week_total,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 7 AND duplicate_found), 0) AS week_duplicates,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 7 AND response_status = 'success'), 0) AS week_successful,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 30), 0) AS month_total,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 30 AND duplicate_found), 0) AS month_duplicates,
+            COALESCE(SUM(requests_count) FILTER (WHERE day > CURRENT_DATE - 30 AND response_status = 'success'), 0) AS month_successful
+        FROM webhook_log_stats_daily
+    """)
+    row = {key: int(value) for key, value in dict(cur.fetchone()).items()}
+    
+    stats = {
+        'total_requests': row['total_requests'],
+        'duplicates_found': row['duplicates_found'],
+        'successful': row['successful']
+    }
+    stats_windows = {
+        window: {
+            'total_requests': row[f'{prefix}_total'],
+            'duplicates_found': row[f'{prefix}_duplicates'],
+            'successful': row[f'{prefix}_successful']
+        }
+        for window, prefix in (('today', 'today'), ('7d', 'week'), ('30d', 'month'))
+    }
+    
+    return stats, stats_windows
+
+def apply_log_retention(cur, table: str, keep_months: int) -> Dict[str, Any]:
+    '''
+    Ротация помесячных секций журнала через общую SQL-функцию apply_monthly_retention (V0032):
+    заранее создаёт секции на ближайшие месяцы, удаляет секции старше keep_months (DETACH + DROP)
+    и такие же старые строки DEFAULT-секции (V0035)
+    Дневные счётчики webhook_log_stats_daily не трогаем - статистика за всё время сохраняется
+    '''
+    cur.execute(
+        "SELECT apply_monthly_retention(%s, %s, %s) AS retention",
+        (table, keep_months, LOG_PARTITIONS_AHEAD_MONTHS)
+    )
+    retention = cur.fetchone()['retention']
+    
+    # Бэкапы компаний живут столько же, сколько записи журнала, на которые они ссылаются
+    if table == 'webhook_logs':
+        retention['backups_deleted'] = delete_orphan_company_backups(cur)
+    
+    print(f"[INFO] Retention for {table}: {retention}")
+    return retention
+
+def delete_orphan_company_backups(cur) -> int:
+    '''Удаляет бэкапы компаний, чьи записи webhook_logs уже удалены ротацией секций'''
+    cur.execute(
+        """DELETE FROM company_backups b
+           WHERE NOT EXISTS (SELECT 1 FROM webhook_logs l WHERE l.id = b.log_id)"""
+    )
+    return cur.rowcount
+
+def enqueue_company_check(cur, bitrix_id: str, body_data: Dict[str, Any], source_info: str, method: str) -> Optional[int]:
+    '''Ставит проверку компании в очередь; если по компании уже ждёт задание - новое не создаётся (возвращает None)'''
+    cur.execute(
+        """INSERT INTO company_check_jobs (bitrix_id, request_body, source_info, request_method)
+           VALUES (%s, %s, %s, %s)
+           ON CONFLICT (bitrix_id) WHERE status = 'pending' DO NOTHING
+           RETURNING id""",
+        (bitrix_id, json.dumps(body_data), source_info, method)
+    )
+    row = cur.fetchone()
+    print(f"[DEBUG] Company {bitrix_id} check {'queued as job ' + str(row['id']) if row else 'already queued'}")
+    return row['id'] if row else None
+
+def begin_company_check(cur, conn, bitrix_id: str, event_at: Optional[datetime] = None) -> Optional[Dict[str, Any]]:
+    '''
+    Берёт транзакционную advisory-блокировку на компанию (снимается на commit/rollback) и решает,
+    нужна ли проверка. Возвращает ответ для схлопнутого события или None, если проверку нужно выполнить.
+    Событие схлопывается (already_checked), только если после его прихода (минус окно дебаунса) компанию
+    уже забрал другой вызов. Если блокировку не удалось взять за COMPANY_LOCK_TIMEOUT_MS (in_flight),
+    держатель блокировки мог забрать компанию до этого события - проверка не выполнена и должна быть повторена
+    '''
+    if event_at is None:
+        cur.execute("SELECT clock_timestamp() AS event_at")
+        event_at = cur.fetchone()['event_at']
+    
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s", (f'{COMPANY_LOCK_TIMEOUT_MS}ms',))
+        cur.execute("SELECT pg_advisory_xact_lock(%s, %s)", (COMPANY_LOCK_NAMESPACE, int(bitrix_id)))
+        cur.execute("SET LOCAL lock_timeout TO DEFAULT")
+    except psycopg2.Error as e:
+        if e.pgcode != PG_LOCK_NOT_AVAILABLE:
+            raise
+        conn.rollback()
+        print(f"[WARN] Company {bitrix_id} is still being processed by another call, event must be retried")
+        return {
+            'coalesced': False,
+            'retryable': True,
+            'bitrix_id': bitrix_id,
+            'reason': 'in_flight',
+            'error': 'Компания проверяется другим вызовом, повторите событие позже'
+        }
+    
+    cur.execute("SELECT last_fetched_at FROM company_event_state WHERE bitrix_id = %s", (bitrix_id,))
+    state = cur.fetchone()
+    debounce_from = event_at - timedelta(seconds=WEBHOOK_DEBOUNCE_SECONDS)
+    
+    if state and state['last_fetched_at'] and state['last_fetched_at'] >= debounce_from:
+        cur.execute(
+            "UPDATE company_event_state SET events_coalesced = events_coalesced + 1 WHERE bitrix_id = %s",
+            (bitrix_id,)
+        )
+        conn.commit()
+        print(f"[DEBUG] Company {bitrix_id} fetched at {state['last_fetched_at']} after event at {event_at}, event coalesced")
+        return {
+            'coalesced': True,
+            'bitrix_id': bitrix_id,
+            'reason': 'already_checked',
+            'last_fetched_at': state['last_fetched_at'].isoformat(),
+            'message': 'Компания уже проверена после этого события'
+        }
+    
+    # Отметка фиксируется вместе с результатом проверки; при ошибке откатится и следующее событие проверит заново
+    cur.execute(
+        """INSERT INTO company_event_state (bitrix_id, last_fetched_at) VALUES (%s, clock_timestamp())
+           ON CONFLICT (bitrix_id) DO UPDATE SET last_fetched_at = EXCLUDED.last_fetched_at""",
+        (bitrix_id,)
+    )
+    return None
+
+def find_local_companies_by_inn(cur, inn: str, exclude_bitrix_id: str) -> List[str]:
+    '''Ищет в локальном индексе companies другие компании с таким же ИНН'''
+    cur.execute(
+        "SELECT bitrix_id FROM companies WHERE inn = %s AND bitrix_id <> %s ORDER BY bitrix_id",
+        (inn, exclude_bitrix_id)
+    )
+    candidate_ids = [row['bitrix_id'] for row in cur.fetchall()]
+    print(f"[DEBUG] Local index candidates for INN {inn}: {candidate_ids}")
+    return candidate_ids
+
+def verify_local_candidates(cur, candidate_ids: List[str]) -> Dict[str, Any]:
+    '''
+    Проверяет локальных кандидатов в Битрикс24 одним списочным запросом
+    Компании, которых уже нет в Битрикс24, удаляются из локального индекса
+    '''
+    try:
+        verified_companies = verify_companies_exist(candidate_ids)
+    except Exception as e:
+        print(f"[ERROR] Failed to verify local candidates {candidate_ids}: {e}")
+        return {'success': False, 'error': str(e), 'companies': []}
+    
+    verified_ids = {c['ID'] for c in verified_companies}
+    stale_ids = [company_id for company_id in candidate_ids if company_id not in verified_ids]
+    remove_local_companies(cur, stale_ids)
+    
+    return {'success': True, 'companies': verified_companies}
+
+def upsert_local_company(cur, bitrix_id: str, inn: str, title: str):
+    cur.execute(
+        "INSERT INTO companies (bitrix_id, inn, title) VALUES (%s, %s, %s) ON CONFLICT (bitrix_id) DO UPDATE SET inn = EXCLUDED.inn, title = EXCLUDED.title, requisite_id = NULL, updated_at = CURRENT_TIMESTAMP",
+        (bitrix_id, inn, title)
+    )
+
+def compute_requisites_hash(company_info: Dict[str, Any]) -> str:
+    '''Хэш значимых для проверки полей: ИНН компании и пары ИНН/КПП всех реквизитов (порядок не важен)'''
+    pairs = {((company_info.get('RQ_INN') or '').strip(), '')}
+    for req in company_info.get('REQUISITES', []):
+        pairs.add(((req.get('RQ_INN') or '').strip(), (req.get('RQ_KPP') or '').strip()))
+    return hashlib.sha256(json.dumps(sorted(pairs)).encode('utf-8')).hexdigest()
+
+def load_cached_verdict(cur, bitrix_id: str, requisites_hash: str) -> Optional[Dict[str, Any]]:
+    '''Сохранённый вердикт «не дубликат», если реквизиты с тех пор не менялись и он не старше CHECK_CACHE_TTL_SECONDS'''
+    cur.execute(
+        """SELECT last_check_status, last_check_result, last_checked_at FROM companies
+           WHERE bitrix_id = %s AND requisites_hash = %s AND last_check_status = ANY(%s)
+             AND last_checked_at > now() - make_interval(secs => %s)""",
+        (bitrix_id, requisites_hash, list(CACHEABLE_CHECK_STATUSES), CHECK_CACHE_TTL_SECONDS)
+    )
+    row = cur.fetchone()
+    if not row:
+        return None
+    return {'status': row['last_check_status'], 'result': row['last_check_result'] or {}, 'checked_at': row['last_checked_at'].isoformat()}
+
+def save_check_verdict(cur, bitrix_id: str, requisites_hash: str, status: str, result: Dict[str, Any]):
+    cur.execute(
+        """UPDATE companies
+           SET requisites_hash = %s, last_check_status = %s, last_check_result = %s, last_checked_at = now()
+           WHERE bitrix_id = %s""",
+        (requisites_hash, status, json.dumps(result, ensure_ascii=False), bitrix_id)
+    )
+
+def remove_local_companies(cur, bitrix_ids: List[str]):
+    if not bitrix_ids:
+        return
+    cur.execute("DELETE FROM companies WHERE bitrix_id = ANY(%s)", ([str(i) for i in bitrix_ids],))
+    if cur.rowcount:
+        print(f"[DEBUG] Removed {cur.rowcount} companies from local index: {bitrix_ids}")
+
+def list_webhook_logs(cur, params: Dict[str, str]) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''
+    Страница журнала вебхуков без request_body, курсорная пагинация по (created_at, id)
+    Фильтры: webhook_type, inn, status, duplicate_found, date_from, date_to; cursor - из next_cursor прошлой страницы
+    '''
+    limit = min(int(params.get('limit') or LOGS_PAGE_SIZE), LOGS_MAX_PAGE_SIZE)
+    if limit <= 0:
+        raise ValueError('limit должен быть положительным')
+    
+    conditions = []
+    values = []
+    
+    if params.get('webhook_type'):
+        conditions.append("webhook_type = %s")
+        values.append(params['webhook_type'])
+    if params.get('inn'):
+        conditions.append("inn = %s")
+        values.append(params['inn'].strip())
+    if params.get('status'):
+        conditions.append("response_status = %s")
+        values.append(params['status'])
+    if params.get('duplicate_found') in ('true', 'false'):
+        conditions.append("duplicate_found = %s")
+        values.append(params['duplicate_found'] == 'true')
+    if params.get('date_from'):
+        conditions.append("created_at >= %s")
+        values.append(params['date_from'])
+    if params.get('date_to'):
+        conditions.append("created_at < %s")
+        values.append(params['date_to'])
+    if params.get('cursor'):
+        cursor_created_at, cursor_id = decode_log_cursor(params['cursor'])
+        conditions.append("(created_at, id) < (%s, %s)")
+        values.extend([cursor_created_at, cursor_id])
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    cur.execute(
+        f"SELECT {LOG_LIST_COLUMNS} FROM webhook_logs {where} ORDER BY created_at DESC, id DESC LIMIT %s",
+        values + [limit + 1]
+    )
+    rows = cur.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_log_cursor(rows[-1]['created_at'], rows[-1]['id'])
+    
+    return rows, next_cursor
+
+def encode_log_cursor(created_at: datetime, log_id: int) -> str:
+    raw = json.dumps([created_at.isoformat(), log_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_log_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        created_at, log_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return datetime.fromisoformat(created_at), int(log_id)
+    except Exception:
+        raise ValueError('Некорректный cursor')
 
 def serialize_log(log: Dict) -> Dict:
     result = dict(log)
@@ -431,157 +982,263 @@ def serialize_log(log: Dict) -> Dict:
     return result
 
 def get_bitrix_company(company_id: str) -> Dict[str, Any]:
+    '''
+    Получает компанию со ВСЕМИ полями, реквизитами и сделками за один HTTP-запрос
+    Команды crm.company.get, crm.requisite.list и crm.deal.list отправляются одним batch
+    '''
+    commands = {
+        'company': build_batch_command('crm.company.get', {'ID': company_id}),
+        'requisites': build_batch_command('crm.requisite.list', {
+            'filter[ENTITY_ID]': company_id,
+            'filter[ENTITY_TYPE_ID]': '4'  # 4 = Company
+        }),
+        'deals': build_batch_command('crm.deal.list', {'filter[COMPANY_ID]': company_id})
+    }
+    print(f"[DEBUG] Requesting Bitrix24 company {company_id} with requisites and deals via batch")
+    
+    batch_result = call_bitrix_batch(commands)
+    if not batch_result.get('success'):
+        return {'success': False, 'error': batch_result.get('error')}
+    
+    company = batch_result['result'].get('company')
+    if not company:
+        error = batch_result['result_error'].get('company') or {}
+        error_msg = error.get('error_description', error.get('error', 'Company not found'))
+        print(f"[DEBUG] Bitrix24 error: {error_msg}")
+        return {'success': False, 'error': error_msg}
+    
+    requisites = batch_result['result'].get('requisites') or []
+    if batch_result['result_error'].get('requisites'):
+        print(f"[DEBUG] Error getting requisites: {batch_result['result_error']['requisites']}")
+    
+    deals = batch_result['result'].get('deals') or []
+    if batch_result['result_error'].get('deals'):
+        print(f"[DEBUG] Error getting deals: {batch_result['result_error']['deals']}")
+    
+    inn = (company.get('RQ_INN') or '').strip()
+    if not inn:
+        print(f"[DEBUG] No INN in company fields, checking requisites...")
+        inn = get_inn_from_requisites(requisites)
+        print(f"[DEBUG] INN from requisites: {inn}")
+        company['RQ_INN'] = inn
+    
+    # ПОЛНЫЕ реквизиты (не только ИНН) и сделки нужны для бэкапа перед удалением
+    company['REQUISITES'] = requisites
+    print(f"[DEBUG] Found {len(requisites)} requisites for company {company_id}")
+    
+    company['DEALS'] = deals
+    print(f"[DEBUG] Found {len(deals)} deals for company {company_id}")
+    
+    return {'success': True, 'company': company}
+
+def get_inn_from_requisites(requisites: List[Dict[str, Any]]) -> str:
+    '''Возвращает первый непустой ИНН из уже загруженных реквизитов'''
+    for req in requisites:
+        inn = (req.get('RQ_INN') or '').strip()
+        if inn:
+            print(f"[DEBUG] Found INN in requisite ID={req.get('ID')}: {inn}")
+            return inn
+    
+    return ''
+
+def build_batch_command(method: str, params: Dict[str, Any]) -> str:
+    '''Формирует команду для batch в виде method?query'''
+    return f"{method}?{urllib.parse.urlencode(params, doseq=True)}"
+
+def call_bitrix_batch(commands: Dict[str, str], halt: bool = False) -> Dict[str, Any]:
+    '''
+    Выполняет до 50 команд REST API Битрикс24 за один HTTP-запрос (метод batch)
+    Возвращает result и result_error, разложенные по ключам команд
+    '''
     bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
     
     if not bitrix_webhook:
         return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL not configured'}
     
+    throttle_bitrix()
+    
     try:
-        # Получаем ВСЕ поля компании
-        params = urllib.parse.urlencode({'ID': company_id})
-        url = f"{bitrix_webhook.rstrip('/')}/crm.company.get.json?{params}"
-        print(f"[DEBUG] Requesting Bitrix24 company with ALL fields: {url}")
-        
-        with urllib.request.urlopen(url, timeout=10) as response:
-            response_text = response.read().decode('utf-8')
-            print(f"[DEBUG] Bitrix24 company response: {response_text[:500]}")
-            result = json.loads(response_text)
-            
-            if result.get('result'):
-                company = result['result']
-                inn = company.get('RQ_INN', '').strip()
-                
-                if not inn:
-                    print(f"[DEBUG] No INN in company fields, checking requisites...")
-                    inn = get_company_inn_from_requisites(company_id)
-                    print(f"[DEBUG] INN from requisites: {inn}")
-                    company['RQ_INN'] = inn
-                
-                # Получаем ПОЛНЫЕ реквизиты (не только ИНН)
-                requisites = get_company_requisites(company_id)
-                company['REQUISITES'] = requisites
-                print(f"[DEBUG] Found {len(requisites)} requisites for company {company_id}")
-                
-                # Получаем дела по компании
-                deals = get_company_deals(company_id)
-                company['DEALS'] = deals
-                print(f"[DEBUG] Found {len(deals)} deals for company {company_id}")
-                
-                return {'success': True, 'company': company}
-            else:
-                error_msg = result.get('error_description', result.get('error', 'Company not found'))
-                print(f"[DEBUG] Bitrix24 error: {error_msg}")
-                return {'success': False, 'error': error_msg}
+        url = f"{bitrix_webhook.rstrip('/')}/batch.json"
+        params = {'halt': '1' if halt else '0'}
+        for key, command in commands.items():
+            params[f'cmd[{key}]'] = command
+        
+        data = urllib.parse.urlencode(params).encode('utf-8')
+        req = urllib.request.Request(url, data=data)
+        
+        with urllib.request.urlopen(req, timeout=15) as response:
+            result = json.loads(response.read().decode('utf-8'))
+        
+        if not isinstance(result.get('result'), dict):
+            error_msg = result.get('error_description', result.get('error', 'Unknown error'))
+            print(f"[DEBUG] Batch error: {error_msg}")
+            return {'success': False, 'error': error_msg}
+        
+        batch = result['result']
+        return {
+            'success': True,
+            'result': normalize_batch_section(batch.get('result')),
+            'result_error': normalize_batch_section(batch.get('result_error')),
+            'result_total': normalize_batch_section(batch.get('result_total')),
+            'result_next': normalize_batch_section(batch.get('result_next'))
+        }
     
     except urllib.error.HTTPError as e:
         error_body = e.read().decode('utf-8') if e.fp else 'No error body'
-        print(f"[DEBUG] HTTPError {e.code}: {error_body}")
+        print(f"[DEBUG] Batch HTTPError {e.code}: {error_body}")
         return {'success': False, 'error': f'HTTP {e.code}: {error_body}'}
     except Exception as e:
-        print(f"[DEBUG] Exception: {type(e).__name__}: {str(e)}")
+        print(f"[DEBUG] Batch exception: {type(e).__name__}: {str(e)}")
         return {'success': False, 'error': str(e)}
 
-def get_company_requisites(company_id: str) -> List[Dict[str, Any]]:
-    '''Получает ВСЕ реквизиты компании с полными данными'''
-    bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
-    
-    if not bitrix_webhook:
-        return []
+def call_bitrix_batch_chunked(commands: Dict[str, str]) -> Dict[str, Any]:
+    '''
+    Отправляет любое число команд пачками по 50 (лимит метода batch)
+    Ключи команд, чья пачка не выполнилась целиком (сеть, лимиты), возвращаются в failed_keys
+    '''
+    merged = {'result': {}, 'result_error': {}, 'failed_keys': [], 'errors': []}
+    keys = list(commands.keys())
     
-    try:
-        params_dict = {
-            'filter[ENTITY_ID]': company_id,
-            'filter[ENTITY_TYPE_ID]': '4'  # 4 = Company
-        }
-        params = urllib.parse.urlencode(params_dict)
-        url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.list.json?{params}"
-        print(f"[DEBUG] Requesting requisites: {url}")
-        
-        with urllib.request.urlopen(url, timeout=10) as response:
-            response_text = response.read().decode('utf-8')
-            print(f"[DEBUG] Requisites response: {response_text[:1000]}")
-            result = json.loads(response_text)
-            
-            if result.get('result'):
-                requisites = result['result']
-                print(f"[DEBUG] Found {len(requisites)} full requisites")
-                return requisites
+    for offset in range(0, len(keys), BATCH_MAX_COMMANDS):
+        chunk_keys = keys[offset:offset + BATCH_MAX_COMMANDS]
+        batch_result = call_bitrix_batch({key: commands[key] for key in chunk_keys})
+        
+        if not batch_result.get('success'):
+            print(f"[DEBUG] Batch chunk of {len(chunk_keys)} commands failed: {batch_result.get('error')}")
+            merged['failed_keys'].extend(chunk_keys)
+            merged['errors'].append(batch_result.get('error'))
+            continue
         
-        return []
+        merged['result'].update(batch_result['result'])
+        merged['result_error'].update(batch_result['result_error'])
     
+    return merged
+
+def normalize_batch_section(section: Any) -> Dict[str, Any]:
+    '''Битрикс24 отдаёт пустые секции batch как [], а не {} - приводим к словарю'''
+    if isinstance(section, dict):
+        return section
+    if isinstance(section, list):
+        return {str(idx): value for idx, value in enumerate(section)}
+    return {}
+
+def confirm_inn_candidates(cur, inn: str, candidate_ids: List[str]) -> Dict[str, Any]:
+    '''
+    КРИТИЧНО: Подтверждает ИНН кандидатов одним crm.requisite.list по filter[ENTITY_ID] и filter[RQ_INN]
+    Кандидаты без реквизита с этим ИНН удаляются из локального индекса; confirmed_ids - по возрастанию ID
+    '''
+    try:
+        response = call_bitrix_method('crm.requisite.list', {
+            'filter[ENTITY_TYPE_ID]': '4',  # 4 = Company
+            'filter[RQ_INN]': inn,
+            'filter[ENTITY_ID][]': candidate_ids,
+            'select[]': ['ENTITY_ID', 'RQ_INN']
+        })
     except Exception as e:
-        print(f"[DEBUG] Error getting requisites: {type(e).__name__}: {str(e)}")
-        return []
+        return {'success': False, 'error': str(e), 'confirmed_ids': []}
+    
+    if 'error' in response:
+        return {'success': False, 'error': response.get('error_description', response['error']), 'confirmed_ids': []}
+    
+    found_ids = {str(req.get('ENTITY_ID')) for req in response.get('result', []) if (req.get('RQ_INN') or '').strip() == inn}
+    confirmed_ids = [company_id for company_id in candidate_ids if str(company_id) in found_ids]
+    stale_ids = [company_id for company_id in candidate_ids if str(company_id) not in found_ids]
+    if stale_ids:
+        print(f"[DEBUG] Candidates without INN {inn} in Bitrix24, removing from local index: {stale_ids}")
+        remove_local_companies(cur, stale_ids)
+    
+    confirmed_ids.sort(key=lambda company_id: int(company_id) if str(company_id).isdigit() else 0)
+    return {'success': True, 'confirmed_ids': confirmed_ids}
 
-def get_company_inn_from_requisites(company_id: str) -> str:
-    '''Получает только ИНН из реквизитов (для быстрой проверки)'''
-    requisites = get_company_requisites(company_id)
+def verify_companies_exist(company_ids: List[str]) -> List[Dict[str, Any]]:
+    '''
+    Проверяет существование компаний через crm.company.list с filter[ID] и минимальным select
+    Кандидаты режутся на пачки, каждая пачка забирается постранично; порядок - по возрастанию ID
+    '''
+    verified_companies = []
     
-    for req in requisites:
-        inn = req.get('RQ_INN', '').strip()
-        if inn:
-            print(f"[DEBUG] Found INN in requisite ID={req.get('ID')}: {inn}")
-            return inn
+    for offset in range(0, len(company_ids), VERIFY_IDS_CHUNK_SIZE):
+        chunk = company_ids[offset:offset + VERIFY_IDS_CHUNK_SIZE]
+        companies = list_bitrix_all('crm.company.list', {
+            'filter[ID][]': chunk,
+            'select[]': ['ID', 'TITLE', 'DATE_CREATE'],
+            'order[ID]': 'ASC'
+        })
+        
+        for company in companies:
+            verified_companies.append({
+                'ID': str(company.get('ID')),
+                'TITLE': company.get('TITLE', 'N/A'),
+                'DATE_CREATE': company.get('DATE_CREATE', 'N/A')
+            })
     
-    return ''
+    found_ids = {c['ID'] for c in verified_companies}
+    skipped_ids = [company_id for company_id in company_ids if str(company_id) not in found_ids]
+    if skipped_ids:
+        print(f"[DEBUG] Companies SKIPPED (deleted or not found): {skipped_ids}")
+    
+    verified_companies.sort(key=lambda c: int(c['ID']) if c['ID'].isdigit() else 0)
+    return verified_companies
 
-def find_duplicate_companies_by_inn(inn: str) -> Dict[str, Any]:
+def call_bitrix_method(method: str, params: Dict[str, Any]) -> Dict[str, Any]:
     '''
-    КРИТИЧНО: Ищет активные компании с заданным ИНН в Битрикс24
-    Проверяет каждую найденную компанию на существование через crm.company.get
+    Вызывает метод REST API Битрикс24 через POST и возвращает распарсенный ответ
+    Списочные значения передаются как key[]=a&key[]=b
     '''
     bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
     
     if not bitrix_webhook:
-        return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL not configured', 'companies': []}
+        raise RuntimeError('BITRIX24_WEBHOOK_URL not configured')
+    
+    url = f"{bitrix_webhook.rstrip('/')}/{method}.json"
+    data = urllib.parse.urlencode(params, doseq=True).encode('utf-8')
+    req = urllib.request.Request(url, data=data)
+    
+    throttle_bitrix()
     
     try:
-        # КРИТИЧНО: Получаем АКТИВНЫЕ компании, ищем через реквизиты
-        url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.list.json"
+        with urllib.request.urlopen(req, timeout=10) as response:
+            return json.loads(response.read().decode('utf-8'))
+    except urllib.error.HTTPError as e:
+        error_body = e.read().decode('utf-8') if e.fp else 'No error body'
+        raise RuntimeError(f'HTTP {e.code}: {error_body}')
+
+def throttle_bitrix():
+    '''
+    Ждёт свободный слот в лимите запросов портала (общий для всех потоков процесса)
+    Короткие серии запросов проходят без задержки, длинные выравниваются до BITRIX24_RATE_LIMIT/сек
+    '''
+    with _bitrix_rate_lock:
+        now = time.monotonic()
+        elapsed = now - _bitrix_rate_state['updated']
+        _bitrix_rate_state['tokens'] = min(BITRIX_RATE_BURST, _bitrix_rate_state['tokens'] + elapsed * BITRIX_RATE_LIMIT)
+        _bitrix_rate_state['updated'] = now
+        _bitrix_rate_state['tokens'] -= 1
+        wait_seconds = -_bitrix_rate_state['tokens'] / BITRIX_RATE_LIMIT if _bitrix_rate_state['tokens'] < 0 else 0
+    
+    if wait_seconds > 0:
+        time.sleep(wait_seconds)
+
+def list_bitrix_all(method: str, params: Dict[str, Any], max_pages: int = 100) -> List[Dict[str, Any]]:
+    '''Забирает все страницы списочного метода (по 50 записей) через start/next'''
+    items = []
+    start = 0
+    
+    for _ in range(max_pages):
+        page_params = dict(params)
+        page_params['start'] = start
+        result = call_bitrix_method(method, page_params)
         
-        filter_params = urllib.parse.urlencode({
-            'filter[RQ_INN]': inn,
-            'filter[ENTITY_TYPE_ID]': '4'  # 4 = Company
-        })
+        if 'error' in result:
+            raise RuntimeError(result.get('error_description', result.get('error')))
         
-        req_url = f"{url}?{filter_params}"
-        print(f"[DEBUG] Searching requisites with INN {inn}: {req_url}")
+        items.extend(result.get('result') or [])
         
-        with urllib.request.urlopen(req_url, timeout=10) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-            if not result.get('result'):
-                return {'success': True, 'companies': []}  # Нет реквизитов = нет компаний
-            
-            requisites = result['result']
-            print(f"[DEBUG] Found {len(requisites)} requisites with INN {inn}")
-            
-            # Собираем уникальные ID компаний из реквизитов
-            company_ids = list(set([req.get('ENTITY_ID') for req in requisites if req.get('ENTITY_ID')]))
-            print(f"[DEBUG] Unique company IDs from requisites: {company_ids}")
-            
-            # КРИТИЧНО: Проверяем каждую компанию на реальное существование
-            verified_companies = []
-            for company_id in company_ids:
-                # Проверяем существование компании через crm.company.get
-                check_result = get_bitrix_company(str(company_id))
-                if check_result.get('success') and check_result.get('company'):
-                    company_data = check_result['company']
-                    verified_companies.append({
-                        'ID': company_id,
-                        'TITLE': company_data.get('TITLE', 'N/A'),
-                        'DATE_CREATE': company_data.get('DATE_CREATE', 'N/A')
-                    })
-                    print(f"[DEBUG] Company {company_id} VERIFIED (exists and active)")
-                else:
-                    print(f"[DEBUG] Company {company_id} SKIPPED (deleted or not found): {check_result.get('error')}")
-            
-            print(f"[DEBUG] Verified {len(verified_companies)} out of {len(company_ids)} companies")
-            return {'success': True, 'companies': verified_companies}
+        if result.get('next') is None:
+            break
+        start = result['next']
     
-    except Exception as e:
-        print(f"[ERROR] find_duplicate_companies_by_inn failed: {e}")
-        return {'success': False, 'error': str(e), 'companies': []}
+    return items
 
 def create_task_for_missing_inn(company_id: str, company_title: str, company_info: Dict[str, Any]) -> Dict[str, Any]:
     bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
@@ -676,20 +1333,229 @@ def send_notification_to_user(user_id: str, message: str, company_id: str, compa
         print(f"[DEBUG] Exception sending notification: {type(e).__name__}: {str(e)}")
         return {'success': False, 'error': str(e)}
 
-def restore_deleted_company(company_data: Dict[str, Any]) -> Dict[str, Any]:
-    '''Восстанавливает компанию с ПОЛНЫМ копированием ВСЕХ полей, реквизитов и дел'''
+def ensure_missing_inn_task(cur, company_id: str, company_title: str, company_info: Dict[str, Any]) -> Dict[str, Any]:
+    '''
+    Задача на заполнение ИНН через реестр pending_inn_tasks: пока по компании есть открытая задача,
+    новая не создаётся и уведомление не отправляется. Давно не сверявшаяся задача проверяется в Битрикс24
+    '''
+    cur.execute(
+        """SELECT task_id, checked_at < now() - make_interval(secs => %s) AS stale
+           FROM pending_inn_tasks WHERE company_id = %s AND status = 'open'""",
+        (INN_TASK_RECHECK_SECONDS, company_id)
+    )
+    pending = cur.fetchone()
+    
+    if pending:
+        task_open = True
+        if pending['stale']:
+            try:
+                task_open = update_pending_inn_tasks(cur, fetch_task_statuses([pending['task_id']]), [pending['task_id']]) == 0
+            except Exception as e:
+                # Битрикс24 недоступен - считаем задачу открытой, чтобы не создавать дубликат
+                print(f"[DEBUG] Failed to check task {pending['task_id']} status: {e}")
+        
+        if task_open:
+            print(f"[DEBUG] Company {company_id} already has open INN task {pending['task_id']}, skipping creation")
+            return {'success': True, 'task_id': pending['task_id'], 'reused': True}
+    
+    task_result = create_task_for_missing_inn(company_id, company_title, company_info)
+    
+    if task_result.get('success'):
+        cur.execute(
+            """INSERT INTO pending_inn_tasks (company_id, task_id, status, created_at, checked_at)
+               VALUES (%s, %s, 'open', now(), now())
+               ON CONFLICT (company_id) DO UPDATE SET
+                   task_id = EXCLUDED.task_id, status = 'open', task_status = NULL,
+                   created_at = EXCLUDED.created_at, checked_at = EXCLUDED.checked_at, closed_at = NULL""",
+            (company_id, str(task_result['task_id']))
+        )
+    
+    return task_result
+
+def close_missing_inn_task(cur, company_id: str):
+    '''У компании появился ИНН - открытая задача в реестре закрывается (в Битрикс24 её закрывает ответственный)'''
+    cur.execute(
+        "UPDATE pending_inn_tasks SET status = 'resolved', closed_at = now() WHERE company_id = %s AND status = 'open'",
+        (company_id,)
+    )
+
+def refresh_pending_inn_tasks(cur) -> Dict[str, Any]:
+    '''Сверяет все открытые задачи реестра с Битрикс24: tasks.task.list по 50 ID, до 50 списков в одном batch'''
+    cur.execute("SELECT task_id FROM pending_inn_tasks WHERE status = 'open'")
+    task_ids = [row['task_id'] for row in cur.fetchall()]
+    
+    if not task_ids:
+        return {'success': True, 'checked': 0, 'closed': 0}
+    
+    try:
+        statuses = fetch_task_statuses(task_ids)
+    except Exception as e:
+        print(f"[ERROR] Failed to refresh INN tasks: {e}")
+        return {'success': False, 'error': str(e)}
+    
+    closed_count = update_pending_inn_tasks(cur, statuses, task_ids)
+    print(f"[INFO] Refreshed {len(task_ids)} open INN tasks, {closed_count} closed")
+    
+    return {'success': True, 'checked': len(task_ids), 'closed': closed_count}
+
+def fetch_task_statuses(task_ids: List[str]) -> Dict[str, int]:
+    '''
+    Статусы задач по ID. Задачи, которых нет в ответе (удалены), в результат не попадают.
+    Если часть batch не выполнилась, бросает RuntimeError - отсутствие задачи тогда ничего не значит
+    '''
+    commands = {}
+    for offset in range(0, len(task_ids), BATCH_MAX_COMMANDS):
+        commands[f'tasks_{offset}'] = build_batch_command('tasks.task.list', {
+            'filter[ID][]': task_ids[offset:offset + BATCH_MAX_COMMANDS],
+            'select[]': ['ID', 'STATUS']
+        })
+    
+    batch_result = call_bitrix_batch_chunked(commands)
+    if batch_result['failed_keys'] or batch_result['result_error']:
+        raise RuntimeError(f"tasks.task.list failed: {batch_result['errors'] or batch_result['result_error']}")
+    
+    statuses = {}
+    for page in batch_result['result'].values():
+        for task in (page or {}).get('tasks', []):
+            statuses[str(task.get('id'))] = int(task.get('status') or 0)
+    
+    return statuses
+
+def update_pending_inn_tasks(cur, statuses: Dict[str, int], task_ids: List[str]) -> int:
+    '''Закрывает в реестре завершённые, отклонённые и удалённые задачи, остальным обновляет checked_at'''
+    closed_ids = [task_id for task_id in task_ids if statuses.get(task_id) is None or statuses[task_id] in TASK_CLOSED_STATUSES]
+    open_ids = [task_id for task_id in task_ids if task_id not in closed_ids]
+    
+    if closed_ids:
+        cur.execute(
+            "UPDATE pending_inn_tasks SET status = 'closed', checked_at = now(), closed_at = now() WHERE task_id = ANY(%s)",
+            (closed_ids,)
+        )
+    if open_ids:
+        cur.execute("UPDATE pending_inn_tasks SET checked_at = now() WHERE task_id = ANY(%s)", (open_ids,))
+    
+    known_ids = [task_id for task_id in task_ids if task_id in statuses]
+    if known_ids:
+        cur.execute(
+            """UPDATE pending_inn_tasks p SET task_status = s.task_status
+               FROM (SELECT unnest(%s::text[]) AS task_id, unnest(%s::int[]) AS task_status) s
+               WHERE p.task_id = s.task_id""",
+            (known_ids, [statuses[task_id] for task_id in known_ids])
+        )
+    
+    return len(closed_ids)
+
+def restore_deleted_company(company_data: Dict[str, Any], cur, conn) -> Dict[str, Any]:
+    '''
+    Восстанавливает компанию с ПОЛНЫМ копированием ВСЕХ полей, реквизитов и дел
+    Реквизиты и дела переносятся пачками batch, прогресс пишется в company_restore_journal
+    после каждой пачки - повторный вызов продолжает с места сбоя и не создаёт дублей
+    '''
     bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
     
     if not bitrix_webhook:
         return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL not configured'}
     
+    original_id = str(company_data.get('ID', company_data.get('bitrix_id')) or '')
+    if not original_id.isdigit():
+        return {'success': False, 'error': 'Backup has no original company ID'}
+    
+    # Сессионная блокировка на всё восстановление (журнал коммитится по ходу, транзакционная бы снялась):
+    # параллельный вызов (двойной клик, повтор клиента) не создаст вторую компанию, а получит «в процессе»
+    cur.execute("SELECT pg_try_advisory_lock(%s, %s) AS locked", (RESTORE_LOCK_NAMESPACE, int(original_id)))
+    locked = cur.fetchone()['locked']
+    conn.commit()
+    if not locked:
+        print(f"[DEBUG] Restore of company {original_id} is already in progress")
+        return {'success': False, 'in_progress': True, 'original_id': original_id, 'error': 'Восстановление компании уже выполняется'}
+    
+    try:
+        return restore_company_locked(company_data, original_id, cur, conn)
+    finally:
+        cur.execute("SELECT pg_advisory_unlock(%s, %s)", (RESTORE_LOCK_NAMESPACE, int(original_id)))
+        conn.commit()
+
+def restore_company_locked(company_data: Dict[str, Any], original_id: str, cur, conn) -> Dict[str, Any]:
+    '''Восстановление под блокировкой RESTORE_LOCK_NAMESPACE: создание компании, затем реквизиты и дела по журналу'''
     try:
-        url = f"{bitrix_webhook.rstrip('/')}/crm.company.add.json"
-        
-        original_id = company_data.get('ID', company_data.get('bitrix_id'))
         print(f"[DEBUG] Restoring company {original_id} with full data copy")
         print(f"[DEBUG] Company data keys: {list(company_data.keys())[:20]}...")
         
+        journal = load_restore_journal(cur, original_id)
+        conn.commit()
+        
+        if journal['status'] == 'completed':
+            print(f"[DEBUG] Company {original_id} already restored as {journal['new_company_id']}")
+            return {'success': True, 'company_id': journal['new_company_id'], 'original_id': original_id, 'already_restored': True}
+        
+        new_company_id = journal['new_company_id']
+        if new_company_id:
+            print(f"[DEBUG] Resuming restore of {original_id} into existing company {new_company_id}")
+        else:
+            create_result = create_company_from_backup(company_data)
+            if not create_result.get('success'):
+                update_restore_journal(cur, original_id, status='failed', errors=[create_result.get('error')])
+                conn.commit()
+                return create_result
+            
+            new_company_id = create_result['company_id']
+            update_restore_journal(cur, original_id, new_company_id=new_company_id, status='company_created')
+            conn.commit()
+            print(f"[DEBUG] Company restored with new ID: {new_company_id} (original was {original_id})")
+        
+        errors = []
+        
+        # КРИТИЧНО: Восстанавливаем реквизиты (включая ИНН), пропуская уже перенесённые
+        requisites = company_data.get('REQUISITES', [])
+        done_requisites = set(journal['restored_requisite_ids'])
+        pending_requisites = [req for req in requisites if str(req.get('ID')) not in done_requisites]
+        if not requisites:
+            print(f"[DEBUG] WARNING: No requisites found in backup data")
+        
+        for offset in range(0, len(pending_requisites), BATCH_MAX_COMMANDS):
+            chunk = pending_requisites[offset:offset + BATCH_MAX_COMMANDS]
+            chunk_result = restore_company_requisites(chunk, new_company_id)
+            errors.extend(chunk_result['errors'])
+            update_restore_journal(cur, original_id, restored_requisite_ids=chunk_result['restored_ids'])
+            conn.commit()
+        
+        # Восстанавливаем дела, переназначая их на новую компанию
+        deals = company_data.get('DEALS', [])
+        done_deals = set(journal['restored_deal_ids'])
+        pending_deals = [deal for deal in deals if str(deal.get('ID')) not in done_deals]
+        
+        for offset in range(0, len(pending_deals), BATCH_MAX_COMMANDS):
+            chunk = pending_deals[offset:offset + BATCH_MAX_COMMANDS]
+            chunk_result = restore_company_deals(chunk, new_company_id)
+            errors.extend(chunk_result['errors'])
+            update_restore_journal(cur, original_id, restored_deal_ids=chunk_result['restored_ids'])
+            conn.commit()
+        
+        status = 'partial' if errors else 'completed'
+        update_restore_journal(cur, original_id, status=status, errors=errors)
+        conn.commit()
+        
+        print(f"[DEBUG] Restore of {original_id} finished with status {status}: "
+              f"{len(pending_requisites)} requisites, {len(pending_deals)} deals processed")
+        if errors:
+            print(f"[DEBUG] Errors: {errors}")
+        
+        return {'success': True, 'company_id': str(new_company_id), 'original_id': original_id, 'status': status, 'errors': errors}
+    
+    except Exception as e:
+        conn.rollback()
+        print(f"[DEBUG] Exception restoring company: {type(e).__name__}: {str(e)}")
+        import traceback
+        print(f"[DEBUG] Traceback: {traceback.format_exc()}")
+        return {'success': False, 'error': str(e)}
+
+def create_company_from_backup(company_data: Dict[str, Any]) -> Dict[str, Any]:
+    '''Создаёт компанию через crm.company.add из всех простых полей и мультиполей бэкапа'''
+    bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
+    
+    try:
+        url = f"{bitrix_webhook.rstrip('/')}/crm.company.add.json"
+        
         # Список полей-исключений (системные, не для копирования)
         skip_fields = {'ID', 'bitrix_id', 'inn', 'DEALS', 'REQUISITES', 'DATE_CREATE', 'DATE_MODIFY', 
                       'CREATED_BY_ID', 'MODIFY_BY_ID', 'COMPANY_ID', 'RQ_INN'}
@@ -742,161 +1608,115 @@ def restore_deleted_company(company_data: Dict[str, Any]) -> Dict[str, Any]:
         data = urllib.parse.urlencode(fields).encode('utf-8')
         req = urllib.request.Request(url, data=data)
         
+        throttle_bitrix()
+        
         with urllib.request.urlopen(req, timeout=10) as response:
             result = json.loads(response.read().decode('utf-8'))
             
             if result.get('result'):
-                new_company_id = result['result']
-                print(f"[DEBUG] Company restored with new ID: {new_company_id} (original was {original_id})")
-                
-                # КРИТИЧНО: Восстанавливаем реквизиты (включая ИНН)
-                requisites = company_data.get('REQUISITES', [])
-                if requisites:
-                    print(f"[DEBUG] Restoring {len(requisites)} requisites to new company {new_company_id}")
-                    restore_requisites_result = restore_company_requisites(requisites, new_company_id)
-                    print(f"[DEBUG] Requisites restore result: {restore_requisites_result}")
-                else:
-                    print(f"[DEBUG] WARNING: No requisites found in backup data")
-                
-                # Восстанавливаем дела, переназначая их на новую компанию
-                deals = company_data.get('DEALS', [])
-                if deals:
-                    print(f"[DEBUG] Restoring {len(deals)} deals to new company {new_company_id}")
-                    restore_deals_result = restore_company_deals(deals, new_company_id)
-                    print(f"[DEBUG] Deals restore result: {restore_deals_result}")
-                
-                return {'success': True, 'company_id': str(new_company_id), 'original_id': original_id}
+                return {'success': True, 'company_id': str(result['result'])}
             else:
                 error_msg = result.get('error_description', result.get('error', 'Unknown error'))
                 print(f"[DEBUG] Restore error: {error_msg}")
                 return {'success': False, 'error': error_msg}
     
     except Exception as e:
-        print(f"[DEBUG] Exception restoring company: {type(e).__name__}: {str(e)}")
-        import traceback
-        print(f"[DEBUG] Traceback: {traceback.format_exc()}")
+        print(f"[DEBUG] Exception creating company: {type(e).__name__}: {str(e)}")
         return {'success': False, 'error': str(e)}
 
+def load_restore_journal(cur, original_id: str) -> Dict[str, Any]:
+    cur.execute(
+        "INSERT INTO company_restore_journal (original_company_id) VALUES (%s) ON CONFLICT (original_company_id) DO NOTHING",
+        (original_id,)
+    )
+    cur.execute(
+        "UPDATE company_restore_journal SET attempts = attempts + 1, updated_at = CURRENT_TIMESTAMP WHERE original_company_id = %s "
+        "RETURNING new_company_id, status, restored_requisite_ids, restored_deal_ids",
+        (original_id,)
+    )
+    return dict(cur.fetchone())
+
+def update_restore_journal(cur, original_id: str, new_company_id: Optional[str] = None, status: Optional[str] = None,
+                           restored_requisite_ids: Optional[List[str]] = None, restored_deal_ids: Optional[List[str]] = None,
+                           errors: Optional[List[str]] = None):
+    cur.execute(
+        """UPDATE company_restore_journal SET
+               new_company_id = COALESCE(%s, new_company_id),
+               status = COALESCE(%s, status),
+               restored_requisite_ids = restored_requisite_ids || %s::jsonb,
+               restored_deal_ids = restored_deal_ids || %s::jsonb,
+               errors = COALESCE(%s::jsonb, errors),
+               updated_at = CURRENT_TIMESTAMP
+           WHERE original_company_id = %s""",
+        (
+            new_company_id,
+            status,
+            json.dumps(restored_requisite_ids or []),
+            json.dumps(restored_deal_ids or []),
+            json.dumps(errors, ensure_ascii=False) if errors is not None else None,
+            original_id
+        )
+    )
+
 def restore_company_requisites(requisites: List[Dict[str, Any]], new_company_id: str) -> Dict[str, Any]:
-    '''Создает реквизиты для восстановленной компании'''
-    bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
+    '''Создает реквизиты для восстановленной компании одной пачкой batch (до 50 штук)'''
+    # Подготавливаем поля реквизита (исключаем системные)
+    skip_req_fields = {'ID', 'ENTITY_ID', 'DATE_CREATE', 'DATE_MODIFY', 'CREATED_BY_ID', 'MODIFY_BY_ID'}
+    commands = {}
     
-    if not bitrix_webhook or not requisites:
-        return {'success': False, 'restored_count': 0}
+    for idx, req in enumerate(requisites):
+        params = {
+            'fields[ENTITY_TYPE_ID]': '4',  # Company
+            'fields[ENTITY_ID]': new_company_id
+        }
+        
+        # Копируем все поля реквизита
+        for key, value in req.items():
+            if key in skip_req_fields or value is None or value == '':
+                continue
+            params[f'fields[{key}]'] = str(value)
+        
+        commands[f'requisite_{idx}'] = build_batch_command('crm.requisite.add', params)
     
-    restored_count = 0
+    batch_result = call_bitrix_batch_chunked(commands)
+    restored_ids = []
     errors = []
     
-    for req in requisites:
-        try:
-            url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.add.json"
-            
-            # Подготавливаем поля реквизита (исключаем системные)
-            skip_req_fields = {'ID', 'ENTITY_ID', 'DATE_CREATE', 'DATE_MODIFY', 'CREATED_BY_ID', 'MODIFY_BY_ID'}
-            
-            params = {
-                'fields[ENTITY_TYPE_ID]': '4',  # Company
-                'fields[ENTITY_ID]': new_company_id
-            }
-            
-            # Копируем все поля реквизита
-            for key, value in req.items():
-                if key in skip_req_fields or value is None or value == '':
-                    continue
-                params[f'fields[{key}]'] = str(value)
-            
-            print(f"[DEBUG] Creating requisite with {len(params)} fields")
-            
-            data = urllib.parse.urlencode(params).encode('utf-8')
-            request = urllib.request.Request(url, data=data)
-            
-            with urllib.request.urlopen(request, timeout=10) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if result.get('result'):
-                    new_req_id = result['result']
-                    restored_count += 1
-                    print(f"[DEBUG] Requisite created with ID: {new_req_id}")
-                else:
-                    error_msg = result.get('error_description', result.get('error', 'Unknown error'))
-                    errors.append(f"Requisite creation failed: {error_msg}")
-                    print(f"[DEBUG] Error creating requisite: {error_msg}")
-        
-        except Exception as e:
-            errors.append(f"Requisite exception: {str(e)}")
-            print(f"[DEBUG] Exception creating requisite: {type(e).__name__}: {str(e)}")
+    for idx, req in enumerate(requisites):
+        key = f'requisite_{idx}'
+        if batch_result['result'].get(key):
+            restored_ids.append(str(req.get('ID')))
+            print(f"[DEBUG] Requisite created with ID: {batch_result['result'][key]}")
+        else:
+            error = batch_result['result_error'].get(key) or {}
+            errors.append(f"Requisite creation failed: {error.get('error_description', error.get('error', 'Batch request failed'))}")
     
-    print(f"[DEBUG] Restored {restored_count}/{len(requisites)} requisites")
-    if errors:
-        print(f"[DEBUG] Errors: {errors}")
+    print(f"[DEBUG] Restored {len(restored_ids)}/{len(requisites)} requisites")
     
-    return {'success': True, 'restored_count': restored_count, 'total': len(requisites), 'errors': errors}
+    return {'success': True, 'restored_ids': restored_ids, 'restored_count': len(restored_ids), 'total': len(requisites), 'errors': errors}
 
 def restore_company_deals(deals: List[Dict[str, Any]], new_company_id: str) -> Dict[str, Any]:
-    '''Копирует дела на восстановленную компанию'''
-    bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
-    
-    if not bitrix_webhook or not deals:
-        return {'success': False, 'restored_count': 0}
+    '''Копирует дела на восстановленную компанию одной пачкой batch (до 50 штук)'''
+    commands = {
+        f'deal_{idx}': build_batch_command('crm.deal.update', {'ID': deal['ID'], 'fields[COMPANY_ID]': new_company_id})
+        for idx, deal in enumerate(deals)
+    }
     
-    restored_count = 0
+    batch_result = call_bitrix_batch_chunked(commands)
+    restored_ids = []
     errors = []
     
-    for deal in deals:
-        try:
-            url = f"{bitrix_webhook.rstrip('/')}/crm.deal.update.json"
-            params = {
-                'ID': deal['ID'],
-                'fields[COMPANY_ID]': new_company_id
-            }
-            
-            data = urllib.parse.urlencode(params).encode('utf-8')
-            req = urllib.request.Request(url, data=data)
-            
-            with urllib.request.urlopen(req, timeout=10) as response:
-                result = json.loads(response.read().decode('utf-8'))
-                
-                if result.get('result'):
-                    restored_count += 1
-                else:
-                    errors.append(f"Deal {deal['ID']}: {result.get('error_description', 'Unknown error')}")
-        
-        except Exception as e:
-            errors.append(f"Deal {deal['ID']}: {str(e)}")
-    
-    print(f"[DEBUG] Restored {restored_count}/{len(deals)} deals")
-    if errors:
-        print(f"[DEBUG] Errors: {errors}")
-    
-    return {'success': True, 'restored_count': restored_count, 'total': len(deals), 'errors': errors}
-
-def get_company_deals(company_id: str) -> List[Dict[str, Any]]:
-    '''Получает все дела по компании'''
-    bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
-    
-    if not bitrix_webhook:
-        print(f"[DEBUG] BITRIX24_WEBHOOK_URL not configured")
-        return []
+    for idx, deal in enumerate(deals):
+        key = f'deal_{idx}'
+        if batch_result['result'].get(key):
+            restored_ids.append(str(deal['ID']))
+        else:
+            error = batch_result['result_error'].get(key) or {}
+            errors.append(f"Deal {deal['ID']}: {error.get('error_description', 'Batch request failed')}")
     
-    try:
-        filter_params = urllib.parse.urlencode({'filter[COMPANY_ID]': company_id})
-        url = f"{bitrix_webhook.rstrip('/')}/crm.deal.list.json?{filter_params}"
-        print(f"[DEBUG] Getting deals for company {company_id}: {url}")
-        
-        with urllib.request.urlopen(url, timeout=10) as response:
-            result = json.loads(response.read().decode('utf-8'))
-            
-            if result.get('result'):
-                deals = result['result']
-                print(f"[DEBUG] Found {len(deals)} deals")
-                return deals
-            else:
-                print(f"[DEBUG] No deals found or error: {result}")
-                return []
+    print(f"[DEBUG] Restored {len(restored_ids)}/{len(deals)} deals")
     
-    except Exception as e:
-        print(f"[DEBUG] Exception getting deals: {type(e).__name__}: {str(e)}")
-        return []
+    return {'success': True, 'restored_ids': restored_ids, 'restored_count': len(restored_ids), 'total': len(deals), 'errors': errors}
 
 def delete_bitrix_company(company_id: str) -> Dict[str, Any]:
     '''Удаляет компанию из Битрикс24'''
@@ -905,6 +1725,8 @@ def delete_bitrix_company(company_id: str) -> Dict[str, Any]:
     if not bitrix_webhook:
         return {'success': False, 'error': 'BITRIX24_WEBHOOK_URL not configured'}
     
+    throttle_bitrix()
+    
     try:
         url = f"{bitrix_webhook.rstrip('/')}/crm.company.delete.json"
         params = {'ID': company_id}
@@ -927,6 +1749,17 @@ def delete_bitrix_company(company_id: str) -> Dict[str, Any]:
         print(f"[DEBUG] Exception deleting company: {type(e).__name__}: {str(e)}")
         return {'success': False, 'error': str(e)}
 
+def parse_max_seconds(value: Any) -> Optional[float]:
+    '''max_seconds из тела запроса: число больше 0, значения больше ACTION_MAX_SECONDS урезаются; None - некорректное значение'''
+    try:
+        seconds = float(value)
+    except (TypeError, ValueError):
+        return None
+    # not > 0 отсекает и NaN
+    if not seconds > 0:
+        return None
+    return min(seconds, ACTION_MAX_SECONDS)
+
 def response_json(status_code: int, data: Dict) -> Dict[str, Any]:
     return {
         'statusCode': status_code,
@@ -942,7 +1775,7 @@ def diagnose_inn_duplicates(inn: str, cur) -> Dict[str, Any]:
     '''
     Диагностирует проблемы с дубликатами ИНН:
     1. Находит активные компании через crm.company.list
-    2. Для каждой компании получает ВСЕ реквизиты с RQ_NAME
+    2. Одним crm.requisite.list по filter[ENTITY_ID] получает реквизиты всех найденных компаний
     3. Формирует таблицу: по одной строке на каждый реквизит
     '''
     result = {
@@ -962,81 +1795,67 @@ def diagnose_inn_duplicates(inn: str, cur) -> Dict[str, Any]:
     
     try:
         # 1. Получаем компании с ИНН через crm.company.list
-        params_dict = {
+        companies = list_bitrix_all('crm.company.list', {
             'filter[RQ_INN]': inn,
-        }
-        for field in ['ID', 'TITLE', 'DATE_CREATE', 'COMPANY_TYPE', 'PHONE', 'EMAIL']:
-            params_dict[f'select[]'] = field
+            'select[]': ['ID', 'TITLE', 'DATE_CREATE', 'COMPANY_TYPE', 'PHONE', 'EMAIL']
+        })
+        print(f"[DEBUG] Found {len(companies)} active companies")
         
-        url = f"{bitrix_webhook.rstrip('/')}/crm.company.list.json"
-        data = urllib.parse.urlencode(params_dict).encode('utf-8')
-        req = urllib.request.Request(url, data=data)
+        companies_by_id = {str(company['ID']): company for company in companies}
         
-        companies = []
-        with urllib.request.urlopen(req, timeout=10) as response:
-            companies_result = json.loads(response.read().decode('utf-8'))
-            
-            if companies_result.get('result'):
-                companies = companies_result['result']
-                print(f"[DEBUG] Found {len(companies)} active companies")
+        # 2. Реквизиты ВСЕХ компаний одним запросом (включая RQ_NAME)
+        requisites = []
+        if companies_by_id:
+            requisites = list_bitrix_all('crm.requisite.list', {
+                'filter[ENTITY_ID][]': list(companies_by_id.keys()),
+                'filter[ENTITY_TYPE_ID]': '4',
+                'select[]': ['ID', 'ENTITY_ID', 'ENTITY_TYPE_ID', 'RQ_NAME', 'RQ_INN', 'RQ_KPP']
+            })
         
-        # 2. Для КАЖДОЙ компании получаем ВСЕ реквизиты (включая RQ_NAME)
         all_requisites_data = []
+        search_inn = str(inn).strip()
         
-        for company in companies:
-            company_id = str(company['ID'])
+        for req_item in requisites:
+            company_id = str(req_item.get('ENTITY_ID', ''))
+            company = companies_by_id.get(company_id)
+            if not company:
+                continue
             
-            # Получаем реквизиты компании
-            params = urllib.parse.urlencode({
-                'filter[ENTITY_ID]': company_id,
-                'filter[ENTITY_TYPE_ID]': '4',
+            # Проверяем ИНН (может быть с пробелами или в другом формате)
+            req_inn = str(req_item.get('RQ_INN', '')).strip()
+            if req_inn != search_inn:
+                print(f"[DEBUG] Skipping requisite: INN mismatch '{req_inn}' != '{search_inn}'")
+                continue
+            
+            phone_value = ''
+            if company.get('PHONE') and isinstance(company['PHONE'], list) and len(company['PHONE']) > 0:
+                phone_value = company['PHONE'][0].get('VALUE', '')
+            
+            email_value = ''
+            if company.get('EMAIL') and isinstance(company['EMAIL'], list) and len(company['EMAIL']) > 0:
+                email_value = company['EMAIL'][0].get('VALUE', '')
+            
+            all_requisites_data.append({
+                'ID': company_id,
+                'REQUISITE_ID': req_item.get('ID', ''),
+                'TITLE': company.get('TITLE', ''),
+                'RQ_NAME': req_item.get('RQ_NAME', ''),
+                'DATE_CREATE': company.get('DATE_CREATE', ''),
+                'is_active': True,
+                'COMPANY_TYPE': company.get('COMPANY_TYPE', ''),
+                'RQ_INN': req_item.get('RQ_INN', inn),
+                'RQ_KPP': req_item.get('RQ_KPP', ''),
+                'PHONE': phone_value,
+                'EMAIL': email_value,
             })
-            req_url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.list.json?{params}"
             
-            try:
-                with urllib.request.urlopen(req_url, timeout=5) as req_response:
-                    req_data = json.loads(req_response.read().decode('utf-8'))
-                    
-                    if req_data.get('result'):
-                        for req_item in req_data['result']:
-                            # Проверяем ИНН (может быть с пробелами или в другом формате)
-                            req_inn = str(req_item.get('RQ_INN', '')).strip()
-                            search_inn = str(inn).strip()
-                            
-                            if req_inn == search_inn:
-                                phone_value = ''
-                                if company.get('PHONE') and isinstance(company['PHONE'], list) and len(company['PHONE']) > 0:
-                                    phone_value = company['PHONE'][0].get('VALUE', '')
-                                
-                                email_value = ''
-                                if company.get('EMAIL') and isinstance(company['EMAIL'], list) and len(company['EMAIL']) > 0:
-                                    email_value = company['EMAIL'][0].get('VALUE', '')
-                                
-                                all_requisites_data.append({
-                                    'ID': company_id,
-                                    'REQUISITE_ID': req_item.get('ID', ''),
-                                    'TITLE': company.get('TITLE', ''),
-                                    'RQ_NAME': req_item.get('RQ_NAME', ''),
-                                    'DATE_CREATE': company.get('DATE_CREATE', ''),
-                                    'is_active': True,
-                                    'COMPANY_TYPE': company.get('COMPANY_TYPE', ''),
-                                    'RQ_INN': req_item.get('RQ_INN', inn),
-                                    'RQ_KPP': req_item.get('RQ_KPP', ''),
-                                    'PHONE': phone_value,
-                                    'EMAIL': email_value,
-                                })
-                                
-                                result['requisites_in_db'].append({
-                                    'id': req_item.get('ID', ''),
-                                    'entity_id': company_id,
-                                    'entity_type_id': req_item.get('ENTITY_TYPE_ID', ''),
-                                    'inn': req_item.get('RQ_INN', ''),
-                                    'company_exists': True
-                                })
-                            else:
-                                print(f"[DEBUG] Skipping requisite: INN mismatch '{req_inn}' != '{search_inn}'")
-            except Exception as e:
-                print(f"[ERROR] Failed to get requisites for company {company_id}: {e}")
+            result['requisites_in_db'].append({
+                'id': req_item.get('ID', ''),
+                'entity_id': company_id,
+                'entity_type_id': req_item.get('ENTITY_TYPE_ID', ''),
+                'inn': req_item.get('RQ_INN', ''),
+                'company_exists': True
+            })
         
         result['bitrix_companies'] = all_requisites_data
         result['summary']['total_bitrix'] = len(companies)
@@ -1052,9 +1871,11 @@ def diagnose_inn_duplicates(inn: str, cur) -> Dict[str, Any]:
     
     return result
 
-def clean_orphaned_requisites(inn: str) -> Dict[str, Any]:
+def clean_orphaned_requisites(inn: str, dry_run: bool = False) -> Dict[str, Any]:
     '''
     Удаляет мусорные реквизиты (не привязанные к активным компаниям) через REST API Битрикс24
+    План строится из одного списка реквизитов и одной проверки существования компаний,
+    удаление идёт пачками batch по 50. В режиме dry_run возвращает план без удаления
     '''
     bitrix_webhook = os.environ.get('BITRIX24_WEBHOOK_URL', '')
     if not bitrix_webhook:
@@ -1063,52 +1884,55 @@ def clean_orphaned_requisites(inn: str) -> Dict[str, Any]:
     cleaned_count = 0
     
     try:
-        # 1. Получаем все реквизиты с данным ИНН
-        params = urllib.parse.urlencode({
+        # 1. Получаем все реквизиты компаний с данным ИНН
+        requisites = list_bitrix_all('crm.requisite.list', {
             'filter[RQ_INN]': inn,
+            'filter[ENTITY_TYPE_ID]': '4',  # 4 = Company, реквизиты контактов не трогаем
             'select[]': ['ID', 'ENTITY_ID', 'ENTITY_TYPE_ID']
         })
-        url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.list.json?{params}"
         
-        with urllib.request.urlopen(url, timeout=10) as response:
-            requisites_data = json.loads(response.read().decode('utf-8'))
-            
-            if not requisites_data.get('result'):
-                return {'success': True, 'cleaned_count': 0, 'message': 'No requisites found'}
-            
-            requisites = requisites_data['result']
+        if not requisites:
+            return {'success': True, 'cleaned_count': 0, 'orphans': [], 'message': 'No requisites found'}
         
-        # 2. Получаем активные компании с таким ИНН
-        active_companies_result = find_duplicate_companies_by_inn(inn)
-        active_company_ids = set()
-        if active_companies_result.get('success') and active_companies_result.get('companies'):
-            active_company_ids = {str(c['ID']) for c in active_companies_result['companies']}
+        # 2. Проверяем существование всех привязанных компаний одним списочным запросом
+        entity_ids = list(dict.fromkeys(str(req.get('ENTITY_ID')) for req in requisites if req.get('ENTITY_ID')))
+        active_company_ids = {c['ID'] for c in verify_companies_exist(entity_ids)}
         
-        # 3. Удаляем реквизиты, не привязанные к активным компаниям
-        for req in requisites:
-            entity_id = str(req.get('ENTITY_ID', ''))
-            
-            # Если компания не существует - удаляем реквизит
-            if entity_id not in active_company_ids:
-                req_id = req.get('ID')
-                print(f"[DEBUG] Deleting orphaned requisite {req_id} (company {entity_id} not found)")
-                
-                delete_url = f"{bitrix_webhook.rstrip('/')}/crm.requisite.delete.json"
-                delete_data = urllib.parse.urlencode({'id': req_id}).encode('utf-8')
-                delete_req = urllib.request.Request(delete_url, data=delete_data)
-                
-                try:
-                    with urllib.request.urlopen(delete_req, timeout=10) as delete_response:
-                        delete_result = json.loads(delete_response.read().decode('utf-8'))
-                        if delete_result.get('result'):
-                            cleaned_count += 1
-                            print(f"[DEBUG] Successfully deleted requisite {req_id}")
-                except Exception as e:
-                    print(f"[ERROR] Failed to delete requisite {req_id}: {e}")
+        # 3. План: реквизиты, чья компания не существует
+        orphans = [
+            {'requisite_id': str(req.get('ID')), 'company_id': str(req.get('ENTITY_ID', ''))}
+            for req in requisites
+            if str(req.get('ENTITY_ID', '')) not in active_company_ids
+        ]
+        print(f"[DEBUG] Orphaned requisites for INN {inn}: {orphans}")
+        
+        if dry_run or not orphans:
+            return {'success': True, 'cleaned_count': 0, 'orphans': orphans, 'dry_run': dry_run}
+        
+        # 4. Удаляем пачками
+        commands = {
+            f'delete_{idx}': build_batch_command('crm.requisite.delete', {'id': orphan['requisite_id']})
+            for idx, orphan in enumerate(orphans)
+        }
+        batch_result = call_bitrix_batch_chunked(commands)
+        
+        failed = []
+        for idx, orphan in enumerate(orphans):
+            key = f'delete_{idx}'
+            if batch_result['result'].get(key):
+                cleaned_count += 1
+                print(f"[DEBUG] Successfully deleted requisite {orphan['requisite_id']}")
+            else:
+                error = batch_result['result_error'].get(key) or {}
+                error_msg = error.get('error_description', error.get('error', 'Batch request failed'))
+                failed.append({'requisite_id': orphan['requisite_id'], 'error': error_msg})
+                print(f"[ERROR] Failed to delete requisite {orphan['requisite_id']}: {error_msg}")
         
         return {
             'success': True,
             'cleaned_count': cleaned_count,
+            'orphans': orphans,
+            'failed': failed,
             'message': f'Cleaned {cleaned_count} orphaned requisites'
         }
     
@@ -1123,28 +1947,51 @@ def clean_orphaned_requisites(inn: str) -> Dict[str, Any]:
 def delete_multiple_companies(company_ids: List[str]) -> Dict[str, Any]:
     '''
     Безопасное удаление нескольких компаний из Битрикс24 по списку ID
+    Удаляет пачками batch по 50 команд; если пачка не прошла целиком - добивает её
+    ограниченным пулом потоков поверх общего лимита запросов портала.
     Возвращает детальную информацию о результатах удаления
     '''
     deleted = []
     failed = []
     
+    company_ids = list(dict.fromkeys(str(company_id) for company_id in company_ids))
     print(f"[DEBUG] Starting bulk delete for {len(company_ids)} companies: {company_ids}")
     
-    for company_id in company_ids:
-        print(f"[DEBUG] Attempting to delete company {company_id}")
-        result = delete_bitrix_company(company_id)
-        
-        if result.get('success'):
+    commands = {
+        f'delete_{idx}': build_batch_command('crm.company.delete', {'ID': company_id})
+        for idx, company_id in enumerate(company_ids)
+    }
+    batch_result = call_bitrix_batch_chunked(commands)
+    failed_keys = set(batch_result['failed_keys'])
+    
+    fallback_ids = []
+    for idx, company_id in enumerate(company_ids):
+        key = f'delete_{idx}'
+        if key in failed_keys:
+            fallback_ids.append(company_id)
+        elif batch_result['result'].get(key):
             deleted.append(company_id)
-            print(f"[DEBUG] Successfully deleted company {company_id}")
         else:
-            error_msg = result.get('error', 'Unknown error')
+            error = batch_result['result_error'].get(key) or {}
+            error_msg = error.get('error_description', error.get('error', 'Unknown error'))
             failed.append({
                 'company_id': company_id,
                 'error': error_msg
             })
             print(f"[DEBUG] Failed to delete company {company_id}: {error_msg}")
     
+    if fallback_ids:
+        print(f"[DEBUG] Deleting {len(fallback_ids)} companies one by one with {DELETE_WORKERS} workers")
+        with ThreadPoolExecutor(max_workers=max(1, min(DELETE_WORKERS, len(fallback_ids)))) as pool:
+            for company_id, result in zip(fallback_ids, pool.map(delete_bitrix_company, fallback_ids)):
+                if result.get('success'):
+                    deleted.append(company_id)
+                else:
+                    failed.append({
+                        'company_id': company_id,
+                        'error': result.get('error', 'Unknown error')
+                    })
+    
     print(f"[DEBUG] Bulk delete completed: {len(deleted)} deleted, {len(failed)} failed")
     
     return {
@@ -1155,4 +2002,4 @@ def delete_multiple_companies(company_ids: List[str]) -> Dict[str, Any]:
             'deleted': deleted,
             'failed': failed
         }
-    }
\ No newline at end of file
+    }
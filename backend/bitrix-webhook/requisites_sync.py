@@ -0,0 +1,365 @@
+"""
+Business: Зеркалирует реквизиты всех компаний Битрикс24 в локальный индекс companies (ИНН -> компания)
+Args: CLI - python requisites_sync.py [--reset] [--max-seconds N]
+      HTTP - POST {"action": "sync_requisites", "reset": false, "max_seconds": 25} в bitrix-webhook
+Returns: статистику прогона (строк, строк/сек, водяной знак, завершён ли проход)
+"""
+import argparse
+import json
+import os
+import time
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Optional
+import psycopg2
+from psycopg2.extras import RealDictCursor, execute_values
+
+from index import call_bitrix_method, list_bitrix_all
+
+SYNC_NAME = 'company_requisites'
+PAGE_SIZE = 50
+INN_MAX_LENGTH = 12
+
+def sync_company_requisites(conn, max_seconds: float = 25, reset: bool = False) -> Dict[str, Any]:
+    '''
+    Обходит все реквизиты компаний (ENTITY_TYPE_ID=4) быстрой постраничной выборкой по ID:
+    order[ID]=ASC, filter[>ID]=водяной знак, start=-1 (без подсчёта total на стороне Битрикс24).
+    Каждая страница upsert-ится одним многострочным INSERT, водяной знак фиксируется после каждой страницы,
+    поэтому прерванный прогон продолжается с места остановки. По завершении прохода компании, не встреченные
+    в нём, удаляются из индекса; после этого вызовы выполняют инкрементальный проход по DATE_MODIFY.
+    reset начинает новый полный проход
+    '''
+    cur = conn.cursor(cursor_factory=RealDictCursor)
+
+    if reset:
+        cur.execute(
+            "UPDATE sync_state SET watermark = 0, rows_synced = 0, completed = FALSE, updated_at = CURRENT_TIMESTAMP WHERE sync_name = %s",
+            (SYNC_NAME,)
+        )
+        conn.commit()
+
+    state = load_state(cur)
+    conn.commit()
+    if state['completed']:
+        # Полный проход по ID завершён - дальше только изменённые реквизиты (правки ИНН у существующих)
+        stats = sync_modified_requisites(conn, cur, state, max_seconds)
+        cur.close()
+        return stats
+
+    watermark = int(state['watermark'])
+    start_watermark = watermark
+    started = time.monotonic()
+    pages = 0
+    rows = 0
+    upserted = 0
+    stale_removed = 0
+    completed = False
+    error = None
+
+    print(f"[INFO] Requisites sync started from watermark {watermark}")
+
+    try:
+        while time.monotonic() - started < max_seconds:
+            result = call_bitrix_method('crm.requisite.list', {
+                'order[ID]': 'ASC',
+                'filter[>ID]': watermark,
+                'filter[ENTITY_TYPE_ID]': '4',  # 4 = Company
+                'select[]': ['ID', 'ENTITY_ID', 'RQ_INN', 'RQ_COMPANY_NAME', 'RQ_NAME'],
+                'start': -1
+            })
+
+            if 'error' in result:
+                raise RuntimeError(result.get('error_description', result.get('error')))
+
+            requisites = result.get('result') or []
+            if requisites:
+                upserted += upsert_requisites_page(cur, requisites, state['pass_started_at'])
+                watermark = max(int(req['ID']) for req in requisites)
+                rows += len(requisites)
+                pages += 1
+
+            completed = len(requisites) < PAGE_SIZE
+            save_watermark(cur, watermark, len(requisites), completed)
+            if completed:
+                stale_removed = finish_full_pass(cur)
+            conn.commit()
+
+            elapsed = time.monotonic() - started
+            print(f"[INFO] Page {pages}: watermark {watermark}, {rows} rows, {rows / elapsed if elapsed else 0:.1f} rows/s")
+
+            if completed:
+                break
+
+    except Exception as e:
+        conn.rollback()
+        error = str(e)
+        print(f"[ERROR] Requisites sync failed at watermark {watermark}: {e}")
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'success': error is None,
+        'sync_name': SYNC_NAME,
+        'start_watermark': start_watermark,
+        'watermark': watermark,
+        'pages': pages,
+        'rows': rows,
+        'companies_upserted': upserted,
+        'stale_companies_removed': stale_removed,
+        'completed': completed,
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else 0
+    }
+    if error:
+        stats['error'] = error
+
+    cur.execute(
+        "UPDATE sync_state SET last_run_stats = %s WHERE sync_name = %s",
+        (json.dumps(stats), SYNC_NAME)
+    )
+    conn.commit()
+    cur.close()
+
+    return stats
+
+def upsert_requisites_page(cur, requisites: List[Dict[str, Any]], pass_started_at: Optional[datetime] = None) -> int:
+    '''
+    Upsert страницы реквизитов в companies одним INSERT ... VALUES (...), (...) ON CONFLICT.
+    У компании с несколькими реквизитами с ИНН в индексе остаётся реквизит с наименьшим ID: внутри страницы
+    реквизиты сортируются по ID, а строка с меньшим requisite_id не перезаписывается реквизитом с большим.
+    pass_started_at (полный проход) разрешает перезапись строк, ещё не встреченных в этом проходе, -
+    их реквизит мог быть удалён в Битрикс24
+    '''
+    rows_by_company = {}
+
+    for req in sorted(requisites, key=lambda r: int(r.get('ID') or 0)):
+        company_id = str(req.get('ENTITY_ID') or '').strip()
+        inn = str(req.get('RQ_INN') or '').strip()
+        if not company_id or not inn or len(inn) > INN_MAX_LENGTH:
+            continue
+        # ON CONFLICT не может обновить одну строку дважды за запрос - берём реквизит с наименьшим ID
+        if company_id not in rows_by_company:
+            title = req.get('RQ_COMPANY_NAME') or req.get('RQ_NAME') or None
+            rows_by_company[company_id] = (company_id, inn, title, int(req['ID']))
+
+    if not rows_by_company:
+        return 0
+
+    replace_condition = "companies.requisite_id IS NULL OR EXCLUDED.requisite_id <= companies.requisite_id"
+    if pass_started_at is not None:
+        replace_condition += cur.mogrify(" OR companies.updated_at < %s::timestamp", (pass_started_at,)).decode('utf-8')
+
+    execute_values(
+        cur,
+        f"""INSERT INTO companies (bitrix_id, inn, title, requisite_id) VALUES %s
+           ON CONFLICT (bitrix_id) DO UPDATE SET
+               inn = CASE WHEN {replace_condition} THEN EXCLUDED.inn ELSE companies.inn END,
+               requisite_id = CASE WHEN {replace_condition} THEN EXCLUDED.requisite_id ELSE companies.requisite_id END,
+               title = COALESCE(companies.title, EXCLUDED.title),
+               updated_at = CURRENT_TIMESTAMP""",
+        list(rows_by_company.values()),
+        page_size=PAGE_SIZE
+    )
+
+    return len(rows_by_company)
+
+def load_state(cur) -> Dict[str, Any]:
+    '''Строка sync_state; начало полного прохода (watermark = 0) фиксирует pass_started_at'''
+    cur.execute(
+        "INSERT INTO sync_state (sync_name) VALUES (%s) ON CONFLICT (sync_name) DO NOTHING",
+        (SYNC_NAME,)
+    )
+    cur.execute(
+        """UPDATE sync_state SET pass_started_at = CURRENT_TIMESTAMP
+           WHERE sync_name = %s AND watermark = 0 AND NOT completed""",
+        (SYNC_NAME,)
+    )
+    cur.execute(
+        "SELECT watermark, completed, pass_started_at, modified_since FROM sync_state WHERE sync_name = %s",
+        (SYNC_NAME,)
+    )
+    return cur.fetchone()
+
+def finish_full_pass(cur) -> int:
+    '''
+    Завершение полного прохода: компании, не встреченные в нём (реквизит или компания удалены в Битрикс24),
+    убираются из индекса; инкрементальный проход по DATE_MODIFY стартует с начала полного прохода
+    '''
+    cur.execute(
+        """DELETE FROM companies c
+           USING sync_state s
+           WHERE s.sync_name = %s AND s.pass_started_at IS NOT NULL
+             AND COALESCE(c.updated_at, c.created_at) < s.pass_started_at::timestamp
+             AND (c.last_checked_at IS NULL OR c.last_checked_at < s.pass_started_at)""",
+        (SYNC_NAME,)
+    )
+    removed = cur.rowcount
+    cur.execute(
+        "UPDATE sync_state SET modified_since = pass_started_at WHERE sync_name = %s",
+        (SYNC_NAME,)
+    )
+    print(f"[INFO] Full requisites pass completed, {removed} stale companies removed from local index")
+    return removed
+
+def sync_modified_requisites(conn, cur, state: Dict[str, Any], max_seconds: float) -> Dict[str, Any]:
+    '''
+    Инкрементальный проход: реквизиты с DATE_MODIFY не раньше modified_since (обычная постраничная выборка -
+    изменений немного). Граница включается (>=): правки, сохранённые в ту же секунду, что и последняя
+    забранная, не теряются, а повторно забранные строки безвредны - upsert идемпотентен.
+    Реквизит без ИНН снимает ИНН компании из индекса. Отметка modified_since сдвигается только после
+    полного окна, поэтому прерванный прогон повторяет окно
+    '''
+    since: datetime = state['modified_since'] or state['pass_started_at'] or datetime.now(timezone.utc) - timedelta(days=1)
+    newest = since
+    started = time.monotonic()
+    start = 0
+    pages = 0
+    rows = 0
+    upserted = 0
+    cleared = 0
+    window_completed = False
+    error = None
+
+    print(f"[INFO] Incremental requisites sync of changes since {since.isoformat()}")
+
+    try:
+        while time.monotonic() - started < max_seconds:
+            result = call_bitrix_method('crm.requisite.list', {
+                'order[DATE_MODIFY]': 'ASC',
+                'order[ID]': 'ASC',
+                'filter[>=DATE_MODIFY]': since.isoformat(),
+                'filter[ENTITY_TYPE_ID]': '4',  # 4 = Company
+                'select[]': ['ID', 'ENTITY_ID', 'RQ_INN', 'RQ_COMPANY_NAME', 'RQ_NAME', 'DATE_MODIFY'],
+                'start': start
+            })
+
+            if 'error' in result:
+                raise RuntimeError(result.get('error_description', result.get('error')))
+
+            requisites = result.get('result') or []
+            upserted += upsert_requisites_page(cur, requisites)
+            cleared += clear_removed_inns(cur, requisites)
+            conn.commit()
+
+            rows += len(requisites)
+            pages += 1
+            for req in requisites:
+                modified = parse_bitrix_datetime(req.get('DATE_MODIFY'))
+                if modified and modified > newest:
+                    newest = modified
+
+            if 'next' not in result:
+                window_completed = True
+                break
+            start = result['next']
+
+        if window_completed:
+            cur.execute(
+                "UPDATE sync_state SET modified_since = %s, updated_at = CURRENT_TIMESTAMP WHERE sync_name = %s",
+                (newest, SYNC_NAME)
+            )
+            conn.commit()
+
+    except Exception as e:
+        conn.rollback()
+        error = str(e)
+        print(f"[ERROR] Incremental requisites sync failed: {e}")
+
+    elapsed = time.monotonic() - started
+    stats = {
+        'success': error is None,
+        'sync_name': SYNC_NAME,
+        'mode': 'incremental',
+        'modified_since': since.isoformat(),
+        'watermark': int(state['watermark']),
+        'pages': pages,
+        'rows': rows,
+        'companies_upserted': upserted,
+        'inns_cleared': cleared,
+        'completed': window_completed,
+        'elapsed_seconds': round(elapsed, 2),
+        'rows_per_second': round(rows / elapsed, 1) if elapsed else 0
+    }
+    if error:
+        stats['error'] = error
+
+    cur.execute(
+        "UPDATE sync_state SET last_run_stats = %s WHERE sync_name = %s",
+        (json.dumps(stats), SYNC_NAME)
+    )
+    conn.commit()
+    return stats
+
+def clear_removed_inns(cur, requisites: List[Dict[str, Any]]) -> int:
+    '''
+    Изменённый реквизит без ИНН ещё не значит, что ИНН у компании не осталось: по таким компаниям одним
+    crm.requisite.list (filter[ENTITY_ID], непустой RQ_INN) перечитываются оставшиеся реквизиты с ИНН.
+    Компании с ними переводятся на реквизит с наименьшим ID, остальные убираются из индекса
+    '''
+    candidate_ids = sorted({
+        str(req.get('ENTITY_ID')) for req in requisites
+        if req.get('ENTITY_ID') and not str(req.get('RQ_INN') or '').strip()
+    })
+    if not candidate_ids:
+        return 0
+
+    remaining = list_bitrix_all('crm.requisite.list', {
+        'order[ID]': 'ASC',
+        'filter[ENTITY_TYPE_ID]': '4',  # 4 = Company
+        'filter[ENTITY_ID][]': candidate_ids,
+        'filter[!RQ_INN]': '',
+        'select[]': ['ID', 'ENTITY_ID', 'RQ_INN']
+    })
+
+    rows_by_company = {}
+    for req in sorted(remaining, key=lambda r: int(r.get('ID') or 0)):
+        company_id = str(req.get('ENTITY_ID') or '').strip()
+        inn = str(req.get('RQ_INN') or '').strip()
+        if company_id in candidate_ids and inn and len(inn) <= INN_MAX_LENGTH and company_id not in rows_by_company:
+            rows_by_company[company_id] = (company_id, inn, int(req['ID']))
+
+    if rows_by_company:
+        execute_values(
+            cur,
+            """UPDATE companies c
+               SET inn = v.inn, requisite_id = v.requisite_id, updated_at = CURRENT_TIMESTAMP
+               FROM (VALUES %s) AS v (bitrix_id, inn, requisite_id)
+               WHERE c.bitrix_id = v.bitrix_id""",
+            list(rows_by_company.values()),
+            page_size=PAGE_SIZE
+        )
+
+    without_inn = [company_id for company_id in candidate_ids if company_id not in rows_by_company]
+    if not without_inn:
+        return 0
+    cur.execute("DELETE FROM companies WHERE bitrix_id = ANY(%s)", (without_inn,))
+    return cur.rowcount
+
+def parse_bitrix_datetime(value: Optional[str]) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+def save_watermark(cur, watermark: int, page_rows: int, completed: bool):
+    cur.execute(
+        """UPDATE sync_state
+           SET watermark = %s, rows_synced = rows_synced + %s, completed = %s, updated_at = CURRENT_TIMESTAMP
+           WHERE sync_name = %s""",
+        (watermark, page_rows, completed, SYNC_NAME)
+    )
+
+def main():
+    parser = argparse.ArgumentParser(description='Синхронизация реквизитов компаний Битрикс24 в таблицу companies')
+    parser.add_argument('--reset', action='store_true', help='начать полный проход с ID=0')
+    parser.add_argument('--max-seconds', type=float, default=24 * 3600, help='ограничение времени прогона')
+    args = parser.parse_args()
+
+    conn = psycopg2.connect(os.environ['DATABASE_URL'])
+    try:
+        stats = sync_company_requisites(conn, max_seconds=args.max_seconds, reset=args.reset)
+    finally:
+        conn.close()
+
+    print(json.dumps(stats, ensure_ascii=False, indent=2))
+
+if __name__ == '__main__':
+    main()
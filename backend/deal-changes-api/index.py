@@ -1,14 +1,28 @@
 """
 Business: Получение истории изменений сделок из базы данных
-Args: event с queryStringParameters (limit, offset, search)
-Returns: JSON с массивом изменений сделок
+Args: event с queryStringParameters (limit, cursor, q, FIELD=value, deal_id, event_type, modifier_user_id, stage, date_from, date_to)
+Returns: JSON с массивом изменений сделок и next_cursor следующей страницы
 """
+import base64
 import json
 import os
-from typing import Dict, Any
+import re
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Tuple
 import psycopg2
 from psycopg2.extras import RealDictCursor
 
+# Параметры в верхнем регистре (TITLE, COMPANY_ID, UF_CRM_...) - фильтры по полям сделки в deal_data.
+# Записи-diff хранят только ключевые поля сделки, по остальным полям совпадут лишь полные снимки
+DEAL_FIELD_PARAM = re.compile(r'^[A-Z][A-Z0-9_]*$')
+
+CHANGES_PAGE_SIZE = 50
+CHANGES_MAX_PAGE_SIZE = 500
+
+# Колонки списка изменений; порядок истории - (event_ts, id), см. V0026
+CHANGE_LIST_COLUMNS = """id, deal_id, event_type, deal_data, timestamp_received, event_ts,
+    modifier_user_id, modifier_user_name, previous_stage, current_stage, changes_summary, is_snapshot"""
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'GET')
     
@@ -32,10 +46,15 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         }
     
     params = event.get('queryStringParameters') or {}
-    limit = int(params.get('limit', '50'))
-    offset = int(params.get('offset', '0'))
-    search = params.get('search', '')
     deal_id = params.get('deal_id', '')
+    try:
+        limit = parse_limit(params)
+    except ValueError as e:
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': str(e)}, ensure_ascii=False)
+        }
     
     dsn = os.environ.get('DATABASE_URL')
     if not dsn:
@@ -48,27 +67,87 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     conn = psycopg2.connect(dsn)
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    query = """
-        SELECT 
-            id, deal_id, event_type, deal_data, timestamp_received,
-            modifier_user_id, modifier_user_name, 
-            previous_stage, current_stage, changes_summary
-        FROM deal_changes 
-        WHERE 1=1
-    """
-    query_params = []
-    
-    if deal_id:
-        query += f" AND deal_id = '{deal_id}'"
-    
-    if search:
-        search_escaped = search.replace("'", "''")
-        query += f" AND (deal_id LIKE '%{search_escaped}%' OR deal_data::text LIKE '%{search_escaped}%' OR modifier_user_name LIKE '%{search_escaped}%')"
+    # Текущее состояние сделки (или последних изменённых сделок) из deal_current_state
+    if params.get('action') == 'current_state':
+        if deal_id:
+            cursor.execute("SELECT * FROM deal_current_state WHERE deal_id = %s", (deal_id,))
+        else:
+            cursor.execute("SELECT * FROM deal_current_state ORDER BY updated_at DESC LIMIT %s", (limit,))
+        states = [serialize_current_state(row) for row in cursor.fetchall()]
+        
+        cursor.close()
+        conn.close()
+        
+        if deal_id and not states:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': False, 'error': 'Deal state not found'})
+            }
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({
+                'success': True,
+                'states': states,
+                'count': len(states)
+            })
+        }
     
-    query += f" ORDER BY timestamp_received DESC LIMIT {limit} OFFSET {offset}"
+    # Полная версия сделки на момент изменения: ближайший снимок + diff последующих записей
+    if params.get('action') == 'version':
+        change_id = params.get('change_id', '')
+        if not change_id.isdigit():
+            cursor.close()
+            conn.close()
+            return {
+                'statusCode': 400,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': False, 'error': 'change_id required'})
+            }
+        
+        cursor.execute("SELECT reconstruct_deal_version(%s) AS deal_data", (int(change_id),))
+        deal_version = cursor.fetchone()['deal_data']
+        
+        cursor.close()
+        conn.close()
+        
+        if deal_version is None:
+            return {
+                'statusCode': 404,
+                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+                'body': json.dumps({'success': False, 'error': 'Version not found'})
+            }
+        
+        return {
+            'statusCode': 200,
+            'headers': {
+                'Content-Type': 'application/json',
+                'Access-Control-Allow-Origin': '*'
+            },
+            'isBase64Encoded': False,
+            'body': json.dumps({
+                'success': True,
+                'change_id': int(change_id),
+                'deal_data': deal_version
+            })
+        }
     
-    cursor.execute(query)
-    rows = cursor.fetchall()
+    try:
+        rows, next_cursor = list_deal_changes(cursor, params, limit)
+    except ValueError as e:
+        cursor.close()
+        conn.close()
+        return {
+            'statusCode': 400,
+            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+            'body': json.dumps({'success': False, 'error': str(e)}, ensure_ascii=False)
+        }
     
     cursor.close()
     conn.close()
@@ -81,11 +160,13 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             'event_type': row['event_type'],
             'deal_data': row['deal_data'],
             'timestamp_received': row['timestamp_received'].isoformat() if row['timestamp_received'] else None,
+            'event_ts': row['event_ts'],
             'modifier_user_id': row['modifier_user_id'],
             'modifier_user_name': row['modifier_user_name'],
             'previous_stage': row['previous_stage'],
             'current_stage': row['current_stage'],
-            'changes_summary': row['changes_summary']
+            'changes_summary': row['changes_summary'],
+            'is_snapshot': row['is_snapshot']
         })
     
     return {
@@ -98,6 +179,104 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'body': json.dumps({
             'success': True,
             'changes': changes,
-            'count': len(changes)
+            'count': len(changes),
+            'next_cursor': next_cursor
         })
-    }
\ No newline at end of file
+    }
+
+def parse_limit(params: Dict[str, str]) -> int:
+    '''Размер страницы из limit: целое от 1, не больше CHANGES_MAX_PAGE_SIZE'''
+    raw_limit = str(params.get('limit') or CHANGES_PAGE_SIZE).strip()
+    if not raw_limit.isdigit() or int(raw_limit) <= 0:
+        raise ValueError('limit должен быть целым положительным числом')
+    return min(int(raw_limit), CHANGES_MAX_PAGE_SIZE)
+
+def parse_date_param(params: Dict[str, str], name: str) -> datetime:
+    try:
+        return datetime.fromisoformat(params[name].strip())
+    except ValueError:
+        raise ValueError(f'Некорректная дата {name}, ожидается ISO 8601 (YYYY-MM-DD или YYYY-MM-DDTHH:MM:SS)')
+
+def list_deal_changes(cursor, params: Dict[str, str], limit: int) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+    '''Страница изменений сделок; запрашивается limit + 1 строка, лишняя строка означает наличие следующей страницы'''
+    query, values = build_changes_query(params, limit)
+    cursor.execute(query, values)
+    rows = cursor.fetchall()
+    
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_changes_cursor(rows[-1]['event_ts'], rows[-1]['id'])
+    
+    return rows, next_cursor
+
+def build_changes_query(params: Dict[str, str], limit: int) -> Tuple[str, List[Any]]:
+    '''
+    Параметризованный запрос страницы deal_changes с keyset-пагинацией по (event_ts, id) вместо OFFSET.
+    Фильтры: deal_id, event_type, modifier_user_id, stage (текущая стадия), date_from / date_to (время события),
+    q - подстрока в search_text (индекс pg_trgm), FIELD=value - точное совпадение полей deal_data (jsonb_path_ops);
+    cursor - из next_cursor прошлой страницы. Некорректные даты и cursor - ValueError
+    '''
+    conditions = []
+    values: List[Any] = []
+    
+    if params.get('deal_id'):
+        conditions.append("deal_id = %s")
+        values.append(params['deal_id'].strip())
+    if params.get('event_type'):
+        conditions.append("event_type = %s")
+        values.append(params['event_type'])
+    if params.get('modifier_user_id'):
+        conditions.append("modifier_user_id = %s")
+        values.append(params['modifier_user_id'].strip())
+    if params.get('stage'):
+        conditions.append("current_stage = %s")
+        values.append(params['stage'])
+    if params.get('date_from'):
+        conditions.append("event_ts >= EXTRACT(EPOCH FROM %s::timestamptz)::bigint")
+        values.append(parse_date_param(params, 'date_from'))
+    if params.get('date_to'):
+        conditions.append("event_ts < EXTRACT(EPOCH FROM %s::timestamptz)::bigint")
+        values.append(parse_date_param(params, 'date_to'))
+    # search - прежнее имя параметра q
+    search = (params.get('q') or params.get('search') or '').strip().lower()
+    if search:
+        pattern = '%' + search.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+        conditions.append("search_text LIKE %s")
+        values.append(pattern)
+    field_filters = {key: value for key, value in params.items() if DEAL_FIELD_PARAM.match(key)}
+    if field_filters:
+        conditions.append("deal_data @> %s::jsonb")
+        values.append(json.dumps(field_filters, ensure_ascii=False))
+    if params.get('cursor'):
+        cursor_event_ts, cursor_id = decode_changes_cursor(params['cursor'])
+        conditions.append("(event_ts, id) < (%s, %s)")
+        values.extend([cursor_event_ts, cursor_id])
+    
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    query = f"SELECT {CHANGE_LIST_COLUMNS} FROM deal_changes {where} ORDER BY event_ts DESC, id DESC LIMIT %s"
+    return query, values + [limit + 1]
+
+def encode_changes_cursor(event_ts: int, change_id: int) -> str:
+    raw = json.dumps([event_ts, change_id])
+    return base64.urlsafe_b64encode(raw.encode('utf-8')).decode('ascii')
+
+def decode_changes_cursor(cursor: str) -> Tuple[int, int]:
+    try:
+        event_ts, change_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        return int(event_ts), int(change_id)
+    except Exception:
+        raise ValueError('Некорректный cursor')
+
+def serialize_current_state(row: Dict[str, Any]) -> Dict[str, Any]:
+    return {
+        'deal_id': row['deal_id'],
+        'last_change_id': row['last_change_id'],
+        'deal_data': row['deal_data'],
+        'current_stage': row['current_stage'],
+        'event_type': row['event_type'],
+        'modifier_user_id': row['modifier_user_id'],
+        'modifier_user_name': row['modifier_user_name'],
+        'timestamp_bitrix': row['timestamp_bitrix'],
+        'updated_at': row['updated_at'].isoformat() if row['updated_at'] else None
+    }
@@ -1,16 +1,19 @@
 """
-Business: Обогащает записи изменений сделок именами пользователей из Битрикс24
-Args: event с queryStringParameters (limit для количества записей)
+Business: Обогащает записи изменений сделок именами пользователей из справочника bitrix_users (синхронизируется с Битрикс24)
+Args: event с queryStringParameters (limit - число пользователей для обогащения, refresh=1 - обновить справочник)
 Returns: JSON с количеством обновлённых записей
 """
 import json
 import os
 from typing import Dict, Any
 import psycopg2
-from psycopg2.extras import RealDictCursor
+from psycopg2.extras import RealDictCursor, execute_values
 import urllib.request
 import urllib.parse
 
+USER_TTL_SECONDS = int(os.environ.get('BITRIX_USERS_TTL_SECONDS', '86400'))
+USER_SYNC_MAX_PAGES = 200
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     method = event.get('httpMethod', 'POST')
     
@@ -59,75 +62,56 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     conn = psycopg2.connect(dsn)
     cursor = conn.cursor(cursor_factory=RealDictCursor)
     
-    # Находим записи без имён пользователей
-    cursor.execute(f"""
-        SELECT DISTINCT modifier_user_id 
-        FROM deal_changes 
-        WHERE modifier_user_id IS NOT NULL 
-        AND modifier_user_id != '' 
-        AND (modifier_user_name IS NULL OR modifier_user_name = '' OR modifier_user_name LIKE 'Пользователь #%')
-        LIMIT {limit}
-    """)
-    
-    rows = cursor.fetchall()
-    user_ids = [row['modifier_user_id'] for row in rows]
-    
-    if not user_ids:
-        cursor.close()
-        conn.close()
-        return {
-            'statusCode': 200,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({
-                'success': True,
-                'message': 'Нет записей для обогащения',
-                'updated': 0
-            }),
-            'isBase64Encoded': False
-        }
-    
-    # Получаем данные пользователей из Битрикс24
-    updated_count = 0
-    user_cache = {}
+    # Справочник bitrix_users обновляем целиком постраничным user.get, если он устарел или запрошено refresh=1.
+    # Строки с отметкой неудачного user.get (заглушки трекера) в свежести справочника не участвуют
+    force_refresh = params.get('refresh', '') in ('1', 'true')
+    cursor.execute(
+        """SELECT COUNT(*) AS cnt,
+                  MIN(fetched_at) FILTER (WHERE lookup_failed_at IS NULL) > now() - make_interval(secs => %s) AS fresh
+           FROM bitrix_users""",
+        (USER_TTL_SECONDS,)
+    )
+    directory = cursor.fetchone()
     
-    for user_id in user_ids:
-        if user_id in user_cache:
-            continue
-            
+    users_synced = 0
+    if force_refresh or not directory['cnt'] or not directory['fresh']:
         try:
-            user_url = f"{webhook_url}user.get.json"
-            user_params = urllib.parse.urlencode({'ID': user_id})
-            user_req = urllib.request.Request(f"{user_url}?{user_params}")
-            
-            with urllib.request.urlopen(user_req, timeout=5) as user_response:
-                user_data = json.loads(user_response.read().decode('utf-8'))
-            
-            if user_data.get('result') and len(user_data['result']) > 0:
-                user = user_data['result'][0]
-                user_name = f"{user.get('NAME', '')} {user.get('LAST_NAME', '')}".strip()
-                
-                if user_name:
-                    user_cache[user_id] = user_name
-                    
-                    # Обновляем все записи этого пользователя
-                    cursor.execute("""
-                        UPDATE deal_changes 
-                        SET modifier_user_name = %s 
-                        WHERE modifier_user_id = %s 
-                        AND (modifier_user_name IS NULL OR modifier_user_name = '' OR modifier_user_name LIKE 'Пользователь #%%')
-                    """, (user_name, user_id))
-                    
-                    updated_count += cursor.rowcount
-                    print(f"[INFO] Обновлено {cursor.rowcount} записей для пользователя {user_name}")
-        
+            users_synced = sync_bitrix_users(cursor, webhook_url)
+            conn.commit()
         except Exception as e:
-            print(f"[WARN] Не удалось получить данные пользователя {user_id}: {e}")
-            continue
+            conn.rollback()
+            print(f"[WARN] Не удалось обновить справочник пользователей: {e}")
+    
+    # Проставляем имена одним UPDATE по справочнику вместо user.get на каждого пользователя
+    cursor.execute("""
+        WITH targets AS (
+            SELECT DISTINCT modifier_user_id
+            FROM deal_changes
+            WHERE modifier_user_id IS NOT NULL
+            AND modifier_user_id != ''
+            AND (modifier_user_name IS NULL OR modifier_user_name = '' OR modifier_user_name LIKE 'Пользователь #%%')
+            LIMIT %s
+        )
+        UPDATE deal_changes dc
+        SET modifier_user_name = u.full_name
+        FROM bitrix_users u
+        WHERE u.user_id = dc.modifier_user_id
+        AND dc.modifier_user_id IN (SELECT modifier_user_id FROM targets)
+        AND u.full_name != ''
+        AND (dc.modifier_user_name IS NULL OR dc.modifier_user_name = '' OR dc.modifier_user_name LIKE 'Пользователь #%%')
+        RETURNING dc.modifier_user_id, u.full_name
+    """, (limit,))
+    
+    updated_rows = cursor.fetchall()
+    updated_count = len(updated_rows)
+    user_names = sorted({row['full_name'] for row in updated_rows})
     
     conn.commit()
     cursor.close()
     conn.close()
     
+    print(f"[INFO] Обновлено {updated_count} записей, пользователей в справочнике обновлено: {users_synced}")
+    
     return {
         'statusCode': 200,
         'headers': {
@@ -137,9 +121,51 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
         'isBase64Encoded': False,
         'body': json.dumps({
             'success': True,
-            'message': f'Обновлено {updated_count} записей',
+            'message': f'Обновлено {updated_count} записей' if updated_count else 'Нет записей для обогащения',
             'updated': updated_count,
-            'users_processed': len(user_cache),
-            'user_names': list(user_cache.values())
+            'users_processed': len(user_names),
+            'users_synced': users_synced,
+            'user_names': user_names
         }, ensure_ascii=False)
     }
+
+def sync_bitrix_users(cursor, webhook_url: str) -> int:
+    '''Загружает всех пользователей портала постранично (user.get по 50, start/next) и upsert-ит их в bitrix_users'''
+    users = []
+    start = 0
+    
+    for _ in range(USER_SYNC_MAX_PAGES):
+        user_params = urllib.parse.urlencode({'start': start})
+        user_req = urllib.request.Request(f"{webhook_url}user.get.json?{user_params}")
+        
+        with urllib.request.urlopen(user_req, timeout=10) as user_response:
+            user_data = json.loads(user_response.read().decode('utf-8'))
+        
+        if 'error' in user_data:
+            raise RuntimeError(user_data.get('error_description', user_data.get('error')))
+        
+        users.extend(user_data.get('result') or [])
+        
+        if user_data.get('next') is None:
+            break
+        start = user_data['next']
+    
+    rows = []
+    for user in users:
+        full_name = f"{user.get('NAME', '') or ''} {user.get('LAST_NAME', '') or ''}".strip()
+        rows.append((str(user.get('ID')), user.get('NAME', ''), user.get('LAST_NAME', ''), full_name, user.get('ACTIVE', True) in (True, 'Y')))
+    
+    if rows:
+        execute_values(
+            cursor,
+            """INSERT INTO bitrix_users (user_id, name, last_name, full_name, active, fetched_at) VALUES %s
+               ON CONFLICT (user_id) DO UPDATE SET
+                   name = EXCLUDED.name, last_name = EXCLUDED.last_name, full_name = EXCLUDED.full_name,
+                   active = EXCLUDED.active, fetched_at = EXCLUDED.fetched_at, lookup_failed_at = NULL""",
+            rows,
+            template='(%s, %s, %s, %s, %s, now())',
+            page_size=500
+        )
+    
+    print(f"[INFO] Справочник пользователей обновлён: {len(rows)} пользователей")
+    return len(rows)
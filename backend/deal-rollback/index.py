@@ -65,7 +65,7 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             conn = psycopg2.connect(db_dsn)
             cur = conn.cursor()
             cur.execute(
-                "SELECT deal_data FROM t_p8980362_bitrix_webhook_handl.deal_changes WHERE deal_id = %s ORDER BY id DESC LIMIT 1",
+                "SELECT deal_data FROM t_p8980362_bitrix_webhook_handl.deal_current_state WHERE deal_id = %s",
                 (deal_id,)
             )
             row = cur.fetchone()
@@ -7,6 +7,9 @@ import psycopg2
 from psycopg2.extras import RealDictCursor
 from datetime import datetime
 
+LOG_RETENTION_MONTHS = int(os.environ.get('LOG_RETENTION_MONTHS', '6'))
+LOG_PARTITIONS_AHEAD_MONTHS = 2
+
 def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
     '''
     Business: Обрабатывает закупки из Битрикс24 - получает товары по сделке, создаёт закупки в ЦРМ Обеспечение, логирует вебхуки
@@ -188,13 +191,35 @@ def handler(event: Dict[str, Any], context: Any) -> Dict[str, Any]:
             action = query_params.get('action', '')
             
             if action == 'clear_webhooks':
-                cur.execute('DELETE FROM purchase_webhooks')
-                deleted = cur.rowcount
+                cur.execute('SELECT COUNT(*) AS cnt FROM purchase_webhooks')
+                deleted = cur.fetchone()['cnt']
+                # TRUNCATE очищает все месячные секции без построчного удаления
+                cur.execute('TRUNCATE purchase_webhooks')
                 conn.commit()
                 return response_json(200, {
                     'success': True,
                     'message': f'Удалено записей: {deleted}'
                 })
+
+            if action == 'apply_retention':
+                keep_months_param = str(query_params.get('keep_months') or LOG_RETENTION_MONTHS)
+                if not keep_months_param.isdigit() or int(keep_months_param) < 1:
+                    return response_json(400, {
+                        'success': False,
+                        'error': 'keep_months должен быть целым числом не меньше 1'
+                    })
+                # Общая с bitrix-webhook SQL-функция ротации помесячных секций (V0032)
+                cur.execute(
+                    'SELECT apply_monthly_retention(%s, %s, %s) AS retention',
+                    ('purchase_webhooks', int(keep_months_param), LOG_PARTITIONS_AHEAD_MONTHS)
+                )
+                retention = cur.fetchone()['retention']
+                conn.commit()
+                return response_json(200, {
+                    'success': True,
+                    **retention,
+                    'message': f"Удалено секций: {len(retention['partitions_dropped'])}"
+                })
         
         return response_json(405, {
             'success': False,
@@ -0,0 +1,12 @@
+-- Состояние фоновых синхронизаций с Битрикс24: водяной знак (последний обработанный ID) для возобновления
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.sync_state (
+    sync_name VARCHAR(100) PRIMARY KEY,
+    watermark BIGINT NOT NULL DEFAULT 0,
+    rows_synced BIGINT NOT NULL DEFAULT 0,
+    completed BOOLEAN DEFAULT FALSE,
+    last_run_stats JSONB,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.sync_state IS 'Водяные знаки массовых синхронизаций (реквизиты компаний, сделки)';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.sync_state.watermark IS 'Последний обработанный ID сущности в Битрикс24';
@@ -0,0 +1,18 @@
+-- Журнал восстановления удалённых компаний: позволяет продолжить прерванное восстановление без дублей
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.company_restore_journal (
+    id SERIAL PRIMARY KEY,
+    original_company_id VARCHAR(255) UNIQUE NOT NULL,
+    new_company_id VARCHAR(255),
+    status VARCHAR(50) NOT NULL DEFAULT 'pending',
+    restored_requisite_ids JSONB NOT NULL DEFAULT '[]'::jsonb,
+    restored_deal_ids JSONB NOT NULL DEFAULT '[]'::jsonb,
+    errors JSONB,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.company_restore_journal IS 'Прогресс восстановления компаний из бэкапа';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_restore_journal.status IS 'pending, company_created, partial, completed, failed';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_restore_journal.restored_requisite_ids IS 'ID реквизитов из бэкапа, уже созданных у новой компании';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_restore_journal.restored_deal_ids IS 'ID сделок, уже перепривязанных к новой компании';
@@ -0,0 +1,5 @@
+-- Индексы для курсорной пагинации журнала вебхуков по (created_at, id) и фильтров списка
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_created_at_id ON t_p8980362_bitrix_webhook_handl.webhook_logs(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_status_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(response_status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_type_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(webhook_type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_duplicate_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(created_at DESC, id DESC) WHERE duplicate_found = TRUE;
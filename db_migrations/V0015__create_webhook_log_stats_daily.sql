@@ -0,0 +1,21 @@
+-- Дневные счётчики журнала вебхуков: статистика дашборда без полного сканирования webhook_logs
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.webhook_log_stats_daily (
+    day DATE NOT NULL,
+    response_status VARCHAR(50) NOT NULL DEFAULT '',
+    duplicate_found BOOLEAN NOT NULL DEFAULT FALSE,
+    requests_count BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, response_status, duplicate_found)
+);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.webhook_log_stats_daily IS 'Счётчики запросов по дням и статусам, ведутся при записи в webhook_logs';
+
+-- Заполняем счётчики по уже накопленным логам
+INSERT INTO t_p8980362_bitrix_webhook_handl.webhook_log_stats_daily (day, response_status, duplicate_found, requests_count)
+SELECT
+    COALESCE(created_at, CURRENT_TIMESTAMP)::date,
+    COALESCE(response_status, ''),
+    COALESCE(duplicate_found, FALSE),
+    COUNT(*)
+FROM t_p8980362_bitrix_webhook_handl.webhook_logs
+GROUP BY 1, 2, 3
+ON CONFLICT (day, response_status, duplicate_found) DO UPDATE SET requests_count = EXCLUDED.requests_count;
@@ -0,0 +1,18 @@
+-- Снимки удалённых компаний-дубликатов (поля, реквизиты, сделки) отдельно от журнала вебхуков
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.company_backups (
+    id SERIAL PRIMARY KEY,
+    log_id INTEGER NOT NULL,
+    bitrix_id VARCHAR(255) NOT NULL,
+    inn VARCHAR(12),
+    snapshot BYTEA NOT NULL,
+    snapshot_size INTEGER,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_company_backups_log_id ON t_p8980362_bitrix_webhook_handl.company_backups(log_id);
+CREATE INDEX IF NOT EXISTS idx_company_backups_bitrix_id ON t_p8980362_bitrix_webhook_handl.company_backups(bitrix_id);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.company_backups IS 'Бэкапы компаний, удалённых как дубликаты ИНН';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_backups.log_id IS 'ID записи webhook_logs, в которой зафиксировано удаление';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_backups.snapshot IS 'JSON компании, сжатый zlib';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_backups.snapshot_size IS 'Размер несжатого JSON в байтах';
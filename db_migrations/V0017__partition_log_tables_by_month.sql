@@ -0,0 +1,159 @@
+-- Помесячное секционирование журналов вебхуков (webhook_logs, purchase_webhooks)
+-- Очистка старых данных становится DETACH + DROP секции вместо DELETE по всей таблице
+
+-- Создаёт недостающие месячные секции от from_date до текущего месяца + months_ahead.
+-- Строки нового месяца, успевшие попасть в DEFAULT-секцию, переносятся в созданную секцию
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.ensure_monthly_partitions(parent_table TEXT, from_date DATE, months_ahead INTEGER)
+RETURNS INTEGER
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    schema_name CONSTANT TEXT := 't_p8980362_bitrix_webhook_handl';
+    month_start DATE := date_trunc('month', from_date)::date;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+    month_end DATE;
+    partition_name TEXT;
+    created_count INTEGER := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        month_end := (month_start + INTERVAL '1 month')::date;
+        partition_name := parent_table || '_' || to_char(month_start, 'YYYY_MM');
+
+        IF to_regclass(format('%I.%I', schema_name, partition_name)) IS NULL THEN
+            EXECUTE format('CREATE TABLE %I.%I (LIKE %I.%I INCLUDING DEFAULTS)',
+                schema_name, partition_name, schema_name, parent_table);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM %I.%I WHERE created_at >= %L AND created_at < %L RETURNING *) INSERT INTO %I.%I SELECT * FROM moved',
+                schema_name, parent_table || '_default', month_start, month_end, schema_name, partition_name);
+            EXECUTE format('ALTER TABLE %I.%I ATTACH PARTITION %I.%I FOR VALUES FROM (%L) TO (%L)',
+                schema_name, parent_table, schema_name, partition_name, month_start, month_end);
+            created_count := created_count + 1;
+        END IF;
+
+        month_start := month_end;
+    END LOOP;
+
+    RETURN created_count;
+END;
+$$;
+
+-- Отключает и удаляет месячные секции старше keep_months полных месяцев, возвращает имена удалённых секций
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.drop_expired_monthly_partitions(parent_table TEXT, keep_months INTEGER)
+RETURNS SETOF TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    schema_name CONSTANT TEXT := 't_p8980362_bitrix_webhook_handl';
+    cutoff DATE := (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date;
+    partition_record RECORD;
+BEGIN
+    FOR partition_record IN
+        SELECT child.relname AS partition_name
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_namespace ns ON ns.oid = parent.relnamespace
+        WHERE ns.nspname = schema_name
+          AND parent.relname = parent_table
+          AND child.relname ~ ('^' || parent_table || '_[0-9]{4}_[0-9]{2}$')
+          AND to_date(right(child.relname, 7), 'YYYY_MM') < cutoff
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I.%I DETACH PARTITION %I.%I',
+            schema_name, parent_table, schema_name, partition_record.partition_name);
+        EXECUTE format('DROP TABLE %I.%I', schema_name, partition_record.partition_name);
+        RETURN NEXT partition_record.partition_name;
+    END LOOP;
+END;
+$$;
+
+-- webhook_logs: переносим данные в секционированную таблицу с тем же именем и той же последовательностью id
+ALTER TABLE t_p8980362_bitrix_webhook_handl.webhook_logs RENAME TO webhook_logs_legacy;
+ALTER INDEX t_p8980362_bitrix_webhook_handl.webhook_logs_pkey RENAME TO webhook_logs_legacy_pkey;
+ALTER SEQUENCE t_p8980362_bitrix_webhook_handl.webhook_logs_id_seq OWNED BY NONE;
+
+CREATE TABLE t_p8980362_bitrix_webhook_handl.webhook_logs (
+    id INTEGER NOT NULL DEFAULT nextval('t_p8980362_bitrix_webhook_handl.webhook_logs_id_seq'::regclass),
+    webhook_type VARCHAR(100) NOT NULL,
+    inn VARCHAR(12),
+    bitrix_company_id VARCHAR(255),
+    request_body TEXT,
+    response_status VARCHAR(50),
+    duplicate_found BOOLEAN DEFAULT FALSE,
+    action_taken TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    source_info TEXT DEFAULT '',
+    request_method VARCHAR(10) DEFAULT 'POST',
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE t_p8980362_bitrix_webhook_handl.webhook_logs_default
+    PARTITION OF t_p8980362_bitrix_webhook_handl.webhook_logs DEFAULT;
+
+SELECT t_p8980362_bitrix_webhook_handl.ensure_monthly_partitions(
+    'webhook_logs',
+    (SELECT COALESCE(MIN(created_at), CURRENT_TIMESTAMP)::date FROM t_p8980362_bitrix_webhook_handl.webhook_logs_legacy),
+    3
+);
+
+INSERT INTO t_p8980362_bitrix_webhook_handl.webhook_logs
+    (id, webhook_type, inn, bitrix_company_id, request_body, response_status, duplicate_found, action_taken, created_at, source_info, request_method)
+SELECT id, webhook_type, inn, bitrix_company_id, request_body, response_status, duplicate_found, action_taken,
+       COALESCE(created_at, CURRENT_TIMESTAMP), source_info, request_method
+FROM t_p8980362_bitrix_webhook_handl.webhook_logs_legacy;
+
+DROP TABLE t_p8980362_bitrix_webhook_handl.webhook_logs_legacy;
+ALTER SEQUENCE t_p8980362_bitrix_webhook_handl.webhook_logs_id_seq OWNED BY t_p8980362_bitrix_webhook_handl.webhook_logs.id;
+
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_inn ON t_p8980362_bitrix_webhook_handl.webhook_logs(inn);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_created_at_id ON t_p8980362_bitrix_webhook_handl.webhook_logs(created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_status_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(response_status, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_type_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(webhook_type, created_at DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_webhook_logs_duplicate_created_at ON t_p8980362_bitrix_webhook_handl.webhook_logs(created_at DESC, id DESC) WHERE duplicate_found = TRUE;
+
+-- purchase_webhooks: та же схема переноса
+ALTER TABLE t_p8980362_bitrix_webhook_handl.purchase_webhooks RENAME TO purchase_webhooks_legacy;
+ALTER INDEX t_p8980362_bitrix_webhook_handl.purchase_webhooks_pkey RENAME TO purchase_webhooks_legacy_pkey;
+ALTER SEQUENCE t_p8980362_bitrix_webhook_handl.purchase_webhooks_id_seq OWNED BY NONE;
+
+CREATE TABLE t_p8980362_bitrix_webhook_handl.purchase_webhooks (
+    id INTEGER NOT NULL DEFAULT nextval('t_p8980362_bitrix_webhook_handl.purchase_webhooks_id_seq'::regclass),
+    deal_id VARCHAR(100) NOT NULL,
+    company_id VARCHAR(100),
+    webhook_type VARCHAR(100) DEFAULT 'deal_product_request',
+    products_count INTEGER DEFAULT 0,
+    total_amount DECIMAL(15, 2) DEFAULT 0,
+    request_body TEXT,
+    response_status VARCHAR(50),
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    source_info TEXT,
+    response_message TEXT,
+    purchase_created BOOLEAN DEFAULT false,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE t_p8980362_bitrix_webhook_handl.purchase_webhooks_default
+    PARTITION OF t_p8980362_bitrix_webhook_handl.purchase_webhooks DEFAULT;
+
+SELECT t_p8980362_bitrix_webhook_handl.ensure_monthly_partitions(
+    'purchase_webhooks',
+    (SELECT COALESCE(MIN(created_at), CURRENT_TIMESTAMP)::date FROM t_p8980362_bitrix_webhook_handl.purchase_webhooks_legacy),
+    3
+);
+
+INSERT INTO t_p8980362_bitrix_webhook_handl.purchase_webhooks
+    (id, deal_id, company_id, webhook_type, products_count, total_amount, request_body, response_status, created_at, source_info, response_message, purchase_created)
+SELECT id, deal_id, company_id, webhook_type, products_count, total_amount, request_body, response_status,
+       COALESCE(created_at, CURRENT_TIMESTAMP), source_info, response_message, purchase_created
+FROM t_p8980362_bitrix_webhook_handl.purchase_webhooks_legacy;
+
+DROP TABLE t_p8980362_bitrix_webhook_handl.purchase_webhooks_legacy;
+ALTER SEQUENCE t_p8980362_bitrix_webhook_handl.purchase_webhooks_id_seq OWNED BY t_p8980362_bitrix_webhook_handl.purchase_webhooks.id;
+
+CREATE INDEX IF NOT EXISTS idx_purchase_webhooks_deal_id ON t_p8980362_bitrix_webhook_handl.purchase_webhooks(deal_id);
+CREATE INDEX IF NOT EXISTS idx_webhooks_created_at ON t_p8980362_bitrix_webhook_handl.purchase_webhooks(created_at DESC);
+CREATE INDEX IF NOT EXISTS idx_webhooks_purchase_created ON t_p8980362_bitrix_webhook_handl.purchase_webhooks(purchase_created);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.webhook_logs IS 'Журнал вебхуков проверки ИНН, секционирован по месяцам created_at';
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.purchase_webhooks IS 'Журнал входящих вебхуков по закупкам, секционирован по месяцам created_at';
@@ -0,0 +1,10 @@
+-- Состояние обработки событий по компании: когда данные компании последний раз забирались из Битрикс24.
+-- Используется вместе с pg_advisory_xact_lock для схлопывания пачек ONCRMCOMPANYADD/ONCRMCOMPANYUPDATE
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.company_event_state (
+    bitrix_id VARCHAR(255) PRIMARY KEY,
+    last_fetched_at TIMESTAMPTZ,
+    events_coalesced INTEGER NOT NULL DEFAULT 0
+);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.company_event_state IS 'Последняя проверка компании вебхуком и число схлопнутых повторных событий';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_event_state.last_fetched_at IS 'Момент (clock_timestamp) перед запросом данных компании из Битрикс24';
@@ -0,0 +1,24 @@
+-- Очередь асинхронных проверок компаний: вебхук только ставит задание, check_worker разбирает его
+-- через FOR UPDATE SKIP LOCKED с повторами и экспоненциальной задержкой
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.company_check_jobs (
+    id BIGSERIAL PRIMARY KEY,
+    bitrix_id VARCHAR(255) NOT NULL,
+    request_body JSONB,
+    source_info TEXT,
+    request_method VARCHAR(10) DEFAULT 'POST',
+    status VARCHAR(20) NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    run_after TIMESTAMPTZ NOT NULL DEFAULT now(),
+    locked_at TIMESTAMPTZ,
+    last_status INTEGER,
+    last_error TEXT,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_company_check_jobs_pending ON t_p8980362_bitrix_webhook_handl.company_check_jobs(run_after, id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_company_check_jobs_pending_company ON t_p8980362_bitrix_webhook_handl.company_check_jobs(bitrix_id) WHERE status = 'pending';
+CREATE INDEX IF NOT EXISTS idx_company_check_jobs_running ON t_p8980362_bitrix_webhook_handl.company_check_jobs(locked_at) WHERE status = 'running';
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.company_check_jobs IS 'Очередь проверок компаний на дубликаты ИНН (pending / running / done / dead)';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.company_check_jobs.run_after IS 'Не раньше этого момента - задержка повтора после ошибки';
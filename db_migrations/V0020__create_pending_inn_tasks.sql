@@ -0,0 +1,15 @@
+-- Реестр задач «заполнить ИНН»: по компании без ИНН создаётся не больше одной открытой задачи
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.pending_inn_tasks (
+    company_id VARCHAR(255) PRIMARY KEY,
+    task_id VARCHAR(50) NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'open',
+    task_status INTEGER,
+    created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+    checked_at TIMESTAMPTZ,
+    closed_at TIMESTAMPTZ
+);
+
+CREATE INDEX IF NOT EXISTS idx_pending_inn_tasks_open ON t_p8980362_bitrix_webhook_handl.pending_inn_tasks(task_id) WHERE status = 'open';
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.pending_inn_tasks IS 'Задачи на заполнение ИНН по компаниям (open / closed / resolved)';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.pending_inn_tasks.task_status IS 'Последний известный STATUS задачи в Битрикс24 (5 - завершена, 7 - отклонена)';
@@ -0,0 +1,8 @@
+-- Кэш результата проверки компании: хэш ИНН/КПП реквизитов и последний вердикт
+ALTER TABLE t_p8980362_bitrix_webhook_handl.companies ADD COLUMN IF NOT EXISTS requisites_hash VARCHAR(64);
+ALTER TABLE t_p8980362_bitrix_webhook_handl.companies ADD COLUMN IF NOT EXISTS last_check_status VARCHAR(50);
+ALTER TABLE t_p8980362_bitrix_webhook_handl.companies ADD COLUMN IF NOT EXISTS last_check_result JSONB;
+ALTER TABLE t_p8980362_bitrix_webhook_handl.companies ADD COLUMN IF NOT EXISTS last_checked_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.companies.requisites_hash IS 'sha256 от ИНН компании и пар ИНН/КПП реквизитов на момент последней проверки';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.companies.last_check_result IS 'Ответ последней проверки, возвращается без поиска дубликатов при неизменных реквизитах';
@@ -0,0 +1,11 @@
+-- Локальный справочник пользователей Битрикс24 для имён в истории сделок
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.bitrix_users (
+    user_id VARCHAR(50) PRIMARY KEY,
+    name VARCHAR(255),
+    last_name VARCHAR(255),
+    full_name VARCHAR(512) NOT NULL DEFAULT '',
+    active BOOLEAN DEFAULT TRUE,
+    fetched_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.bitrix_users IS 'Пользователи Битрикс24 (user.get), обновляются по TTL из deal-changes-enrich и по промаху в bitrix-deal-tracker';
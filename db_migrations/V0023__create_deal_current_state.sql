@@ -0,0 +1,29 @@
+-- Текущее состояние каждой сделки: одна строка на сделку, обновляется вместе со вставкой в deal_changes
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.deal_current_state (
+    deal_id VARCHAR(50) PRIMARY KEY,
+    last_change_id INTEGER,
+    deal_data JSONB NOT NULL,
+    current_stage VARCHAR(100),
+    event_type VARCHAR(100),
+    modifier_user_id VARCHAR(50),
+    modifier_user_name VARCHAR(255),
+    timestamp_bitrix BIGINT,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_deal_current_state_updated_at ON t_p8980362_bitrix_webhook_handl.deal_current_state(updated_at DESC);
+
+-- Заполняем из истории: последняя успешно полученная версия каждой сделки
+INSERT INTO t_p8980362_bitrix_webhook_handl.deal_current_state (
+    deal_id, last_change_id, deal_data, current_stage, event_type,
+    modifier_user_id, modifier_user_name, timestamp_bitrix, updated_at
+)
+SELECT DISTINCT ON (deal_id)
+    deal_id, id, deal_data, COALESCE(current_stage, deal_data->>'STAGE_ID'), event_type,
+    modifier_user_id, modifier_user_name, timestamp_bitrix, timestamp_received
+FROM t_p8980362_bitrix_webhook_handl.deal_changes
+WHERE NOT deal_data ? 'error'
+ORDER BY deal_id, timestamp_received DESC, id DESC
+ON CONFLICT (deal_id) DO NOTHING;
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.deal_current_state IS 'Последний снимок и стадия каждой сделки (O(1) вместо поиска последней записи в deal_changes)';
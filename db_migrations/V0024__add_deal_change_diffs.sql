@@ -0,0 +1,60 @@
+-- Компактная история сделок: полный снимок только в части записей, остальные хранят diff полей в changes_summary
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_changes ADD COLUMN IF NOT EXISTS is_snapshot BOOLEAN NOT NULL DEFAULT TRUE;
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_current_state ADD COLUMN IF NOT EXISTS events_since_snapshot INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_deal_changes_snapshots ON t_p8980362_bitrix_webhook_handl.deal_changes(deal_id, id DESC) WHERE is_snapshot;
+
+-- Восстанавливает полные данные сделки на момент записи target_change_id:
+-- ближайший предыдущий снимок + changes_summary.fields / removed всех записей до целевой включительно
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.reconstruct_deal_version(target_change_id INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    target RECORD;
+    base RECORD;
+    change RECORD;
+    field_name TEXT;
+    field_diff JSONB;
+    result JSONB;
+BEGIN
+    SELECT id, deal_id, is_snapshot, deal_data INTO target
+    FROM t_p8980362_bitrix_webhook_handl.deal_changes WHERE id = target_change_id;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    IF target.is_snapshot THEN
+        RETURN target.deal_data;
+    END IF;
+
+    SELECT id, deal_data INTO base
+    FROM t_p8980362_bitrix_webhook_handl.deal_changes
+    WHERE deal_id = target.deal_id AND is_snapshot AND id < target.id
+    ORDER BY id DESC
+    LIMIT 1;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    result := base.deal_data;
+    FOR change IN
+        SELECT changes_summary
+        FROM t_p8980362_bitrix_webhook_handl.deal_changes
+        WHERE deal_id = target.deal_id AND id > base.id AND id <= target.id AND NOT is_snapshot
+          AND changes_summary IS NOT NULL
+        ORDER BY id
+    LOOP
+        FOR field_name, field_diff IN SELECT key, value FROM jsonb_each(COALESCE(change.changes_summary->'fields', '{}'::jsonb)) LOOP
+            result := jsonb_set(result, ARRAY[field_name], COALESCE(field_diff->'to', 'null'::jsonb));
+        END LOOP;
+        FOR field_name IN SELECT jsonb_array_elements_text(COALESCE(change.changes_summary->'removed', '[]'::jsonb)) LOOP
+            result := result - field_name;
+        END LOOP;
+    END LOOP;
+
+    RETURN result;
+END;
+$$;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.deal_changes.is_snapshot IS 'TRUE - deal_data содержит полный снимок; FALSE - только ключевые поля, изменения в changes_summary.fields';
@@ -0,0 +1,16 @@
+-- Сделки, по которым пришли события и которые ещё не забраны из Битрикс24 (режим дебаунса bitrix-deal-tracker)
+CREATE TABLE IF NOT EXISTS t_p8980362_bitrix_webhook_handl.dirty_deals (
+    deal_id VARCHAR(50) PRIMARY KEY,
+    event_type VARCHAR(100) NOT NULL,
+    event_handler_id VARCHAR(50),
+    bitrix_domain VARCHAR(255),
+    member_id VARCHAR(255),
+    timestamp_bitrix BIGINT,
+    events_count INTEGER NOT NULL DEFAULT 1,
+    first_seen_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW(),
+    last_seen_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS idx_dirty_deals_first_seen ON t_p8980362_bitrix_webhook_handl.dirty_deals(first_seen_at);
+
+COMMENT ON TABLE t_p8980362_bitrix_webhook_handl.dirty_deals IS 'Очередь дебаунса: одна строка на сделку независимо от числа событий';
@@ -0,0 +1,79 @@
+-- История сделок упорядочивается по времени события в Битрикс24 (event_ts), а не по времени доставки вебхука
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_changes ADD COLUMN IF NOT EXISTS event_ts BIGINT;
+
+UPDATE t_p8980362_bitrix_webhook_handl.deal_changes
+SET event_ts = COALESCE(timestamp_bitrix, extract(epoch FROM timestamp_received)::bigint)
+WHERE event_ts IS NULL;
+
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_changes ALTER COLUMN event_ts SET DEFAULT extract(epoch FROM now())::bigint;
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_changes ALTER COLUMN event_ts SET NOT NULL;
+
+CREATE INDEX IF NOT EXISTS idx_deal_changes_deal_event_order ON t_p8980362_bitrix_webhook_handl.deal_changes(deal_id, event_ts, id);
+CREATE INDEX IF NOT EXISTS idx_deal_changes_event_order ON t_p8980362_bitrix_webhook_handl.deal_changes(event_ts DESC, id DESC);
+
+DROP INDEX IF EXISTS t_p8980362_bitrix_webhook_handl.idx_deal_changes_snapshots;
+CREATE INDEX IF NOT EXISTS idx_deal_changes_snapshots ON t_p8980362_bitrix_webhook_handl.deal_changes(deal_id, event_ts DESC, id DESC) WHERE is_snapshot;
+
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_current_state ADD COLUMN IF NOT EXISTS event_ts BIGINT;
+
+UPDATE t_p8980362_bitrix_webhook_handl.deal_current_state s
+SET event_ts = c.event_ts
+FROM t_p8980362_bitrix_webhook_handl.deal_changes c
+WHERE c.id = s.last_change_id AND s.event_ts IS NULL;
+
+-- Восстановление версии в порядке (event_ts, id): ближайший предыдущий снимок + diff последующих записей
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.reconstruct_deal_version(target_change_id INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+STABLE
+AS $$
+DECLARE
+    target RECORD;
+    base RECORD;
+    change RECORD;
+    field_name TEXT;
+    field_diff JSONB;
+    result JSONB;
+BEGIN
+    SELECT id, deal_id, event_ts, is_snapshot, deal_data INTO target
+    FROM t_p8980362_bitrix_webhook_handl.deal_changes WHERE id = target_change_id;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+    IF target.is_snapshot THEN
+        RETURN target.deal_data;
+    END IF;
+
+    SELECT id, event_ts, deal_data INTO base
+    FROM t_p8980362_bitrix_webhook_handl.deal_changes
+    WHERE deal_id = target.deal_id AND is_snapshot AND (event_ts, id) < (target.event_ts, target.id)
+    ORDER BY event_ts DESC, id DESC
+    LIMIT 1;
+    IF NOT FOUND THEN
+        RETURN NULL;
+    END IF;
+
+    result := base.deal_data;
+    FOR change IN
+        SELECT changes_summary
+        FROM t_p8980362_bitrix_webhook_handl.deal_changes
+        WHERE deal_id = target.deal_id
+          AND (event_ts, id) > (base.event_ts, base.id)
+          AND (event_ts, id) <= (target.event_ts, target.id)
+          AND NOT is_snapshot
+          AND changes_summary IS NOT NULL
+        ORDER BY event_ts, id
+    LOOP
+        FOR field_name, field_diff IN SELECT key, value FROM jsonb_each(COALESCE(change.changes_summary->'fields', '{}'::jsonb)) LOOP
+            result := jsonb_set(result, ARRAY[field_name], COALESCE(field_diff->'to', 'null'::jsonb));
+        END LOOP;
+        FOR field_name IN SELECT jsonb_array_elements_text(COALESCE(change.changes_summary->'removed', '[]'::jsonb)) LOOP
+            result := result - field_name;
+        END LOOP;
+    END LOOP;
+
+    RETURN result;
+END;
+$$;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.deal_changes.event_ts IS 'Unix-время события (ts из Битрикс24, иначе время приёма) - ключ порядка истории вместе с id';
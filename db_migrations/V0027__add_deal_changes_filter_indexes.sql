@@ -0,0 +1,10 @@
+-- Составные индексы под фильтры deal-changes-api с keyset-пагинацией по (event_ts DESC, id DESC):
+-- фильтр по равенству + порядок страницы читаются одним проходом индекса без сортировки.
+-- deal_id покрыт idx_deal_changes_deal_event_order, диапазон дат и лента без фильтров - idx_deal_changes_event_order (V0026)
+CREATE INDEX IF NOT EXISTS idx_deal_changes_event_type_order ON t_p8980362_bitrix_webhook_handl.deal_changes(event_type, event_ts DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_deal_changes_modifier_order ON t_p8980362_bitrix_webhook_handl.deal_changes(modifier_user_id, event_ts DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_deal_changes_stage_order ON t_p8980362_bitrix_webhook_handl.deal_changes(current_stage, event_ts DESC, id DESC);
+
+-- Одноколоночные индексы перекрыты составными
+DROP INDEX IF EXISTS t_p8980362_bitrix_webhook_handl.idx_deal_changes_event_type;
+DROP INDEX IF EXISTS t_p8980362_bitrix_webhook_handl.idx_deal_changes_modifier;
@@ -0,0 +1,22 @@
+-- Индексированный поиск по истории сделок вместо deal_data::text LIKE '%...%' по всем строкам
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Текст для поиска q: номер сделки, название, компания, контакт, комментарий и автор изменения.
+-- Записи-diff (is_snapshot = FALSE) хранят только ключевые поля, поэтому комментарий берётся и из changes_summary
+ALTER TABLE t_p8980362_bitrix_webhook_handl.deal_changes ADD COLUMN IF NOT EXISTS search_text TEXT GENERATED ALWAYS AS (
+    lower(
+        coalesce(deal_id, '') || ' ' ||
+        coalesce(deal_data->>'TITLE', '') || ' ' ||
+        coalesce(deal_data->>'COMPANY_ID', '') || ' ' ||
+        coalesce(deal_data->>'CONTACT_ID', '') || ' ' ||
+        coalesce(deal_data->>'COMMENTS', changes_summary->'fields'->'COMMENTS'->>'to', '') || ' ' ||
+        coalesce(modifier_user_name, '')
+    )
+) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_deal_changes_search_trgm ON t_p8980362_bitrix_webhook_handl.deal_changes USING gin (search_text gin_trgm_ops);
+
+-- Точные фильтры по полям сделки: deal_data @> '{"COMPANY_ID": "15"}'
+CREATE INDEX IF NOT EXISTS idx_deal_changes_deal_data_path ON t_p8980362_bitrix_webhook_handl.deal_changes USING gin (deal_data jsonb_path_ops);
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.deal_changes.search_text IS 'Нормализованный (lower) текст для поиска q через pg_trgm';
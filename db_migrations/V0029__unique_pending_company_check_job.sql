@@ -0,0 +1,12 @@
+-- Не больше одного ожидающего задания на компанию: постановка в очередь через ON CONFLICT DO NOTHING
+-- вместо гонки INSERT ... WHERE NOT EXISTS при параллельных вебхуках
+UPDATE t_p8980362_bitrix_webhook_handl.company_check_jobs j
+SET status = 'done', last_error = 'superseded by newer pending job', finished_at = now()
+WHERE j.status = 'pending'
+  AND EXISTS (
+      SELECT 1 FROM t_p8980362_bitrix_webhook_handl.company_check_jobs newer
+      WHERE newer.bitrix_id = j.bitrix_id AND newer.status = 'pending' AND newer.id > j.id
+  );
+
+DROP INDEX IF EXISTS t_p8980362_bitrix_webhook_handl.idx_company_check_jobs_pending_company;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_company_check_jobs_pending_company ON t_p8980362_bitrix_webhook_handl.company_check_jobs(bitrix_id) WHERE status = 'pending';
@@ -0,0 +1,5 @@
+-- Отрицательный кэш справочника пользователей: момент последнего неудачного user.get.
+-- Строка-заглушка без имени (full_name = '') создаётся для пользователей, которых ни разу не удалось получить
+ALTER TABLE t_p8980362_bitrix_webhook_handl.bitrix_users ADD COLUMN IF NOT EXISTS lookup_failed_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.bitrix_users.lookup_failed_at IS 'Последний неудачный user.get; повтор не раньше BITRIX_USERS_NEGATIVE_TTL_SECONDS';
@@ -0,0 +1,5 @@
+-- Захват пачки dirty_deals сбросом: строки помечаются claimed_at короткой транзакцией,
+-- поэтому вебхуки по этим сделкам не ждут запросов сброса к Битрикс24
+ALTER TABLE t_p8980362_bitrix_webhook_handl.dirty_deals ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMP WITH TIME ZONE;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.dirty_deals.claimed_at IS 'Момент захвата сбросом; NULL - ждёт сброса, старше DEAL_CLAIM_TTL_SECONDS - сброс упал';
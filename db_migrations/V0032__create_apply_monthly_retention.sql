@@ -0,0 +1,61 @@
+-- Единая ротация помесячных журналов для всех функций (bitrix-webhook, purchases):
+-- заранее создаёт секции и удаляет секции старше keep_months. keep_months < 1 отклоняется -
+-- иначе граница среза попадает на текущий или будущий месяц и удаляет текущие данные
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.drop_expired_monthly_partitions(parent_table TEXT, keep_months INTEGER)
+RETURNS SETOF TEXT
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    schema_name CONSTANT TEXT := 't_p8980362_bitrix_webhook_handl';
+    cutoff DATE;
+    partition_record RECORD;
+BEGIN
+    IF keep_months IS NULL OR keep_months < 1 THEN
+        RAISE EXCEPTION 'keep_months must be at least 1, got %', keep_months USING ERRCODE = '22023';
+    END IF;
+    cutoff := (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date;
+
+    FOR partition_record IN
+        SELECT child.relname AS partition_name
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        JOIN pg_namespace ns ON ns.oid = parent.relnamespace
+        WHERE ns.nspname = schema_name
+          AND parent.relname = parent_table
+          AND child.relname ~ ('^' || parent_table || '_[0-9]{4}_[0-9]{2}$')
+          AND to_date(right(child.relname, 7), 'YYYY_MM') < cutoff
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I.%I DETACH PARTITION %I.%I',
+            schema_name, parent_table, schema_name, partition_record.partition_name);
+        EXECUTE format('DROP TABLE %I.%I', schema_name, partition_record.partition_name);
+        RETURN NEXT partition_record.partition_name;
+    END LOOP;
+END;
+$$;
+
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.apply_monthly_retention(parent_table TEXT, keep_months INTEGER, months_ahead INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    created_count INTEGER;
+    dropped TEXT[];
+BEGIN
+    IF keep_months IS NULL OR keep_months < 1 THEN
+        RAISE EXCEPTION 'keep_months must be at least 1, got %', keep_months USING ERRCODE = '22023';
+    END IF;
+
+    created_count := t_p8980362_bitrix_webhook_handl.ensure_monthly_partitions(parent_table, CURRENT_DATE, months_ahead);
+    SELECT COALESCE(array_agg(p), ARRAY[]::TEXT[]) INTO dropped
+    FROM t_p8980362_bitrix_webhook_handl.drop_expired_monthly_partitions(parent_table, keep_months) AS p;
+
+    RETURN jsonb_build_object(
+        'table', parent_table,
+        'keep_months', keep_months,
+        'partitions_created', created_count,
+        'partitions_dropped', to_jsonb(dropped)
+    );
+END;
+$$;
@@ -0,0 +1,7 @@
+-- Полный проход синхронизации: момент начала (строки companies, не встреченные с этого момента, удаляются
+-- по завершении прохода) и отметка инкрементального прохода по DATE_MODIFY после завершения
+ALTER TABLE t_p8980362_bitrix_webhook_handl.sync_state ADD COLUMN IF NOT EXISTS pass_started_at TIMESTAMPTZ;
+ALTER TABLE t_p8980362_bitrix_webhook_handl.sync_state ADD COLUMN IF NOT EXISTS modified_since TIMESTAMPTZ;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.sync_state.pass_started_at IS 'Начало текущего/последнего полного прохода по ID';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.sync_state.modified_since IS 'Инкрементальный проход забирает записи с DATE_MODIFY позже этой отметки';
@@ -0,0 +1,5 @@
+-- Реквизит, из которого взят ИНН компании в индексе: при нескольких реквизитах с ИНН выигрывает наименьший ID
+ALTER TABLE t_p8980362_bitrix_webhook_handl.companies ADD COLUMN IF NOT EXISTS requisite_id BIGINT;
+
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.companies.requisite_id IS 'ID реквизита Битрикс24, давшего ИНН; NULL - ИНН записан проверкой компании, а не синхронизацией реквизитов';
+COMMENT ON COLUMN t_p8980362_bitrix_webhook_handl.sync_state.modified_since IS 'Инкрементальный проход забирает записи с DATE_MODIFY не раньше этой отметки';
@@ -0,0 +1,64 @@
+-- Ротация журналов чистит и DEFAULT-секцию: строки, попавшие туда до создания месячной секции
+-- (или с created_at вне созданных месяцев), раньше не удалялись ни DROP секции, ни чем-либо ещё
+CREATE OR REPLACE FUNCTION t_p8980362_bitrix_webhook_handl.apply_monthly_retention(parent_table TEXT, keep_months INTEGER, months_ahead INTEGER)
+RETURNS JSONB
+LANGUAGE plpgsql
+AS $$
+DECLARE
+    schema_name CONSTANT TEXT := 't_p8980362_bitrix_webhook_handl';
+    created_count INTEGER;
+    dropped TEXT[];
+    cutoff DATE;
+    default_deleted INTEGER := 0;
+BEGIN
+    IF keep_months IS NULL OR keep_months < 1 THEN
+        RAISE EXCEPTION 'keep_months must be at least 1, got %', keep_months USING ERRCODE = '22023';
+    END IF;
+    cutoff := (date_trunc('month', CURRENT_DATE) - make_interval(months => keep_months))::date;
+
+    created_count := t_p8980362_bitrix_webhook_handl.ensure_monthly_partitions(parent_table, CURRENT_DATE, months_ahead);
+    SELECT COALESCE(array_agg(p), ARRAY[]::TEXT[]) INTO dropped
+    FROM t_p8980362_bitrix_webhook_handl.drop_expired_monthly_partitions(parent_table, keep_months) AS p;
+
+    -- Та же граница, что и у удаляемых секций: строки DEFAULT старше начала первого хранимого месяца
+    IF to_regclass(format('%I.%I', schema_name, parent_table || '_default')) IS NOT NULL THEN
+        EXECUTE format('DELETE FROM %I.%I WHERE created_at < %L', schema_name, parent_table || '_default', cutoff);
+        GET DIAGNOSTICS default_deleted = ROW_COUNT;
+    END IF;
+
+    RETURN jsonb_build_object(
+        'table', parent_table,
+        'keep_months', keep_months,
+        'partitions_created', created_count,
+        'partitions_dropped', to_jsonb(dropped),
+        'default_rows_deleted', default_deleted
+    );
+END;
+$$;
+
+-- Проверка при накате: старая строка DEFAULT удаляется, строка текущего месяца переезжает в свою секцию и остаётся
+DO $$
+DECLARE
+    retention JSONB;
+    remaining INTEGER;
+BEGIN
+    CREATE TABLE t_p8980362_bitrix_webhook_handl.retention_smoke_check (
+        id SERIAL,
+        created_at TIMESTAMP NOT NULL
+    ) PARTITION BY RANGE (created_at);
+    CREATE TABLE t_p8980362_bitrix_webhook_handl.retention_smoke_check_default
+        PARTITION OF t_p8980362_bitrix_webhook_handl.retention_smoke_check DEFAULT;
+
+    INSERT INTO t_p8980362_bitrix_webhook_handl.retention_smoke_check (created_at)
+    VALUES (date_trunc('month', CURRENT_DATE) - INTERVAL '2 months'), (CURRENT_TIMESTAMP);
+
+    retention := t_p8980362_bitrix_webhook_handl.apply_monthly_retention('retention_smoke_check', 1, 0);
+    SELECT COUNT(*) INTO remaining FROM t_p8980362_bitrix_webhook_handl.retention_smoke_check;
+
+    IF (retention->>'default_rows_deleted')::INTEGER <> 1 OR remaining <> 1 THEN
+        RAISE EXCEPTION 'apply_monthly_retention smoke check failed: %, remaining rows %', retention, remaining;
+    END IF;
+
+    DROP TABLE t_p8980362_bitrix_webhook_handl.retention_smoke_check;
+END;
+$$;
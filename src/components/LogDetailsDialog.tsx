@@ -7,7 +7,7 @@ interface WebhookLog {
   webhook_type: string;
   inn: string;
   bitrix_company_id: string;
-  request_body: string;
+  request_body?: string;
   response_status: string;
   duplicate_found: boolean;
   action_taken: string;
@@ -85,6 +85,9 @@ export default function LogDetailsDialog({
 
             {(() => {
               try {
+                if (!selectedLog.request_body) {
+                  return null;
+                }
                 const requestBody = JSON.parse(selectedLog.request_body);
                 const searchDetails = requestBody.search_details;
                 
@@ -162,7 +165,9 @@ export default function LogDetailsDialog({
             <div className="space-y-2">
               <p className="text-sm font-semibold text-muted-foreground">Тело запроса (полное)</p>
               <pre className="text-xs bg-secondary p-3 rounded overflow-x-auto max-h-[300px]">
-                {JSON.stringify(JSON.parse(selectedLog.request_body), null, 2)}
+                {selectedLog.request_body
+                  ? JSON.stringify(JSON.parse(selectedLog.request_body), null, 2)
+                  : 'Загрузка...'}
               </pre>
             </div>
 
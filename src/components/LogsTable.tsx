@@ -10,7 +10,7 @@ interface WebhookLog {
   webhook_type: string;
   inn: string;
   bitrix_company_id: string;
-  request_body: string;
+  request_body?: string;
   response_status: string;
   duplicate_found: boolean;
   action_taken: string;
@@ -56,6 +56,16 @@ export default function DealChangesTable({
       );
     }
     
+    const changedFields = Object.keys(change.changes_summary?.fields || {});
+    if (changedFields.length > 0) {
+      return (
+        <span className="text-slate-600 text-xs" title={changedFields.join(', ')}>
+          Поля: {changedFields.slice(0, 3).join(', ')}
+          {changedFields.length > 3 && ` +${changedFields.length - 3}`}
+        </span>
+      );
+    }
+    
     if (change.current_stage && !change.previous_stage) {
       return (
         <div className="flex items-center gap-2">
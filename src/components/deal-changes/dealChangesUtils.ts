@@ -4,11 +4,13 @@ export interface DealChange {
   event_type: string;
   deal_data: any;
   timestamp_received: string;
+  event_ts?: number;
   modifier_user_id?: string;
   modifier_user_name?: string;
   previous_stage?: string;
   current_stage?: string;
   changes_summary?: any;
+  is_snapshot?: boolean;
 }
 
 export interface RollbackLog {
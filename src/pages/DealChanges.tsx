@@ -34,7 +34,7 @@ export default function DealChanges() {
       });
       
       if (searchQuery.trim()) {
-        params.append('search', searchQuery.trim());
+        params.append('q', searchQuery.trim());
       }
 
       const response = await fetch(`${BACKEND_URL}?${params}`);
@@ -15,7 +15,7 @@ interface WebhookLog {
   webhook_type: string;
   inn: string;
   bitrix_company_id: string;
-  request_body: string;
+  request_body?: string;
   response_status: string;
   duplicate_found: boolean;
   action_taken: string;
@@ -60,6 +60,25 @@ export default function InnUniqueness() {
     }
   };
 
+  const fetchLogDetail = async (id: number): Promise<WebhookLog | null> => {
+    try {
+      const response = await fetch(`${API_URL}?action=log&id=${id}`);
+      const data = await response.json();
+      return data.log || null;
+    } catch (error) {
+      console.error('Error fetching log detail:', error);
+      return null;
+    }
+  };
+
+  const selectLog = async (log: WebhookLog) => {
+    setSelectedLog(log);
+    const detail = await fetchLogDetail(log.id);
+    if (detail) {
+      setSelectedLog(detail);
+    }
+  };
+
   const clearLogs = async () => {
     setIsClearing(true);
     try {
@@ -79,15 +98,6 @@ export default function InnUniqueness() {
   const restoreCompany = async (log: WebhookLog) => {
     setRestoringId(log.id);
     try {
-      const requestBody = JSON.parse(log.request_body);
-      const companyData = requestBody.deleted_company_data;
-      
-      if (!companyData) {
-        alert('Данные для восстановления не найдены в логе. Возможно компания была удалена до обновления системы.');
-        setRestoringId(null);
-        return;
-      }
-
       const response = await fetch(API_URL, {
         method: 'POST',
         headers: {
@@ -95,10 +105,15 @@ export default function InnUniqueness() {
         },
         body: JSON.stringify({
           action: 'restore',
-          original_data: companyData,
+          log_id: log.id,
         }),
       });
 
+      if (response.status === 404) {
+        alert('Данные для восстановления не найдены в логе. Возможно компания была удалена до обновления системы.');
+        return;
+      }
+
       const result = await response.json();
       
       if (result.success) {
@@ -180,7 +195,7 @@ export default function InnUniqueness() {
               loading={loading}
               isClearing={isClearing}
               restoringId={restoringId}
-              onLogSelect={setSelectedLog}
+              onLogSelect={selectLog}
               onClearLogs={clearLogs}
               onRestoreCompany={restoreCompany}
               formatDate={formatDate}
@@ -199,7 +214,7 @@ export default function InnUniqueness() {
 
         {selectedLog && (
           <LogDetailsDialog
-            log={selectedLog}
+            selectedLog={selectedLog}
             onClose={() => setSelectedLog(null)}
             formatDate={formatDate}
             getStatusBadge={getStatusBadge}